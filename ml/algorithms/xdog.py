@@ -1,5 +1,7 @@
 import cv2 as cv
 import numpy as np
+import torch
+import torch.nn.functional as nnF
 
 
 def xdog_filter(
@@ -50,3 +52,65 @@ def extract_edges_cv(
     im = xdog_filter(im, kernel_size, sigma, k_sigma, eps, phi, gamma)  # xdog
 
     return im
+
+
+def _cv_gaussian_kernel_1d(kernel_size, sigma):
+    # same kernel as cv.GaussianBlur on 8 bit images, which picks the size from sigma when it is 0
+    if kernel_size <= 0:
+        kernel_size = int(round(sigma * 3 * 2 + 1)) | 1
+    if sigma <= 0:
+        if kernel_size == 5:
+            return torch.tensor([1., 4., 6., 4., 1.], dtype=torch.float64) / 16  # fixed small kernel of cv
+        sigma = 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8
+    x = torch.arange(kernel_size, dtype=torch.float64) - (kernel_size - 1) / 2
+    kernel = torch.exp(-x ** 2 / (2 * sigma ** 2))
+    return kernel / kernel.sum()
+
+
+def _gaussian_kernels(kernel_size, sigmas):
+    # (N, K) kernel of each sample, zero padded to the largest one so that a single grouped conv applies all
+    kernels = [_cv_gaussian_kernel_1d(kernel_size, sigma) for sigma in sigmas]
+    max_size = max(len(kernel) for kernel in kernels)
+    return torch.stack([nnF.pad(kernel, ((max_size - len(kernel)) // 2,) * 2) for kernel in kernels])
+
+
+def _gaussian_blur_8bit(x: torch.Tensor, kernels: torch.Tensor):
+    # separable blur of (N, 1, H, W) with the kernel of each sample, reflect 101 border and rounding as cv on uint8
+    n, _, h, w = x.shape
+    kernels = kernels.to(x.device, x.dtype)
+    pad = kernels.shape[1] // 2
+    x = x.reshape(1, n, h, w)
+    x = nnF.conv2d(nnF.pad(x, (pad, pad, 0, 0), mode='reflect'), kernels[:, None, None, :], groups=n)
+    x = nnF.conv2d(nnF.pad(x, (0, 0, pad, pad), mode='reflect'), kernels[:, None, :, None], groups=n)
+    return torch.floor(x.reshape(n, 1, h, w) + 0.5).clamp_(0, 255)
+
+
+def extract_edges_torch(
+        batch: torch.Tensor,
+        sigma=0.3,  # 0.3/0.4/0.5, or one per sample
+        kernel_size=0,
+        k_sigma=4.5,
+        eps=0.0,
+        phi=10e9,
+        gamma=0.95,
+):
+    """
+    extract_edges_cv for a (N, 3, H, W) batch of rgb images in [0, 255] on any device, (N, 1, H, W) in [0, 1] out.
+    Grayscale conversion, blurs and their rounding follow cv on 8 bit images,
+    the blurs are a separable grouped convolution with the kernel of each sample's sigma.
+    """
+    n = batch.shape[0]
+    sigmas = [float(s) for s in sigma] if isinstance(sigma, (list, tuple, torch.Tensor)) else [float(sigma)] * n
+    assert len(sigmas) == n, f'one sigma per sample is needed: {len(sigmas)} != {n}'
+
+    # cv.COLOR_RGB2GRAY on uint8, fixed point
+    r, g, b = torch.floor(batch.float() + 0.5).clamp(0, 255).to(torch.int32).split(1, dim=1)
+    im = ((r * 4899 + g * 9617 + b * 1868 + (1 << 13)) >> 14).float()
+
+    im = _gaussian_blur_8bit(im, _gaussian_kernels(5, [0] * n))  # blur to remove noise
+    g1 = _gaussian_blur_8bit(im, _gaussian_kernels(kernel_size, sigmas))
+    g2 = _gaussian_blur_8bit(im, _gaussian_kernels(kernel_size, [s * k_sigma for s in sigmas]))
+
+    dog = g1 - gamma * g2
+    dog = dog / dog.amax(dim=(1, 2, 3), keepdim=True)
+    return (1 + torch.tanh(phi * (dog - eps))).clamp_(max=1)
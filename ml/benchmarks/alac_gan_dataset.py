@@ -0,0 +1,38 @@
+import time
+
+from ml.datasets.alac_gan import AlacGANTrainDataset
+from ml.options.alac_gan import AlacGANTrainOptions
+
+N_SAMPLES = 200
+
+
+def _samples_per_sec(func, n):
+    start = time.perf_counter()
+    for i in range(n):
+        func(i)
+    return n / (time.perf_counter() - start)
+
+
+def benchmark(dataset_sketches):
+    opt = AlacGANTrainOptions()
+    opt.dataset_sketches = dataset_sketches
+    dataset = AlacGANTrainDataset(opt)
+    n = min(N_SAMPLES, len(dataset))
+
+    # read is the sketch and color only, getitem includes the transforms
+    read = _samples_per_sec(lambda i: dataset._read_sketch_and_color(i, 0.4), n)
+    getitem = _samples_per_sec(lambda i: dataset[i], n)
+
+    return read, getitem
+
+
+def main():
+    # requires packed sketches, see ml/preprocess/preprocess_pack_sketches.py
+    print(f'{"mode":<10}{"read/s":>12}{"getitem/s":>12}')
+    for name, dataset_sketches in [('xdog', False), ('sketches', True)]:
+        read, getitem = benchmark(dataset_sketches)
+        print(f'{name:<10}{read:>12.1f}{getitem:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
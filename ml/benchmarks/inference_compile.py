@@ -0,0 +1,61 @@
+import os
+import statistics
+import tempfile
+import time
+
+import torch
+
+from ml.models.export import CompiledNetwork
+from ml.models.pix2pix_partials import Generator
+from ml.models.sketch_simp_partials import SketchSimpModel
+from ml.models.waifu2x_partials import Net
+from ml.options.pix2pix import Pix2pixTrainOptions
+
+BATCH_SIZES = [1, 8]
+IMAGE_SIZE = 256  # the pix2pix generator halves the resolution 8 times
+N_RUNS = 5
+BACKENDS = ['torchscript', 'compile']
+
+
+def _networks():
+    # (name, network, channels, input size, non tensor args) with random weights, latency does not depend on them
+    opt = Pix2pixTrainOptions()
+    return [
+        ('pix2pix', Generator(opt), opt.generator_config['in_channels'], IMAGE_SIZE, ()),
+        ('sketch_simp', SketchSimpModel(), 1, IMAGE_SIZE, ()),
+        ('waifu2x', Net(scale=2, multi_scale=False, group=1), 3, IMAGE_SIZE // 2, (2,)),
+    ]
+
+
+def _latency(forward, x):
+    # median seconds of a forward pass, after one warm up pass that also traces or compiles
+    times = []
+    with torch.inference_mode():
+        forward(x)
+        for _ in range(N_RUNS):
+            start = time.perf_counter()
+            forward(x)
+            times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    torch.manual_seed(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f'{"network":<14}{"batch":>6}{"eager":>10}' + ''.join(f'{backend:>14}' for backend in BACKENDS))
+        for name, net, channels, size, args in _networks():
+            net = net.eval()
+            checkpoint_file = os.path.join(tmp_dir, f'{name}.ckpt')
+            torch.save({'network_state_dict': net.state_dict()}, checkpoint_file)
+
+            for batch_size in BATCH_SIZES:
+                x = torch.rand(batch_size, channels, size, size) * 2 - 1
+                eager = _latency(CompiledNetwork(net, name, None, checkpoint_file, args), x)
+                compiled = [_latency(CompiledNetwork(net, name, backend, checkpoint_file, args), x)
+                            for backend in BACKENDS]
+                print(f'{name:<14}{batch_size:>6}{eager * 1000:>8.1f}ms'
+                      + ''.join(f'{seconds * 1000:>8.1f}ms {eager / seconds:>3.1f}x' for seconds in compiled))
+
+
+if __name__ == '__main__':
+    main()
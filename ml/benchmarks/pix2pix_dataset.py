@@ -0,0 +1,38 @@
+import time
+
+from ml.datasets.pix2pix import Pix2pixTrainDataset
+from ml.options.pix2pix import Pix2pixTrainOptions
+
+N_SAMPLES = 500
+
+
+def _samples_per_sec(func, n):
+    start = time.perf_counter()
+    for i in range(n):
+        func(i)
+    return n / (time.perf_counter() - start)
+
+
+def benchmark(dataset_shards):
+    opt = Pix2pixTrainOptions()
+    opt.dataset_shards = dataset_shards
+    dataset = Pix2pixTrainDataset(opt)
+    n = min(N_SAMPLES, len(dataset))
+
+    # read only measures decoding / memmap access, getitem includes the augmentations
+    read = _samples_per_sec(lambda i: dataset._read_AB(i), n)
+    getitem = _samples_per_sec(lambda i: dataset[i], n)
+
+    return read, getitem
+
+
+def main():
+    # requires shards, see ml/preprocess/preprocess_pack_shards.py
+    print(f'{"mode":<8}{"read/s":>12}{"getitem/s":>12}')
+    for name, dataset_shards in [('jpeg', False), ('shards', True)]:
+        read, getitem = benchmark(dataset_shards)
+        print(f'{name:<8}{read:>12.1f}{getitem:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import os
+import tempfile
+import time
+
+import torch
+
+from ml.image_writer import ImageWriter, to_uint8_images
+from ml.plot_utils import plt_horizontals, save_raw_im
+
+BATCH_SIZE = 8
+IMAGE_SIZE = 512
+N_BATCHES_MATPLOTLIB = 2  # matplotlib is slow, a few batches are enough
+N_BATCHES_WRITER = 16
+
+
+def _random_batches(n):
+    # stands in for the network output, only the writing is measured
+    batches = []
+    for _ in range(n):
+        inp, tar, out = (torch.rand(BATCH_SIZE, 1, IMAGE_SIZE, IMAGE_SIZE) * 2 - 1 for _ in range(3))
+        batches.append((inp, tar, out, (out > 0.5) * 1.0))
+    return batches
+
+
+def _write_matplotlib(batches, folder):
+    # what Pix2pixInferenceModel.inference did before
+    for b, (inp_batch, tar_batch, out_batch, thresh_batch) in enumerate(batches):
+        for i, (inp, tar, out, thresh) in enumerate(zip(inp_batch, tar_batch, out_batch, thresh_batch)):
+            prefix = os.path.join(folder, f'{b}-{i}')
+            plt_horizontals([inp, tar, out], titles=['input', 'target', 'output', 'threshold'],
+                            un_normalize=True, grayscale=True, figsize=(3, 1), save_file=f'{prefix}.png')
+            for name, im in [('in', inp), ('tar', tar), ('out', out), ('threshold', thresh)]:
+                save_raw_im(im, f'{prefix}-{name}.png', grayscale=True)
+
+
+def _write_image_writer(batches, folder):
+    writer = ImageWriter()
+    for b, (inp_batch, tar_batch, out_batch, thresh_batch) in enumerate(batches):
+        inp_ims, tar_ims, out_ims = [to_uint8_images(batch) for batch in (inp_batch, tar_batch, out_batch)]
+        thresh_ims = to_uint8_images(thresh_batch, un_normalize=False)
+        for i, ims in enumerate(zip(inp_ims, tar_ims, out_ims, thresh_ims)):
+            prefix = os.path.join(folder, f'{b}-{i}')
+            writer.write_strip(f'{prefix}.png', ims)
+            for name, im in zip(['in', 'tar', 'out', 'threshold'], ims):
+                writer.write(f'{prefix}-{name}.png', im)
+    writer.close()
+
+
+def _images_per_sec(write_func, n_batches):
+    batches = _random_batches(n_batches)
+    with tempfile.TemporaryDirectory() as folder:
+        start = time.perf_counter()
+        write_func(batches, folder)
+        return n_batches * BATCH_SIZE / (time.perf_counter() - start)
+
+
+def main():
+    print(f'{"writer":<14}{"images/s":>10}')
+    for name, write_func, n_batches in [('matplotlib', _write_matplotlib, N_BATCHES_MATPLOTLIB),
+                                        ('image_writer', _write_image_writer, N_BATCHES_WRITER)]:
+        print(f'{name:<14}{_images_per_sec(write_func, n_batches):>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
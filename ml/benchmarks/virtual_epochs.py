@@ -0,0 +1,56 @@
+import itertools
+import time
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from ml.datasets.sampler import InfiniteSampler
+
+N_EPOCHS = 50
+DATASET_SIZE = 64
+BATCH_SIZE = 8
+NUM_WORKERS = 4
+
+
+class _TinyDataset(Dataset):
+    # stands in for a small pix2pix folder, the per sample cost is irrelevant here
+
+    def __len__(self):
+        return DATASET_SIZE
+
+    def __getitem__(self, i):
+        return torch.zeros(1, 64, 64), torch.zeros(1, 64, 64)
+
+
+def _run_epochs(loader, virtual):
+    train_iter = iter(loader) if virtual else None
+    n_batches = 0
+
+    start = time.perf_counter()
+    for _ in range(N_EPOCHS):
+        batches = itertools.islice(train_iter, len(loader)) if virtual else loader
+        for _ in batches:
+            n_batches += 1
+    return time.perf_counter() - start, n_batches
+
+
+def main():
+    dataset = _TinyDataset()
+    loaders = {
+        'per-epoch': DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=True, num_workers=NUM_WORKERS,
+                                drop_last=True),
+        'persistent': DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=True, num_workers=NUM_WORKERS,
+                                 drop_last=True, persistent_workers=True),
+        'virtual': DataLoader(dataset, batch_size=BATCH_SIZE, sampler=InfiniteSampler(dataset),
+                              num_workers=NUM_WORKERS, drop_last=True),
+    }
+
+    print(f'{N_EPOCHS} epochs of {DATASET_SIZE // BATCH_SIZE} batches, {NUM_WORKERS} workers')
+    print(f'{"mode":<12}{"total(s)":>10}{"epoch(ms)":>12}{"batches":>10}')
+    for name, loader in loaders.items():
+        total, n_batches = _run_epochs(loader, virtual=name == 'virtual')
+        print(f'{name:<12}{total:>10.2f}{total / N_EPOCHS * 1000:>12.1f}{n_batches:>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+import time
+
+import numpy as np
+
+from ml.preprocess.src.functions import compute_weight_map, compute_weight_maps
+from tests.reference import compute_weight_map_loop
+
+N_BINS = 10
+DIST = 8
+SMALL_SIZE = 64  # the loop takes about a second here already
+LARGE_SIZE = 512
+BATCH_SIZE = 16
+
+
+def _seconds(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    # the outputs are checked against the loop by tests/test_weight_map.py
+    rng = np.random.default_rng(0)
+    small = rng.random((SMALL_SIZE, SMALL_SIZE))
+    large = rng.random((BATCH_SIZE, LARGE_SIZE, LARGE_SIZE))
+    print(f'{"implementation":<24}{"seconds":>10}')
+    print(f'{f"loop {SMALL_SIZE}x{SMALL_SIZE}":<24}'
+          f'{_seconds(lambda: compute_weight_map_loop(small, N_BINS, DIST)):>10.3f}')
+    print(f'{f"vectorised {SMALL_SIZE}x{SMALL_SIZE}":<24}'
+          f'{_seconds(lambda: compute_weight_map(small, (N_BINS, DIST))):>10.3f}')
+    print(f'{f"vectorised {BATCH_SIZE}x{LARGE_SIZE}x{LARGE_SIZE}":<24}'
+          f'{_seconds(lambda: compute_weight_maps(large, N_BINS, DIST)):>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import time
+
+import numpy as np
+import torch
+
+from ml.algorithms.xdog import extract_edges_cv, extract_edges_torch
+from tests.reference import random_images, to_batch
+
+SIGMAS = [0.3, 0.4, 0.5]
+IMAGE_SIZE = 512
+BATCH_SIZE = 16
+
+
+def _seconds(func, device):
+    func()  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    func()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def main():
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # the outputs are checked against cv by tests/test_xdog.py
+    rng = np.random.default_rng(0)
+    ims = random_images(rng, BATCH_SIZE, IMAGE_SIZE)
+    sigmas = [SIGMAS[i % len(SIGMAS)] for i in range(BATCH_SIZE)]
+    batch = to_batch(ims, device)
+    print(f'{"implementation":<32}{"seconds":>10}')
+    print(f'{f"cv per sample {BATCH_SIZE}x{IMAGE_SIZE}":<32}'
+          f'{_seconds(lambda: [extract_edges_cv(im, sigma=s) for im, s in zip(ims, sigmas)], device):>10.3f}')
+    with torch.no_grad():
+        print(f'{f"torch batched {BATCH_SIZE}x{IMAGE_SIZE} ({device.type})":<32}'
+              f'{_seconds(lambda: extract_edges_torch(batch, sigmas), device):>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import copy
+import os
+import queue
+import shutil
+import threading
+
+import torch
+
+from ml.logger import log
+from ml.save_load import save_file
+
+
+def snapshot_to_cpu(obj, pin_memory=False):
+    """
+    Copy of a checkpoint with every tensor moved to cpu, so that training can continue modifying the originals
+    while the copy is written. Copies from cuda go to pinned memory without blocking, caller must synchronize.
+    """
+    if isinstance(obj, torch.Tensor):
+        obj = obj.detach()
+        if obj.is_cuda and pin_memory:
+            cpu_tensor = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=True)
+            return cpu_tensor.copy_(obj, non_blocking=True)
+        return obj.to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_cpu(v, pin_memory)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v, pin_memory) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def _link_or_copy(src, dst):
+    # the new link is created next to dst and renamed over it, so dst is never missing or half written
+    tmp = dst + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        # filesystem without hardlinks
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints in a background thread and uploads them in another one.
+    At most max_in_flight snapshots are held in memory, save blocks when the writer falls behind.
+    """
+
+    def __init__(self, opt, max_in_flight=2, upload=True):
+        self.opt = opt
+        self.upload = upload
+        self.pin_memory = torch.cuda.is_available()
+
+        self.write_queue = queue.Queue(maxsize=max_in_flight)
+        self.upload_queue = queue.Queue()
+        self.error = None
+
+        self.write_thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.upload_thread = threading.Thread(target=self._upload_loop, daemon=True)
+        self.write_thread.start()
+        self.upload_thread.start()
+
+    def save(self, checkpoint, file_name, link_names=()):
+        self._raise_error()
+
+        snapshot = snapshot_to_cpu(checkpoint, self.pin_memory)
+        if self.pin_memory:
+            torch.cuda.synchronize()  # non blocking copies must finish before the state changes again
+        self.write_queue.put((snapshot, file_name, tuple(link_names)))
+
+    def flush(self):
+        self.write_queue.join()
+        self.upload_queue.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('background checkpoint writer failed') from error
+
+    def _write_loop(self):
+        while True:
+            snapshot, file_name, link_names = self.write_queue.get()
+            try:
+                tmp_file_name = file_name + '.tmp'
+                torch.save(snapshot, tmp_file_name)
+                os.replace(tmp_file_name, file_name)
+                # same content under another name, e.g. latest, without serializing again
+                for link_name in link_names:
+                    _link_or_copy(file_name, link_name)
+                log(f'Checkpoint written: {", ".join((file_name,) + link_names)}')
+
+                if self.upload:
+                    for name in (file_name,) + link_names:
+                        self.upload_queue.put(name)
+            except Exception as e:
+                self.error = e
+                log(f'Failed to write checkpoint {file_name}: {e}')
+            finally:
+                del snapshot
+                self.write_queue.task_done()
+
+    def _upload_loop(self):
+        while True:
+            file_name = self.upload_queue.get()
+            try:
+                save_file(self.opt, file_name)
+                log(f'Checkpoint uploaded: {file_name}')
+            except Exception as e:
+                self.error = e
+                log(f'Failed to upload checkpoint {file_name}: {e}')
+            finally:
+                self.upload_queue.task_done()
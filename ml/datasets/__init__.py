@@ -1,6 +1,10 @@
+import torch
 from torch.utils.data import DataLoader
 
 from ml.datasets.base import BaseDataset
+from ml.datasets.bucket import BucketBatchSampler
+from ml.datasets.prefetcher import DevicePrefetcher, seed_worker
+from ml.datasets.sampler import InfiniteSampler
 from ml.file_utils import _find_cls_using_name
 from ml.logger import log
 from ml.options.base import BaseTrainOptions, BaseInferenceOptions
@@ -25,14 +29,60 @@ def create_train_dataloaders(opt: BaseTrainOptions, name):
     )(opt)
     log(f'done: [{test_dataset.__class__.__name__}] was created')
 
-    train_dataloader = DataLoader(train_dataset, batch_size=opt.batch_size, shuffle=opt.shuffle,
-                                  num_workers=opt.num_workers, pin_memory=opt.pin_memory, drop_last=True)
-    test_dataloader = DataLoader(test_dataset, batch_size=opt.batch_size, shuffle=False, num_workers=opt.num_workers,
-                                 pin_memory=opt.pin_memory, drop_last=True)
+    if train_dataset.bucket_ids is not None:
+        # every batch from one aspect ratio bucket, endless with virtual epochs
+        batch_sampler = BucketBatchSampler(train_dataset.bucket_ids, opt.batch_size, shuffle=opt.shuffle,
+                                           drop_last=True, generator=torch.Generator().manual_seed(opt.random_seed),
+                                           infinite=opt.virtual_epochs)
+        train_dataloader = DataLoader(train_dataset, batch_sampler=batch_sampler, num_workers=opt.num_workers,
+                                      pin_memory=opt.pin_memory, **_worker_kwargs(opt))
+    elif opt.virtual_epochs:
+        # one endless loader for the whole run, BaseTrainModel.train cuts it into logical epochs
+        sampler = InfiniteSampler(train_dataset, shuffle=opt.shuffle,
+                                  generator=torch.Generator().manual_seed(opt.random_seed))
+        train_dataloader = DataLoader(train_dataset, batch_size=opt.batch_size, sampler=sampler,
+                                      num_workers=opt.num_workers, pin_memory=opt.pin_memory, drop_last=True,
+                                      **_worker_kwargs(opt))
+    else:
+        train_dataloader = DataLoader(train_dataset, batch_size=opt.batch_size, shuffle=opt.shuffle,
+                                      num_workers=opt.num_workers, pin_memory=opt.pin_memory, drop_last=True,
+                                      **_worker_kwargs(opt))
+    if test_dataset.bucket_ids is not None:
+        batch_sampler = BucketBatchSampler(test_dataset.bucket_ids, opt.batch_size, shuffle=False, drop_last=True)
+        test_dataloader = DataLoader(test_dataset, batch_sampler=batch_sampler, num_workers=opt.num_workers,
+                                     pin_memory=opt.pin_memory, **_worker_kwargs(opt))
+    else:
+        test_dataloader = DataLoader(test_dataset, batch_size=opt.batch_size, shuffle=False,
+                                     num_workers=opt.num_workers, pin_memory=opt.pin_memory, drop_last=True,
+                                     **_worker_kwargs(opt))
+
+    if opt.device_prefetch:
+        train_dataloader = DevicePrefetcher(train_dataloader, opt.device)
+        test_dataloader = DevicePrefetcher(test_dataloader, opt.device)
 
     return train_dataloader, test_dataloader
 
 
+def _worker_kwargs(opt: BaseTrainOptions):
+    # shuffling and worker seeds are derived from the run's random seed
+    kwargs = {
+        'generator': torch.Generator().manual_seed(opt.random_seed),
+        'worker_init_fn': seed_worker,
+    }
+
+    # these are only accepted by DataLoader when workers are used
+    if opt.num_workers > 0:
+        kwargs['persistent_workers'] = opt.persistent_workers
+        kwargs['prefetch_factor'] = opt.prefetch_factor
+
+    return kwargs
+
+
+def _collate_frames(batch):
+    # [(A, B), (A, B), ...] -> ([A, A, ...], [B, B, ...])
+    return tuple(list(items) for items in zip(*batch))
+
+
 def create_inference_dataloaders(opt: BaseInferenceOptions, name):
     log(f'Finding inference dataloaders with name: [{name}] ... ', end='')
     inference_dataset = _find_cls_using_name(
@@ -43,8 +93,10 @@ def create_inference_dataloaders(opt: BaseInferenceOptions, name):
     )(opt)
     log(f'done: [{inference_dataset.__class__.__name__}] was created')
 
+    # full resolution frames for tiled inference differ in size and cannot be stacked
+    collate_fn = _collate_frames if opt.inference_tile_size > 0 else None
     inference_dataloader = DataLoader(inference_dataset,
                                       batch_size=opt.batch_size, shuffle=False, num_workers=opt.num_workers,
-                                      pin_memory=opt.pin_memory, drop_last=False)
+                                      pin_memory=opt.pin_memory, drop_last=False, collate_fn=collate_fn)
 
     return inference_dataloader
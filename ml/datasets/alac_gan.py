@@ -9,13 +9,45 @@ from PIL import Image
 from torchvision.transforms import transforms, InterpolationMode
 import cv2 as cv
 
-from ml.algorithms.xdog import extract_edges_cv
+from ml.algorithms.xdog import extract_edges_cv, extract_edges_torch
 from ml.datasets import BaseDataset
-from ml.file_utils import get_all_image_paths
+from ml.datasets.shard import SketchShards, get_sketch_shard_root
+from ml.logger import log
 from ml.options.alac_gan import AlacGANTrainOptions, AlacGANInferenceOptions
 
 
-class AlacGANTrainDataset(BaseDataset):
+class _AlacGANSketchDataset(BaseDataset):
+    # sketches are read from the store packed by ml/preprocess/preprocess_pack_sketches.py when opt.dataset_sketches
+
+    def _init_sketch_shards(self, root):
+        assert not (self.opt.dataset_sketches and self.opt.batch_xdog), \
+            'sketches are either read from the packed store or extracted on device, not both'
+        self.sketch_shards, self.sketch_ids = None, None
+        if not self.opt.dataset_sketches:
+            return
+        self.sketch_shards = SketchShards(get_sketch_shard_root(root))
+        # images added or changed since packing are not in the store, their sketches are extracted on the fly,
+        # changes are found by the mtime and size of each file, as stored when packing
+        self.sketch_ids = []
+        for path in self.paths:
+            stat = os.stat(path)
+            self.sketch_ids.append(self.sketch_shards.find(os.path.relpath(path, root), [stat.st_mtime, stat.st_size]))
+        n_missing = sum(i < 0 for i in self.sketch_ids)
+        if n_missing:
+            log(f'{n_missing} of {len(self.paths)} images are not in {self.sketch_shards.shard_root}, '
+                f'their sketches are extracted on the fly')
+
+    def _read_sketch_and_color(self, i, sigma):
+        # (sketch, color) of sample i, the sketch is an 8 bit image from the store or a 0-1 float image extracted now
+        if self.sketch_shards is not None:
+            item = self.sketch_shards.read(self.sketch_ids[i], sigma)
+            if item is not None:
+                return item
+        _, B = self._split_image_cv(self._read_im_cv(self.paths[i]))
+        return extract_edges_cv(B, sigma=sigma), B
+
+
+class AlacGANTrainDataset(_AlacGANSketchDataset):
 
     @staticmethod
     def jitter(x):
@@ -25,8 +57,10 @@ class AlacGANTrainDataset(BaseDataset):
     def __init__(self, opt: AlacGANTrainOptions):
         super().__init__(opt)
         root = os.path.join(opt.dataset_root, opt.dataset_train_folder)
-        self.paths = sorted(get_all_image_paths(root))
+        self.paths = self._get_image_paths(root)
         self.a_to_b = opt.a_to_b
+        assert opt.a_to_b or not opt.batch_xdog, 'batch_xdog extracts the sketch from the color image, a_to_b is needed'
+        self._init_sketch_shards(root)
 
         self.c_trans = transforms.Compose([
             transforms.Resize(opt.image_size, InterpolationMode.BICUBIC),
@@ -59,8 +93,10 @@ class AlacGANTrainDataset(BaseDataset):
         # create own sketch using xdog
         sigma = 0.3 if r < 0.333 else (0.4 if r < 0.666 else 0.5)
 
-        _, B = self._split_image_cv(self._read_im_cv(self.paths[i]))
-        A = extract_edges_cv(B, sigma=sigma)
+        if self.opt.batch_xdog:
+            _, B = self._split_image_cv(self._read_im_cv(self.paths[i]))
+            return self._get_batch_xdog_item(B, sigma)
+        A, B = self._read_sketch_and_color(i, sigma)
         A, B = self._cv2pil_im(A), self._cv2pil_im(B)
         # A, B = self._split_image_pil(self._read_im_pil(self.paths[i]))
 
@@ -75,14 +111,26 @@ class AlacGANTrainDataset(BaseDataset):
 
         return c_im, v_im, s_im
 
+    def _get_batch_xdog_item(self, B, sigma):
+        # sketch is extracted from c_im for the whole batch on device by alac_gan_batch_xdog
+        c_im = self._cv2pil_im(B)
+        if random.random() < 0.5:
+            c_im = c_im.transpose(Image.FLIP_LEFT_RIGHT)
+        return self.c_trans(c_im), self.v_trans(c_im), torch.tensor(sigma)
+
 
-class AlacGANTestDataset(BaseDataset):
+class AlacGANTestDataset(_AlacGANSketchDataset):
 
     def __init__(self, opt: AlacGANTrainOptions):
         super().__init__(opt)
         root = os.path.join(opt.dataset_root, opt.dataset_test_folder)
-        self.paths = sorted(get_all_image_paths(root))
+        self.paths = self._get_image_paths(root)
         self.a_to_b = opt.a_to_b
+        assert opt.a_to_b or not opt.batch_xdog, 'batch_xdog extracts the sketch from the color image, a_to_b is needed'
+        self._init_sketch_shards(root)
+        if opt.feature_cache_dir is not None:
+            # test sketches are extracted the same way every time
+            self._init_sample_keys(root, 0.4, self.a_to_b, opt.batch_xdog, opt.image_size)
 
         self.c_trans = transforms.Compose([
             transforms.Resize(opt.image_size, InterpolationMode.BICUBIC),
@@ -106,8 +154,11 @@ class AlacGANTestDataset(BaseDataset):
         return len(self.paths)
 
     def __getitem__(self, i):
-        _, B = self._split_image_cv(self._read_im_cv(self.paths[i]))
-        A = extract_edges_cv(B, sigma=0.4)
+        if self.opt.batch_xdog:
+            _, B = self._split_image_cv(self._read_im_cv(self.paths[i]))
+            c_im = self._cv2pil_im(B)
+            return self._with_key(i, (self.c_trans(c_im), self.v_trans(c_im), torch.tensor(0.4)))
+        A, B = self._read_sketch_and_color(i, 0.4)
         A, B = self._cv2pil_im(A), self._cv2pil_im(B)
 
         s_im, c_im = (A, B) if self.a_to_b else (B, A)
@@ -115,7 +166,27 @@ class AlacGANTestDataset(BaseDataset):
         s_im = s_im.convert('L')
         c_im, v_im, s_im = self.c_trans(c_im), self.v_trans(c_im), self.s_trans(s_im)
 
-        return c_im, v_im, s_im
+        return self._with_key(i, (c_im, v_im, s_im))
+
+
+def alac_gan_batch_xdog(opt, batch_data, jitter=False):
+    """
+    Second half of the AlacGAN datasets when opt.batch_xdog is enabled, sketches of the whole batch are extracted
+    from the color images on opt.device, with the sigma of each sample. The sketch is extracted at image_size,
+    after the resize, the per sample path extracts it from the image as loaded.
+    """
+    c_im, v_im, sigma = [x.to(opt.device, non_blocking=True) for x in batch_data]
+
+    # back to the uint8 rgb that c_trans normalized
+    s_im = extract_edges_torch(torch.round((c_im * 0.5 + 0.5) * 255), sigma.tolist())
+    # same grey levels as the per sample path, where the 0-1 sketch is converted to an 8 bit pil image as is
+    s_im = torch.round(s_im) / 255
+    if jitter:
+        ran = torch.empty(len(s_im), 1, 1, 1, device=s_im.device).uniform_(0.7, 1)
+        s_im = s_im * ran + 1 - ran
+    s_im = (s_im - 0.5) / 0.5
+
+    return c_im, v_im, s_im
 
 
 class RandomCrop(object):
@@ -196,9 +267,13 @@ class AlacGANInferenceDataset(BaseDataset):
     def __init__(self, opt: AlacGANInferenceOptions):
         super().__init__(opt)
         root = os.path.join(opt.input_images_path)
-        self.paths = sorted(get_all_image_paths(root))
+        self.paths = self._get_image_paths(root)
         self.a_to_b = opt.a_to_b
+        assert opt.a_to_b or not opt.batch_xdog, 'batch_xdog extracts the sketch from the color image, a_to_b is needed'
         self.size = len(self.paths) if opt.limit is None else int(opt.limit)
+        if opt.feature_cache_dir is not None:
+            # inference sketches are extracted the same way every time
+            self._init_sample_keys(root, 0.4, self.a_to_b, opt.batch_xdog, opt.image_size)
 
         self.c_trans = transforms.Compose([
             transforms.Resize(opt.image_size, InterpolationMode.BICUBIC),
@@ -230,10 +305,11 @@ class AlacGANInferenceDataset(BaseDataset):
         if i >= self.size:
             raise IndexError(f'InferenceDatasetLoader out of range: {i}')
         _, B = self._split_image_cv(self._read_im_cv(self.paths[i]))
-        A = extract_edges_cv(B, sigma=0.4)
+        # with batch_xdog the sketch is extracted from c_im on device, A is not needed
+        A = extract_edges_cv(B, sigma=0.4) if not self.opt.batch_xdog else None
         A, B = (A, B) if self.a_to_b else (B, A)
 
-        s_im, c_im = self._cv2pil_im(A), self._cv2pil_im(B)
+        s_im, c_im = (self._cv2pil_im(A) if A is not None else None), self._cv2pil_im(B)
 
         if self.custom_color is not None:
             gray = cv.cvtColor(B, cv.COLOR_RGB2GRAY)
@@ -245,7 +321,10 @@ class AlacGANInferenceDataset(BaseDataset):
         else:
             v_im = self.v_trans(c_im)
 
+        if self.opt.batch_xdog:
+            return self._with_key(i, (self.c_trans(c_im), v_im, torch.tensor(0.4)))
+
         s_im = s_im.convert('L')
         c_im, s_im = self.c_trans(c_im), self.s_trans(s_im)
 
-        return c_im, v_im, s_im
+        return self._with_key(i, (c_im, v_im, s_im))
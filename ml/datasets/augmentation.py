@@ -5,6 +5,7 @@ from typing import List, Tuple, Sequence
 import cv2 as cv
 import numpy as np
 import torch
+import torch.nn.functional as nnF
 import torchvision.transforms.functional as F
 from PIL import Image
 from torch import nn
@@ -105,6 +106,51 @@ def rotated_crop_dims(w, h, angle):
     return wr, hr
 
 
+def affine_theta(width, height, crop=None, rotate_deg=0, mirror=False):
+    """
+    Affine matrix for F.affine_grid that performs crop -> rotate & crop max -> mirror
+    on an image of size width x height, equivalent to the pil pipeline in Pix2pixDataset.
+    crop is (top, left, crop_height, crop_width) in pixels, same as FixedRandomResizedCrop.get_params.
+    """
+    if crop is None:
+        crop = 0, 0, height, width
+    top, left, crop_h, crop_w = crop
+
+    # center of the crop, relative to the image center, in pixels
+    cx = left + crop_w / 2 - width / 2
+    cy = top + crop_h / 2 - height / 2
+
+    # largest axis aligned rectangle inside the rotated crop
+    if rotate_deg != 0:
+        new_w, new_h = rotated_crop_dims(crop_w, crop_h, rotate_deg)
+        crop_w, crop_h = min(crop_w, new_w), min(crop_h, new_h)
+
+    half_w = crop_w / 2 * (-1 if mirror else 1)
+    half_h = crop_h / 2
+
+    # counter-clockwise rotation (pil convention) in image coordinates, where y points down
+    angle = math.radians(rotate_deg)
+    cos_a, sin_a = math.cos(angle), math.sin(angle)
+
+    # maps output normalized coordinates to input normalized coordinates
+    return torch.tensor([
+        [2 / width * cos_a * half_w, -2 / width * sin_a * half_h, 2 * cx / width],
+        [2 / height * sin_a * half_w, 2 / height * cos_a * half_h, 2 * cy / height],
+    ], dtype=torch.float32)
+
+
+def batch_affine_warp(ims: torch.Tensor, theta: torch.Tensor, size, mode='bicubic'):
+    """
+    Warp a whole batch (N, C, H, W) with per sample affine matrices (N, 2, 3) from affine_theta in one call,
+    the input may be any resolution since the affine matrices work in normalized coordinates.
+    size is the output size, an int or (height, width).
+    """
+    ims = ims.float()
+    h, w = (size, size) if isinstance(size, int) else size
+    grid = nnF.affine_grid(theta.to(ims), [ims.shape[0], ims.shape[1], h, w], align_corners=False)
+    return nnF.grid_sample(ims, grid, mode=mode, padding_mode='border', align_corners=False)
+
+
 # a copy of torch vision's random resize crop, except that it is deterministic for every instance of it
 # I did this by moving get_params to __init__ instead of forward
 class FixedRandomResizedCrop(nn.Module):
@@ -1,3 +1,4 @@
+import os
 from abc import abstractmethod, ABC
 
 import numpy as np
@@ -6,13 +7,67 @@ from torch.utils.data.dataset import Dataset
 
 import cv2 as cv
 
+from ml.datasets.bucket import make_buckets, assign_buckets
+from ml.datasets.cache import get_image_cache
+from ml.datasets.index import get_image_index
+from ml.file_utils import get_all_image_paths
 from ml.logger import log
 
 
 class BaseDataset(Dataset, ABC):
+    # set by datasets that support aspect ratio bucketing, batches are then drawn from one bucket at a time
+    bucket_ids = None
+    # set by datasets whose samples end with their key when the feature cache is enabled
+    sample_keys = None
 
     def __init__(self, opt):
         self.opt = opt
+        self.image_cache = get_image_cache(opt)
+
+    def _init_sample_keys(self, root, *args):
+        # key of each sample of self.paths for the feature cache, the path, mtime and size of its file
+        # and the args it is produced with, taken once from the image index when enabled, os.stat otherwise
+        files = get_image_index(root).files if self.opt.dataset_index else {}
+        self.sample_keys = []
+        for path in self.paths:
+            rel_path = os.path.relpath(path, root)
+            if rel_path in files:
+                mtime, size = files[rel_path][:2]
+            else:
+                stat = os.stat(path)
+                mtime, size = stat.st_mtime, stat.st_size
+            self.sample_keys.append(repr((os.path.abspath(path), mtime, size) + args))
+
+    def _with_key(self, i, item):
+        # samples end with their key when the feature cache is enabled
+        if self.sample_keys is None:
+            return item
+        return (*item, self.sample_keys[i])
+
+    def _get_image_paths(self, root):
+        # sorted image paths under root, from the cached index next to root when enabled
+        if self.opt.dataset_index:
+            return get_image_index(root).paths
+        return sorted(get_all_image_paths(root))
+
+    @staticmethod
+    def _get_image_sizes(root):
+        # (width, height) of each image in the order of _get_image_paths, from the image headers
+        return get_image_index(root).sizes
+
+    def _init_buckets(self, sizes):
+        # sizes are (width, height) of each sample
+        self.buckets = make_buckets(self.opt.image_size, self.opt.bucket_step, self.opt.bucket_max_ratio)
+        if len(self.buckets) <= 1:
+            log(f'Aspect buckets degenerate to {self.buckets}, bucket_step={self.opt.bucket_step} is too coarse '
+                f'for image_size={self.opt.image_size}, every image is cropped to a square')
+        self.bucket_ids = assign_buckets(sizes, self.buckets)
+
+    def _get_bucket_size(self, i):
+        # (width, height) that sample i is produced at
+        if self.bucket_ids is None:
+            return self.opt.image_size, self.opt.image_size
+        return self.buckets[self.bucket_ids[i]]
 
     @abstractmethod
     def __len__(self):
@@ -22,12 +77,22 @@ class BaseDataset(Dataset, ABC):
     def __getitem__(self, i):
         pass
 
-    @staticmethod
-    def _read_im_pil(path):
+    def _read_im_pil(self, path):
+        if self.image_cache is not None:
+            return Image.fromarray(self.image_cache.read(f'pil:{path}', path, self._decode_im_pil))
         return Image.open(path).convert('RGB')
 
+    def _read_im_cv(self, path):
+        if self.image_cache is not None:
+            return self.image_cache.read(f'cv:{path}', path, self._decode_im_cv)
+        return self._decode_im_cv(path)
+
+    @staticmethod
+    def _decode_im_pil(path):
+        return np.asarray(Image.open(path).convert('RGB'))
+
     @staticmethod
-    def _read_im_cv(path):
+    def _decode_im_cv(path):
         return cv.cvtColor(cv.imread(path), cv.COLOR_BGR2RGB)
 
     @staticmethod
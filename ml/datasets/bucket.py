@@ -0,0 +1,76 @@
+import math
+
+import torch
+from torch.utils.data import Sampler
+
+
+def make_buckets(image_size, step, max_ratio, min_area_ratio=0.9):
+    """
+    (width, height) resolutions with sides multiple of step and at most image_size ** 2 pixels,
+    as close to that pixel count as the step allows, with aspect ratios up to max_ratio either way.
+    Buckets with fewer than min_area_ratio of the pixels are dropped, so that every bucket trains on about
+    the same pixel count. A step that is coarse relative to image_size leaves few buckets, or only the square one.
+    """
+    area = image_size * image_size
+    buckets = set()
+    for w in range(step, image_size + 1, step):
+        # tallest bucket of this width, within the pixel count and the aspect ratio, and its transpose
+        h = min(area // w, int(w * max_ratio)) // step * step
+        if h >= w and w * h >= min_area_ratio * area:
+            buckets.add((w, h))
+            buckets.add((h, w))
+    return sorted(buckets)
+
+
+def assign_buckets(sizes, buckets):
+    # nearest bucket in log aspect ratio
+    bucket_log_ratios = [math.log(w / h) for w, h in buckets]
+    return [
+        min(range(len(buckets)), key=lambda b: abs(bucket_log_ratios[b] - math.log(w / h)))
+        for w, h in sizes
+    ]
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches of indices from the same bucket, so that every batch can be stacked at the bucket resolution.
+    Indices are shuffled within buckets and batches are shuffled across buckets every pass,
+    infinite keeps yielding passes, for virtual epochs.
+    """
+
+    def __init__(self, bucket_ids, batch_size, shuffle=True, drop_last=True, generator=None, infinite=False):
+        self.bucket_ids = bucket_ids
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.infinite = infinite
+
+        self.buckets = {}
+        for i, bucket_id in enumerate(bucket_ids):
+            self.buckets.setdefault(bucket_id, []).append(i)
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(indices) // self.batch_size for indices in self.buckets.values())
+        return sum(math.ceil(len(indices) / self.batch_size) for indices in self.buckets.values())
+
+    def _one_pass(self):
+        batches = []
+        for indices in self.buckets.values():
+            if self.shuffle:
+                indices = [indices[i] for i in torch.randperm(len(indices), generator=self.generator).tolist()]
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=self.generator).tolist()]
+        return batches
+
+    def __iter__(self):
+        while True:
+            yield from self._one_pass()
+            if not self.infinite:
+                return
@@ -0,0 +1,185 @@
+import atexit
+import threading
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.managers import BaseManager
+
+import numpy as np
+
+_IMAGE_CACHE = None
+
+
+class _LRUIndex:
+    """
+    Lives in the manager process and is shared by the main process and all dataloader workers,
+    maps a key to the shared memory segment holding the decoded image.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (shm_name, shape, dtype, nbytes)
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()  # manager serves each client in its own thread
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        # returns the entries that the caller should unlink,
+        # which includes the given entry if it was not inserted
+        with self.lock:
+            nbytes = entry[3]
+            if key in self.entries or nbytes > self.max_bytes:
+                return [entry]
+
+            evicted = []
+            while self.n_bytes + nbytes > self.max_bytes:
+                _, old_entry = self.entries.popitem(last=False)
+                self.n_bytes -= old_entry[3]
+                self.evictions += 1
+                evicted.append(old_entry)
+
+            self.entries[key] = entry
+            self.n_bytes += nbytes
+            return evicted
+
+    def invalidate(self, key, entry):
+        # entry was unlinked by someone else before it could be read
+        with self.lock:
+            if self.entries.get(key) == entry:
+                del self.entries[key]
+                self.n_bytes -= entry[3]
+
+    def stats(self, reset=False):
+        with self.lock:
+            stats = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'images': len(self.entries),
+                'bytes': self.n_bytes,
+            }
+            if reset:
+                self.hits, self.misses, self.evictions = 0, 0, 0
+            return stats
+
+    def clear(self):
+        with self.lock:
+            entries = list(self.entries.values())
+            self.entries.clear()
+            self.n_bytes = 0
+            return entries
+
+
+class _CacheManager(BaseManager):
+    pass
+
+
+_CacheManager.register('LRUIndex', _LRUIndex)
+
+
+def _unlink(entry):
+    try:
+        shm = shared_memory.SharedMemory(name=entry[0])
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+class SharedImageCache:
+    """
+    Decoded image cache shared across dataloader workers, bounded by max_bytes with lru eviction.
+    Images are stored in shared memory segments, only their (name, shape, dtype) go through the manager.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # workers must share the tracker of the main process, so segments unlinked by one are not leaked by another
+        resource_tracker.ensure_running()
+        self._manager = _CacheManager()
+        self._manager.start()
+        self._index = self._manager.LRUIndex(max_bytes)
+
+    def __getstate__(self):
+        # workers only need the proxy to the index, the manager stays in the main process
+        state = self.__dict__.copy()
+        state['_manager'] = None
+        return state
+
+    def get(self, key):
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+
+        shm_name, shape, dtype, _ = entry
+        try:
+            shm = shared_memory.SharedMemory(name=shm_name)
+        except FileNotFoundError:
+            # evicted by another worker in between
+            self._index.invalidate(key, entry)
+            return None
+
+        im = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+        shm.close()
+        return im
+
+    def put(self, key, im: np.ndarray):
+        shm = shared_memory.SharedMemory(create=True, size=max(1, im.nbytes))
+        np.ndarray(im.shape, dtype=im.dtype, buffer=shm.buf)[...] = im
+        entry = (shm.name, im.shape, im.dtype.str, im.nbytes)
+        shm.close()
+
+        for unused_entry in self._index.put(key, entry):
+            _unlink(unused_entry)
+
+    def read(self, key, path, read_func):
+        im = self.get(key)
+        if im is None:
+            im = read_func(path)
+            self.put(key, im)
+        return im
+
+    def stats(self, reset=False):
+        return self._index.stats(reset)
+
+    def log_text(self):
+        stats = self.stats(reset=True)
+        return f'[image_cache] ' + \
+               f'[hits={stats["hits"]}] ' + \
+               f'[misses={stats["misses"]}] ' + \
+               f'[evictions={stats["evictions"]}] ' + \
+               f'[images={stats["images"]}] ' + \
+               f'[size={stats["bytes"] / 2 ** 20:.1f}/{self.max_bytes / 2 ** 20:.1f}MB] '
+
+    def close(self):
+        if self._manager is None:
+            return
+        for entry in self._index.clear():
+            _unlink(entry)
+        self._manager.shutdown()
+        self._manager = None
+
+
+def get_image_cache(opt):
+    # one cache per main process, shared by train, test and inference datasets
+    global _IMAGE_CACHE
+
+    if opt.image_cache_size <= 0:
+        return None
+
+    if _IMAGE_CACHE is None:
+        _IMAGE_CACHE = SharedImageCache(opt.image_cache_size)
+        atexit.register(_IMAGE_CACHE.close)
+
+    return _IMAGE_CACHE
@@ -3,7 +3,6 @@ import os
 from torchvision.transforms import transforms
 
 from ml.datasets import BaseDataset
-from ml.file_utils import get_all_image_paths
 from ml.options import BaseTrainOptions
 from ml.options.base import BaseInferenceOptions
 
@@ -11,7 +10,7 @@ from ml.options.base import BaseInferenceOptions
 class DefaultDataset(BaseDataset):
     def __init__(self, opt, root):
         super().__init__(opt)
-        self.paths = sorted(get_all_image_paths(root))
+        self.paths = self._get_image_paths(root)
         self.a_to_b = opt.a_to_b
         self.transform = transforms.Compose([
             transforms.Resize(size=opt.image_size),
@@ -0,0 +1,162 @@
+import json
+import os
+from multiprocessing.pool import ThreadPool
+
+from PIL import Image
+
+from ml.file_utils import is_image_file
+from ml.logger import log
+
+INDEX_VERSION = 1
+
+_IMAGE_INDEXES = {}
+
+
+def get_index_file(root):
+    # index of a folder is stored next to it, e.g. dataset/train -> dataset/train.index.json
+    return os.path.normpath(root) + '.index.json'
+
+
+def _scan_dir(path):
+    # (subdirectories, [(image file name, mtime, file size)]) of a single directory
+    dirs, files = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            # same as os.walk, symlinked directories are not followed
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    dirs.append(entry.name)
+            elif is_image_file(entry.name):
+                stat = entry.stat()
+                files.append((entry.name, stat.st_mtime, stat.st_size))
+    return sorted(dirs), sorted(files)
+
+
+def _read_image_header(path):
+    # (width, height, channels), pil only parses the header until the pixels are accessed
+    try:
+        with Image.open(path) as im:
+            return im.size[0], im.size[1], len(im.getbands())
+    except Exception as e:
+        log(f'Failed to read image header {path}: {e}')
+        return 0, 0, 0
+
+
+class ImageIndex:
+    """
+    Image paths under root with their modification time, file size and (width, height, channels) from the header,
+    cached in index_file. Directories are listed with os.scandir in parallel, level by level,
+    a directory whose mtime did not change since the last scan is not listed again,
+    and only headers of new or modified files are read. Files overwritten in place do not change the mtime
+    of their directory, they are picked up once the directory changes or the index file is removed.
+    """
+
+    def __init__(self, root, index_file=None, workers=16):
+        assert os.path.isdir(root), root
+        self.root = root
+        self.index_file = get_index_file(root) if index_file is None else index_file
+        self.workers = workers
+
+        cache = self._load_cache()
+        self.dirs = {}  # relative dir -> [mtime, subdirs, file names]
+        self.files = {}  # relative path -> [mtime, file size, width, height, channels]
+        changed = self._refresh(cache)
+        if changed:
+            self._save_cache()
+
+        self.rel_paths = sorted(self.files)
+        self.paths = [os.path.join(root, rel_path) for rel_path in self.rel_paths]
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def sizes(self):
+        # (width, height) of each image, in the order of paths
+        return [tuple(self.files[rel_path][2:4]) for rel_path in self.rel_paths]
+
+    @property
+    def channels(self):
+        return [self.files[rel_path][4] for rel_path in self.rel_paths]
+
+    def _load_cache(self):
+        if not os.path.isfile(self.index_file):
+            return {'dirs': {}, 'files': {}}
+        try:
+            with open(self.index_file, 'r') as file:
+                cache = json.load(file)
+            if cache.get('version') == INDEX_VERSION:
+                return cache
+        except (OSError, ValueError) as e:
+            log(f'Ignoring unreadable image index {self.index_file}: {e}')
+        return {'dirs': {}, 'files': {}}
+
+    def _save_cache(self):
+        # written next to the dataset, a read only dataset folder only costs a rescan next time
+        tmp_file = self.index_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as file:
+                json.dump({'version': INDEX_VERSION, 'dirs': self.dirs, 'files': self.files}, file)
+            os.replace(tmp_file, self.index_file)
+        except OSError as e:
+            log(f'Failed to write image index {self.index_file}: {e}')
+
+    def _refresh_dir(self, rel_dir, cached_dir):
+        path = os.path.join(self.root, rel_dir)
+        mtime = os.stat(path).st_mtime
+        if cached_dir is not None and cached_dir[0] == mtime:
+            return rel_dir, cached_dir, None
+        dirs, files = _scan_dir(path)
+        return rel_dir, [mtime, dirs, [name for name, _, _ in files]], files
+
+    def _refresh(self, cache):
+        cached_dirs, cached_files = cache['dirs'], cache['files']
+        changed = False
+        to_read = []
+
+        with ThreadPool(self.workers) as pool:
+            level = ['']
+            while level:
+                next_level = []
+                for rel_dir, entry, scanned_files in pool.imap(
+                        lambda d: self._refresh_dir(d, cached_dirs.get(d)), level):
+                    self.dirs[rel_dir] = entry
+                    _, dirs, names = entry
+                    next_level.extend(os.path.join(rel_dir, d) for d in dirs)
+
+                    if scanned_files is None:
+                        # unchanged directory, reuse its files as they were
+                        for name in names:
+                            rel_path = os.path.join(rel_dir, name)
+                            self.files[rel_path] = cached_files[rel_path]
+                        continue
+
+                    changed = True
+                    for name, file_mtime, file_size in scanned_files:
+                        rel_path = os.path.join(rel_dir, name)
+                        cached_file = cached_files.get(rel_path)
+                        if cached_file is not None and cached_file[:2] == [file_mtime, file_size]:
+                            self.files[rel_path] = cached_file
+                        else:
+                            self.files[rel_path] = [file_mtime, file_size, 0, 0, 0]
+                            to_read.append(rel_path)
+                level = next_level
+
+            if to_read:
+                log(f'Reading image headers of {len(to_read)} images under {self.root} ... ', end='')
+                headers = pool.map(_read_image_header, [os.path.join(self.root, p) for p in to_read], chunksize=64)
+                for rel_path, header in zip(to_read, headers):
+                    self.files[rel_path][2:] = header
+                log('done')
+
+        # directories that were removed
+        changed = changed or len(self.dirs) != len(cached_dirs)
+        return changed
+
+
+def get_image_index(root):
+    # one index per root and process, train and test datasets of the same root share it
+    key = os.path.normpath(root)
+    if key not in _IMAGE_INDEXES:
+        _IMAGE_INDEXES[key] = ImageIndex(root)
+    return _IMAGE_INDEXES[key]
@@ -3,13 +3,15 @@ import random
 
 import cv2 as cv
 import numpy as np
+import torch
 from PIL import Image
 from torchvision import transforms
 from torchvision.transforms import InterpolationMode
+from torchvision.transforms.functional import rgb_to_grayscale
 
-from ml.datasets.augmentation import pil_rotate_crop_max, FixedRandomResizedCrop
+from ml.datasets.augmentation import pil_rotate_crop_max, FixedRandomResizedCrop, affine_theta, batch_affine_warp
 from ml.datasets.base import BaseDataset
-from ml.file_utils import get_all_image_paths
+from ml.datasets.shard import ImageShards, get_shard_root, SHARD_INDEX_FILE
 from ml.options.pix2pix import Pix2pixTrainOptions, Pix2pixInferenceOptions
 
 
@@ -20,13 +22,14 @@ class Pix2pixInferenceDataset(BaseDataset):
         self.opt = opt
         self.opt = opt
         root = os.path.join(opt.input_images_path)
-        self.paths = sorted(get_all_image_paths(root))
+        self.paths = self._get_image_paths(root)
         self.a_to_b = opt.a_to_b
 
         in_channels = self.opt.generator_config['in_channels']
 
         self.transform = transforms.Compose([
-            transforms.Resize(
+            # tiled inference runs on the full resolution frame
+            transforms.Lambda(lambda im: im) if opt.inference_tile_size > 0 else transforms.Resize(
                 (self.opt.image_size, self.opt.image_size),
                 interpolation=InterpolationMode.BICUBIC,
                 antialias=True
@@ -55,7 +58,13 @@ class Pix2pixDataset(BaseDataset):
         super().__init__(opt)
         self.opt = opt
         root = os.path.join(opt.dataset_root, opt.dataset_train_folder)
-        self.paths = sorted(get_all_image_paths(root))
+        if opt.dataset_shards:
+            # pre-decoded images packed by ml.datasets.shard.pack_image_shards
+            self.shards = ImageShards(get_shard_root(root))
+            self.paths = self.shards.paths
+        else:
+            self.shards = None
+            self.paths = self._get_image_paths(root)
         self.a_to_b = opt.a_to_b
         self.random_jitter = opt.random_jitter
         self.random_mirror = opt.random_mirror
@@ -63,19 +72,56 @@ class Pix2pixDataset(BaseDataset):
 
         self.dilate_kernel = np.ones((3, 3), np.uint8)
 
-    def __len__(self):
-        return len(self.paths)
+        if opt.aspect_buckets:
+            if self.shards is not None:
+                sizes = [(int(w), int(h)) for _, _, h, w, _ in self.shards.entries]
+            else:
+                sizes = self._get_image_sizes(root)
+            # A and B are side by side
+            self._init_buckets([(w // 2, h) for w, h in sizes])
 
-    def __getitem__(self, i):
-        A, B = self._split_image_cv(self._read_im_cv(self.paths[i]))
+        if get_feature_cache_dir(opt) is not None:
+            self._init_feature_keys(root)
 
-        transform = self._generate_transform(A.shape[1], A.shape[0])
+    def __len__(self):
+        return len(self.paths)
 
+    def _read_AB(self, i):
+        if self.shards is not None:
+            return self._split_image_cv(self.shards[i])
+        return self._split_image_cv(self._read_im_cv(self.paths[i]))
+
+    def _init_feature_keys(self, root):
+        # real_A is the same every time it is produced with the same options, as it is not augmented
+        args = (self.opt.image_size, self.opt.aspect_buckets, self.opt.bucket_step, self.opt.bucket_max_ratio,
+                self.a_to_b, self.opt.batch_augmentation, self.opt.generator_config['in_channels'])
+        if self.shards is None:
+            self._init_sample_keys(root, *args)
+            return
+        # records are keyed by the index of the shards they are packed in
+        index_file = os.path.abspath(os.path.join(self.shards.shard_root, SHARD_INDEX_FILE))
+        stat = os.stat(index_file)
+        self.sample_keys = [repr((index_file, stat.st_mtime, stat.st_size, i) + args) for i in range(len(self.paths))]
+
+    def _weight_map(self, B):
         # weight_map = B.point(lambda p: 255 if p < 200 else 0)  # threshold
         # weight_map = self._pil2cv_im(weight_map)
         weight_map = ((B < 200) * 255).astype(np.uint8)
         if self.opt.dilate:
             weight_map = cv.dilate(weight_map, kernel=self.dilate_kernel, iterations=1)
+        return weight_map
+
+    def __getitem__(self, i):
+        A, B = self._read_AB(i)
+
+        out_w, out_h = self._get_bucket_size(i)
+
+        if self.opt.batch_augmentation:
+            return self._with_key(i, self._get_batch_augmentation_item(A, B, out_w, out_h))
+
+        transform = self._generate_transform(A.shape[1], A.shape[0], out_w, out_h)
+
+        weight_map = self._weight_map(B)
         weight_map = transform(weight_map)
         weight_map = (weight_map > 0) * 1.0
 
@@ -83,9 +129,45 @@ class Pix2pixDataset(BaseDataset):
 
         A, B = (A, B) if self.a_to_b else (B, A)
 
-        return A, B, weight_map
+        return self._with_key(i, (A, B, weight_map))
+    def _get_batch_augmentation_item(self, A, B, out_w, out_h):
+        # only sample the augmentation parameters here, the images are warped
+        # for the whole batch on device by pix2pix_batch_transform
+        h, w = A.shape[:2]
+        weight_map = self._weight_map(B)
+
+        # the jitter crop is taken at full resolution before the images are downsampled to the load size,
+        # so crops are as sharp as in the pil pipeline, where the crop is resized from the original image
+        if self.random_jitter and random.random() > 0.1:
+            top, left, h, w = FixedRandomResizedCrop.get_params(h, w, scale=(0.6, 1.0),
+                                                                 ratio=(out_w / out_h, out_w / out_h))
+            A, B, weight_map = [im[top:top + h, left:left + w] for im in (A, B, weight_map)]
+
+        rotate_deg = 0
+        if self.random_rotate and random.random() > 0.2:
+            rotate_deg = random.randint(0, 180)
+
+        mirror = self.random_mirror and random.random() > 0.5
+
+        theta = affine_theta(w, h, rotate_deg=rotate_deg, mirror=mirror)
+
+        # images are batched as uint8 at a common size, affine_theta works in normalized coordinates
+        if self.bucket_ids is None:
+            load_size = self.opt.batch_augmentation_load_size or self.opt.image_size
+            load_w, load_h = load_size, load_size
+        else:
+            # batches are per bucket, the warp keeps the loaded size
+            load_w, load_h = out_w, out_h
+        A, B, weight_map = [
+            torch.from_numpy(cv.resize(im, (load_w, load_h), interpolation=cv.INTER_AREA)).permute(2, 0, 1)
+            for im in (A, B, weight_map)
+        ]
+
+        A, B = (A, B) if self.a_to_b else (B, A)
+
+        return A, B, weight_map, theta
 
-    def _generate_transform(self, w, h):
+    def _generate_transform(self, w, h, out_w, out_h):
         additional_transforms = []
 
         if self.random_jitter and random.random() > 0.1:
@@ -95,11 +177,18 @@ class Pix2pixDataset(BaseDataset):
             # rand_x = random.randint(0, new_size - old_size)
             # rand_y = random.randint(0, new_size - old_size)
 
-            additional_transforms += [
-                # transforms.Resize((new_size, new_size), interpolation=InterpolationMode.BICUBIC, antialias=True),
-                # transforms.Lambda(lambda im: self._crop(im, (rand_x, rand_y), (old_size, old_size)))
-                FixedRandomResizedCrop(w, h, self.opt.image_size, scale=(0.6, 1.0), ratio=(1, 1)),
-            ]
+            if self.bucket_ids is None:
+                additional_transforms += [
+                    # transforms.Resize((new_size, new_size), interpolation=InterpolationMode.BICUBIC, antialias=True),
+                    # transforms.Lambda(lambda im: self._crop(im, (rand_x, rand_y), (old_size, old_size)))
+                    FixedRandomResizedCrop(w, h, self.opt.image_size, scale=(0.6, 1.0), ratio=(1, 1)),
+                ]
+            else:
+                # crop at the aspect ratio of the bucket
+                additional_transforms += [
+                    FixedRandomResizedCrop(h, w, (out_h, out_w), scale=(0.6, 1.0),
+                                           ratio=(out_w / out_h, out_w / out_h)),
+                ]
 
         if self.random_rotate and random.random() > 0.2:
             rotate_deg = random.randint(0, 180)
@@ -122,7 +211,7 @@ class Pix2pixDataset(BaseDataset):
             transforms.Lambda(lambda im: self._cv2pil_im(im)),
             *additional_transforms,
             transforms.Resize(
-                (self.opt.image_size, self.opt.image_size),
+                (out_h, out_w),
                 interpolation=InterpolationMode.BICUBIC,
                 antialias=True
             ),
@@ -139,6 +228,34 @@ class Pix2pixDataset(BaseDataset):
         return im.crop((pos[0], pos[1], pos[0] + size[0], pos[1] + size[1]))
 
 
+def get_feature_cache_dir(opt: Pix2pixTrainOptions):
+    # NetF features of real_A are only cached when it is not augmented, augmented ones are never seen again
+    augmented = opt.random_jitter or opt.random_mirror or opt.random_rotate
+    return opt.feature_cache_dir if opt.content_loss and not augmented else None
+
+
+def pix2pix_batch_transform(opt: Pix2pixTrainOptions, batch_data):
+    """
+    Second half of Pix2pixDataset when opt.batch_augmentation is enabled,
+    A, B and weight map share a single warp on opt.device instead of three pil pipelines per sample.
+    """
+    A, B, weight_map, theta = [x.to(opt.device, non_blocking=True) for x in batch_data]
+
+    # with aspect buckets, the batch was loaded at its bucket size
+    size = tuple(A.shape[-2:]) if opt.aspect_buckets else opt.image_size
+    ims = batch_affine_warp(torch.cat((A, B, weight_map), dim=1), theta, size)
+    ims = ims.clamp_(0, 255).div_(255).split(A.shape[1], dim=1)
+
+    if opt.generator_config['in_channels'] == 1:
+        ims = [rgb_to_grayscale(im) for im in ims]
+
+    # same as transforms.Normalize(0.5, 0.5)
+    A, B, weight_map = [(im - 0.5) / 0.5 for im in ims]
+    weight_map = (weight_map > 0) * 1.0
+
+    return A, B, weight_map
+
+
 class Pix2pixTestDataset(Pix2pixDataset):
     def __init__(self, opt: Pix2pixTrainOptions):
         super().__init__(opt)
@@ -0,0 +1,76 @@
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+
+def seed_worker(worker_id):
+    # torch seeds each worker with base_seed + worker_id, where base_seed comes from the dataloader generator,
+    # numpy and random need to follow it, otherwise every worker produces the same augmentations
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def _to_device(data, device):
+    if isinstance(data, torch.Tensor):
+        return data.to(device, non_blocking=True)
+    if isinstance(data, (list, tuple)):
+        return type(data)(_to_device(x, device) for x in data)
+    return data
+
+
+def _record_stream(data, stream):
+    # tell the caching allocator that these tensors are used by the compute stream now
+    if isinstance(data, torch.Tensor):
+        data.record_stream(stream)
+    elif isinstance(data, (list, tuple)):
+        for x in data:
+            _record_stream(x, stream)
+
+
+class DevicePrefetcher:
+    """
+    Wraps a dataloader so that the copy of the next batch to the device runs on a separate cuda stream
+    while the current batch is being computed, works as a plain pass through on cpu.
+    """
+
+    def __init__(self, loader: DataLoader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # dataset, batch_size, ... of the wrapped loader
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        if self.stream is None:
+            yield from self.loader
+            return
+
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            _record_stream(batch, current_stream)
+
+            next_batch = self._preload(loader_iter)
+            yield batch
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+
+        with torch.cuda.stream(self.stream):
+            return _to_device(batch, self.device)
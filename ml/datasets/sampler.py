@@ -0,0 +1,25 @@
+import torch
+from torch.utils.data import Sampler
+
+
+class InfiniteSampler(Sampler):
+    """
+    Endless stream of indices, reshuffled after every pass over the dataset, so that the dataloader
+    is created and iterated only once for the whole run. __len__ is one pass, i.e. one logical epoch.
+    """
+
+    def __init__(self, data_source, shuffle=True, generator=None):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.generator = generator
+
+    def __len__(self):
+        return len(self.data_source)
+
+    def __iter__(self):
+        n = len(self.data_source)
+        while True:
+            if self.shuffle:
+                yield from torch.randperm(n, generator=self.generator).tolist()
+            else:
+                yield from range(n)
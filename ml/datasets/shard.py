@@ -0,0 +1,169 @@
+import json
+import os
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from ml.algorithms.xdog import extract_edges_cv
+from ml.file_utils import get_all_image_paths
+
+SHARD_INDEX_FILE = 'index.json'
+SHARD_FILE_FORMAT = 'shard-{:05d}.bin'
+DEFAULT_SHARD_SIZE = 1 << 30  # 1GB per shard file
+SKETCH_SIGMAS = [0.3, 0.4, 0.5]  # sigmas the AlacGAN datasets draw from
+
+
+def get_shard_root(root):
+    # shards of a folder are stored next to it, e.g. dataset/train -> dataset/train.shards
+    return os.path.normpath(root) + '.shards'
+
+
+def get_sketch_shard_root(root):
+    # e.g. dataset/train -> dataset/train.sketches
+    return os.path.normpath(root) + '.sketches'
+
+
+def _read_im_rgb(path):
+    # same decoding as BaseDataset._decode_im_cv, done once at packing time
+    return np.ascontiguousarray(cv.cvtColor(cv.imread(path), cv.COLOR_BGR2RGB))
+
+
+def _read_im_sketches(path, sigmas):
+    # color half of an A|B image as the AlacGAN datasets split it, followed by its sketch of each sigma as channels
+    im = _read_im_rgb(path)
+    color = im[:, int(im.shape[1] / 2):]
+    # through pil as the datasets do, so that the sketches are the same 8 bit images
+    sketches = [np.asarray(Image.fromarray(extract_edges_cv(color, sigma=sigma)).convert('L')) for sigma in sigmas]
+    return np.ascontiguousarray(np.dstack([color] + sketches))
+
+
+def pack_image_shards(root, out_root=None, shard_size=DEFAULT_SHARD_SIZE, workers=4, read=_read_im_rgb, meta=None):
+    """
+    Decode every image under root once and pack the raw uint8 pixels into shard files
+    of at most shard_size bytes, together with an index of (shard, offset, height, width, channels).
+    read maps a path to the (h, w, c) uint8 record to store, meta is saved with the index.
+    """
+    paths = sorted(get_all_image_paths(root))
+    out_root = get_shard_root(root) if out_root is None else out_root
+    Path(out_root).mkdir(parents=True, exist_ok=True)
+
+    entries = []
+    shard_id, shard_offset = 0, 0
+    shard_file = open(os.path.join(out_root, SHARD_FILE_FORMAT.format(shard_id)), 'wb')
+    try:
+        with Pool(workers) as pool:
+            # decode in parallel, but write in order so that index matches sorted paths
+            for im in tqdm(pool.imap(read, paths, chunksize=16), total=len(paths), desc='pack'):
+                if shard_offset > 0 and shard_offset + im.nbytes > shard_size:
+                    shard_file.close()
+                    shard_id, shard_offset = shard_id + 1, 0
+                    shard_file = open(os.path.join(out_root, SHARD_FILE_FORMAT.format(shard_id)), 'wb')
+
+                shard_file.write(im.tobytes())
+                h, w, c = im.shape
+                entries.append([shard_id, shard_offset, h, w, c])
+                shard_offset += im.nbytes
+    finally:
+        shard_file.close()
+
+    with open(os.path.join(out_root, SHARD_INDEX_FILE), 'w') as file:
+        json.dump({
+            'root': os.path.abspath(root),
+            'paths': [os.path.relpath(path, root) for path in paths],
+            'n_shards': shard_id + 1,
+            'entries': entries,
+            'meta': {} if meta is None else meta,
+        }, file)
+
+    return out_root
+
+
+def pack_sketch_shards(root, out_root=None, sigmas=None, shard_size=DEFAULT_SHARD_SIZE, workers=4):
+    """
+    Pack the color image of every A|B image under root with its xdog sketch of each sigma into one record,
+    (h, w, 3 + len(sigmas)) uint8, so that the AlacGAN datasets read both with one slice of the shards.
+    The modification time and size of each image are saved, so that images changed since are not read from it.
+    """
+    sigmas = SKETCH_SIGMAS if sigmas is None else list(sigmas)
+    out_root = get_sketch_shard_root(root) if out_root is None else out_root
+    # stat before reading, an image modified while packing is then seen as changed
+    stats = {}
+    for path in get_all_image_paths(root):
+        stat = os.stat(path)
+        stats[os.path.relpath(path, root)] = [stat.st_mtime, stat.st_size]
+    return pack_image_shards(root, out_root, shard_size, workers, read=partial(_read_im_sketches, sigmas=sigmas),
+                             meta={'sigmas': sigmas, 'stats': stats})
+
+
+class ImageShards:
+    """
+    Read only view over shards written by pack_image_shards,
+    images are returned as uint8 numpy views into memory mapped shard files, no decoding involved.
+    """
+
+    def __init__(self, shard_root):
+        self.shard_root = shard_root
+        assert os.path.isfile(os.path.join(shard_root, SHARD_INDEX_FILE)), \
+            f'shard index not found, run pack_image_shards first: {shard_root}'
+
+        with open(os.path.join(shard_root, SHARD_INDEX_FILE), 'r') as file:
+            index = json.load(file)
+
+        self.paths = index['paths']
+        self.entries = np.asarray(index['entries'], dtype=np.int64).reshape(-1, 5)
+        self.n_shards = index['n_shards']
+        self.meta = index.get('meta', {})
+
+        # opened lazily, so that each dataloader worker maps its own copy instead of pickling the data
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, i):
+        shard_id, offset, h, w, c = self.entries[i]
+        shard = self._get_shard(int(shard_id))
+        return shard[offset:offset + h * w * c].reshape(h, w, c)
+
+    def _get_shard(self, shard_id):
+        if shard_id not in self._shards:
+            shard_file = os.path.join(self.shard_root, SHARD_FILE_FORMAT.format(shard_id))
+            self._shards[shard_id] = np.memmap(shard_file, dtype=np.uint8, mode='r')
+        return self._shards[shard_id]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+
+class SketchShards(ImageShards):
+    """
+    Color images and their sketches packed by pack_sketch_shards, looked up by the path of the image.
+    Images that were not packed, or changed since, and sigmas that were not packed are left to the caller.
+    """
+
+    def __init__(self, shard_root):
+        super().__init__(shard_root)
+        self.sigmas = self.meta['sigmas']
+        self.stats = self.meta['stats']
+        self._ids = {path: i for i, path in enumerate(self.paths)}
+
+    def find(self, rel_path, stat=None):
+        # record id of rel_path, -1 if it is not packed or its [mtime, size] is not the packed one
+        i = self._ids.get(rel_path, -1)
+        if i >= 0 and stat is not None and list(stat) != self.stats.get(rel_path):
+            return -1
+        return i
+
+    def read(self, i, sigma):
+        # (sketch, color) views of record i, None if the sigma is not packed
+        if i < 0 or sigma not in self.sigmas:
+            return None
+        record = self[i]
+        return record[..., 3 + self.sigmas.index(sigma)], record[..., :3]
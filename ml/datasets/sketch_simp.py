@@ -6,19 +6,18 @@ from torchvision.transforms import transforms
 
 from ml.datasets import BaseDataset
 from ml.datasets.augmentation import cv_rotate_crop_max, FixedRandomResizedCrop, cv_flip_horizontal
-from ml.file_utils import get_all_image_paths
 from ml.options.sketch_simp import SketchSimpInferenceOptions, SketchSimpTrainOptions
 
 
 class SketchSimpDataset(BaseDataset):
-    def __init__(self, opt, root):
+    def __init__(self, opt, root, resize=True):
         super().__init__(opt)
         self.opt = opt
-        self.paths = sorted(get_all_image_paths(root))
+        self.paths = self._get_image_paths(root)
         self.a_to_b = opt.a_to_b
         self.transform = transforms.Compose([
             transforms.ToTensor(),
-            transforms.Resize(size=(opt.image_size, opt.image_size)),
+            transforms.Resize(size=(opt.image_size, opt.image_size)) if resize else transforms.Lambda(lambda im: im),
             transforms.Normalize(0.5, 0.5),
         ])
 
@@ -39,7 +38,8 @@ class SketchSimpDataset(BaseDataset):
 class SketchSimpInferenceDataset(SketchSimpDataset):
 
     def __init__(self, opt: SketchSimpInferenceOptions):
-        super().__init__(opt, opt.input_images_path)
+        # tiled inference runs on the full resolution frame
+        super().__init__(opt, opt.input_images_path, resize=opt.inference_tile_size <= 0)
 
 
 class SketchSimpTestDataset(SketchSimpDataset):
@@ -52,10 +52,15 @@ class SketchSimpTrainDataset(BaseDataset):
     def __init__(self, opt: SketchSimpTrainOptions):
         super().__init__(opt)
         root = os.path.join(opt.dataset_root, opt.dataset_train_folder)
-        self.paths = sorted(get_all_image_paths(root))
+        self.paths = self._get_image_paths(root)
         self.a_to_b = opt.a_to_b
         self.opt = opt
 
+        if opt.aspect_buckets:
+            # A and B are side by side
+            sizes = self._get_image_sizes(root)
+            self._init_buckets([(w // 2, h) for w, h in sizes])
+
     def __len__(self):
         return len(self.paths)
 
@@ -74,9 +79,16 @@ class SketchSimpTrainDataset(BaseDataset):
         ])
 
         A, B = transform1(A), transform1(B)
+        if self.bucket_ids is None:
+            crop = FixedRandomResizedCrop(A.shape[1], A.shape[0], self.opt.image_size, scale=(0.3, 1.0), ratio=(1, 1))
+        else:
+            # crop at the aspect ratio of the bucket
+            out_w, out_h = self._get_bucket_size(i)
+            crop = FixedRandomResizedCrop(A.shape[0], A.shape[1], (out_h, out_w), scale=(0.3, 1.0),
+                                          ratio=(out_w / out_h, out_w / out_h))
         transform2 = transforms.Compose([
             transforms.ToTensor(),
-            FixedRandomResizedCrop(A.shape[1], A.shape[0], self.opt.image_size, scale=(0.3, 1.0), ratio=(1, 1)),
+            crop,
             transforms.Normalize(0.5, 0.5),
         ])
 
@@ -5,7 +5,6 @@ import numpy as np
 from torchvision.transforms import transforms
 
 from ml.datasets import BaseDataset
-from ml.file_utils import get_all_image_paths
 from ml.options.waifu2x2 import Waifu2x2TrainOptions
 
 
@@ -13,8 +12,8 @@ class Waifu2x2Dataset(BaseDataset):
     def __init__(self, opt: Waifu2x2TrainOptions, hr_root, lr_root):
         super().__init__(opt)
 
-        self.hr_paths = sorted(get_all_image_paths(hr_root))
-        self.lr_paths = sorted(get_all_image_paths(lr_root))
+        self.hr_paths = self._get_image_paths(hr_root)
+        self.lr_paths = self._get_image_paths(lr_root)
         self.a_to_b = opt.a_to_b
         self.opt = opt
 
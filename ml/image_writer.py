@@ -0,0 +1,58 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2 as cv
+import numpy as np
+import torch
+
+
+def to_uint8_images(batch: torch.Tensor, un_normalize=True) -> np.ndarray:
+    """
+    Batch of (N, C, H, W) images in [-1, 1] (or [0, 1] when not un_normalize) to (N, H, W, C) uint8 on cpu,
+    converted on the device so that only uint8 is copied back. A list of (C, H, W) images gives a list.
+    """
+    if isinstance(batch, (list, tuple)):
+        return [to_uint8_images(im[None], un_normalize)[0] for im in batch]
+
+    batch = batch.detach().float()
+    if un_normalize:
+        batch = batch * 0.5 + 0.5
+    batch = (batch.clamp(0, 1) * 255).round().to(torch.uint8)
+    return batch.permute(0, 2, 3, 1).cpu().numpy()
+
+
+def _write_png(path, im):
+    if im.ndim == 3 and im.shape[2] == 3:
+        im = cv.cvtColor(im, cv.COLOR_RGB2BGR)
+    if not cv.imwrite(path, im):
+        raise IOError(f'failed to write image: {path}')
+
+
+class ImageWriter:
+    """
+    Encodes and writes uint8 images in a thread pool, png encoding in cv releases the gil.
+    At most max_pending images wait in memory, write blocks when the pool falls behind.
+    """
+
+    def __init__(self, workers=4, max_pending=64):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.error = None
+
+    def write(self, path, im: np.ndarray):
+        self.pending.acquire()
+        self.pool.submit(_write_png, path, im).add_done_callback(self._on_done)
+
+    def write_strip(self, path, ims):
+        # side by side comparison, all images must have the same height and channels
+        self.write(path, np.concatenate(ims, axis=1))
+
+    def _on_done(self, future):
+        self.pending.release()
+        if future.exception() is not None and self.error is None:
+            self.error = future.exception()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        if self.error is not None:
+            raise self.error
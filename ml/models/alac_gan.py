@@ -3,7 +3,6 @@ from pathlib import Path
 from typing import Tuple
 
 import numpy as np
-import scipy.stats as stats
 import torch
 from torch import optim, nn, Tensor
 from torch.autograd import grad
@@ -13,39 +12,58 @@ from tqdm import tqdm
 from ml.models.base import BaseTrainModel, BaseInferenceModel
 from ml.models.criterion.GANBCELoss import GANBCELoss
 from .alac_gan_partials import NetG, NetD, NetF, NetI
+from .feature_cache import FrozenFeatures, log_feature_caches
+from ..datasets.alac_gan import alac_gan_batch_xdog
 from ..logger import log
 from ..options.alac_gan import AlacGANTrainOptions, AlacGANInferenceOptions
 from ..plot_utils import plt_input_target, plt_horizontals, save_raw_im, plt_model_sample
 
 
-def _mask_gen(opt, X, batch_size):
-    maskS = opt.image_size // 4
+class HintMaskGenerator:
+    """
+    Hint masks of AlacGAN, (N, 1, image_size / 4, image_size / 4) on opt.device, 1 where the color is given.
+    Each sample is hinted where a uniform draw is at least its threshold, the thresholds of a batch are one draw of
+    a normal truncated to [low, high] by inverting its cdf, so a whole batch is made on device without host syncs.
+    """
 
-    mask1 = torch.cat(
-        [torch.rand(1, 1, maskS, maskS).ge(X.rvs(1)[0]).float() for _ in range(batch_size // 2)], 0)
-    mask2 = torch.cat([torch.zeros(1, 1, maskS, maskS).float() for _ in range(batch_size // 2)], 0)
-    mask = torch.cat([mask1, mask2], 0)
-
-    return mask.to(opt.device)
-
-
-def _mask_gen_all(opt, X, batch_size):
-    maskS = opt.image_size // 4
-
-    mask = torch.cat([torch.rand(1, 1, maskS, maskS).ge(X.rvs(1)[0]).float() for _ in range(batch_size)], 0)
-
-    return mask.to(opt.device)
-
-
-def _mask_gen_none(opt, batch_size):
-    maskS = opt.image_size // 4
-
-    mask = torch.cat([torch.zeros(1, 1, maskS, maskS).float() for _ in range(batch_size)], 0)
-
-    return mask.to(opt.device)
-
-
-def calc_gradient_penalty(opt, netD, real_data, fake_data, sketch_feat):
+    def __init__(self, opt, mu=1., sigma=0.01, low=0., high=1.):  # mu, sigma = 1, 0.005
+        self.opt = opt
+        self.size = opt.image_size // 4
+        self.mu, self.sigma = mu, sigma
+        self.low, self.high = low, high
+        normal = torch.distributions.Normal(0., 1.)
+        self.cdf_low = normal.cdf(torch.tensor((low - mu) / sigma)).item()
+        self.cdf_high = normal.cdf(torch.tensor((high - mu) / sigma)).item()
+        self._zeros = {}
+
+    def thresholds(self, n):
+        u = torch.empty(n, device=self.opt.device).uniform_(self.cdf_low, self.cdf_high)
+        return (self.mu + self.sigma * torch.special.ndtri(u)).clamp_(self.low, self.high)
+
+    def all(self, batch_size):
+        # every sample hinted
+        return self._masks(self.thresholds(batch_size))
+
+    def half(self, batch_size):
+        # first half hinted, the rest without hints
+        n_hinted = batch_size // 2
+        thresholds = torch.cat([self.thresholds(n_hinted),
+                                torch.full((batch_size - n_hinted,), float('inf'), device=self.opt.device)])
+        return self._masks(thresholds)
+
+    def none(self, batch_size):
+        # cached, must not be modified in place
+        if batch_size not in self._zeros:
+            self._zeros[batch_size] = torch.zeros(batch_size, 1, self.size, self.size, device=self.opt.device)
+        return self._zeros[batch_size]
+
+    def _masks(self, thresholds):
+        n = len(thresholds)
+        noise = torch.rand(n, 1, self.size, self.size, device=self.opt.device)
+        return noise.ge_(thresholds.view(n, 1, 1, 1)).float()
+
+
+def calc_gradient_penalty(opt, netD, real_data, fake_data, sketch_feat, grad_scaler=None):
     alpha = torch.rand(opt.batch_size, 1, 1, 1, device=opt.device)
 
     interpolates = alpha * real_data + ((1 - alpha) * fake_data)
@@ -54,10 +72,18 @@ def calc_gradient_penalty(opt, netD, real_data, fake_data, sketch_feat):
 
     disc_interpolates = netD(interpolates, sketch_feat)
 
+    if grad_scaler is not None:
+        # with float16 loss scaling, differentiate the scaled output so that the input gradients do not underflow,
+        # and unscale them before the penalty, the penalty itself is scaled again by the caller
+        disc_interpolates = grad_scaler.scale(disc_interpolates)
+
     gradients = grad(outputs=disc_interpolates, inputs=interpolates,
                      grad_outputs=torch.ones(disc_interpolates.size(), device=opt.device), create_graph=True,
                      retain_graph=True, only_inputs=True)[0]
 
+    if grad_scaler is not None:
+        gradients = gradients / grad_scaler.get_scale()
+
     return ((gradients.norm(2, dim=1) - 1) ** 2).mean() * 10
 
 
@@ -68,11 +94,12 @@ class AlacGANInferenceModel(BaseInferenceModel):
         self.net_I = None
         self.net_D = None
         self.net_G = None
+        self.compiled_G = None
         self.net_F = None
+        self.features_I = None
         self.opt = opt
 
-        mu, sigma = 1, 0.01  # 1, 0.005
-        self.X = stats.truncnorm((0 - mu) / sigma, (1 - mu) / sigma, loc=mu, scale=sigma)
+        self.mask_gen = HintMaskGenerator(opt)
 
         self.setup()
 
@@ -83,13 +110,22 @@ class AlacGANInferenceModel(BaseInferenceModel):
         self.net_G = NetG(loaded_opt).to(self.opt.device).eval()
         self.net_D = NetD(loaded_opt).to(self.opt.device).eval()
 
-        self.net_F = NetF(loaded_opt).to(self.opt.device).eval()
+        # net_F is only used for the content loss in training
         self.net_I = NetI(loaded_opt).to(self.opt.device).eval()
+        # inference sketches are not augmented
+        self.features_I = FrozenFeatures(self.net_I, 'net_I', self.opt.device, cache_dir=self.opt.feature_cache_dir)
 
         self.net_G.load_state_dict(checkpoint['net_G_state_dict'])
         self.net_D.load_state_dict(checkpoint['net_D_state_dict'])
+        self.compiled_G = self._compile_network(self.net_G, 'net_G')
 
     def inference_batch(self, i, batch_data) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor]:
+        # samples end with their key when the sketch features are cached
+        keys = None
+        if self.opt.feature_cache_dir is not None:
+            *batch_data, keys = batch_data
+        if self.opt.batch_xdog:
+            batch_data = alac_gan_batch_xdog(self.opt, batch_data)
         real_cim, real_vim, real_sim = batch_data
 
         real_cim = real_cim.to(self.opt.device)
@@ -99,16 +135,15 @@ class AlacGANInferenceModel(BaseInferenceModel):
         batch_size = real_cim.shape[0]
 
         if self.opt.hint_mask:
-            mask = _mask_gen_all(self.opt, self.X, batch_size)
+            mask = self.mask_gen.all(batch_size)
         else:
-            mask = _mask_gen_none(self.opt, batch_size)
+            mask = self.mask_gen.none(batch_size)
 
         hint = torch.cat((real_vim * mask, mask), 1) * self.opt.hint_multiplier
-        with torch.no_grad():
-            # get sketch feature
-            feat_sim = self.net_I(real_sim).detach()
+        # get sketch feature
+        feat_sim = self.features_I(real_sim, keys)
 
-        fake_cim = self.net_G(real_sim, hint, feat_sim)
+        fake_cim = self.compiled_G(real_sim, hint, feat_sim)
 
         return real_sim, real_cim, fake_cim, real_vim * mask, mask
 
@@ -141,8 +176,12 @@ class AlacGANInferenceModel(BaseInferenceModel):
                 save_raw_im(tar_im, os.path.join(self.opt.output_images_path, f'inference-{im_index}-tar.png'))
                 save_raw_im(out_im, os.path.join(self.opt.output_images_path, f'inference-{im_index}-out.png'))
 
+        log_feature_caches(self.features_I)
+
 
 class AlacGANTrainModel(BaseTrainModel):
+    supports_amp = True
+    supports_grad_accumulation = True
 
     def __init__(self, opt: AlacGANTrainOptions, train_loader, test_loader):
         super().__init__(opt, train_loader, test_loader)
@@ -153,6 +192,8 @@ class AlacGANTrainModel(BaseTrainModel):
         self.net_D = None
         self.net_F = None
         self.net_I = None
+        self.features_F = None
+        self.test_features_I = None
 
         # optimizer
         self.opt_G = None
@@ -176,8 +217,7 @@ class AlacGANTrainModel(BaseTrainModel):
         self.epoch_eval_loss = None
 
         # for generating mask
-        mu, sigma = 1, 0.01  # 1, 0.005
-        self.X = stats.truncnorm((0 - mu) / sigma, (1 - mu) / sigma, loc=mu, scale=sigma)
+        self.mask_gen = HintMaskGenerator(opt)
 
         self.setup()
 
@@ -187,6 +227,7 @@ class AlacGANTrainModel(BaseTrainModel):
             'net_D_state_dict': self.net_D.state_dict(),
             'opt_G_state_dict': self.opt_G.state_dict(),
             'opt_D_state_dict': self.opt_D.state_dict(),
+            'grad_scaler_state_dicts': self._get_amp_state_dict(),
             'opt': self.opt.saved_dict,
         }
 
@@ -201,6 +242,7 @@ class AlacGANTrainModel(BaseTrainModel):
 
         self.opt_G.load_state_dict(checkpoint['opt_G_state_dict'])
         self.opt_D.load_state_dict(checkpoint['opt_D_state_dict'])
+        self._load_amp_state_dict(checkpoint.get('grad_scaler_state_dicts', {}))
 
     def setup_from_opt(self, opt):
         # network
@@ -218,6 +260,12 @@ class AlacGANTrainModel(BaseTrainModel):
         self._set_requires_grad(self.net_F, False)
         self._set_requires_grad(self.net_I, False)
 
+        # content features of the real image overlap the discriminator step,
+        # test sketches are not augmented, so their features can be cached
+        self.features_F = FrozenFeatures(self.net_F, 'net_F', self.opt.device)
+        self.test_features_I = FrozenFeatures(self.net_I, 'net_I', self.opt.device,
+                                              cache_dir=self.opt.feature_cache_dir)
+
         # criterion
         self.crt_mse = nn.MSELoss()
         self.crt_l1 = nn.L1Loss()
@@ -277,6 +325,12 @@ class AlacGANTrainModel(BaseTrainModel):
         return np.mean(eval_losses)
 
     def evaluate_batch(self, i, batch_data) -> Tuple[float, Tensor, Tensor, Tensor, Tensor]:
+        # samples end with their key when the sketch features are cached
+        keys = None
+        if self.opt.feature_cache_dir is not None:
+            *batch_data, keys = batch_data
+        if self.opt.batch_xdog:
+            batch_data = alac_gan_batch_xdog(self.opt, batch_data)
         real_cim, real_vim, real_sim = batch_data
 
         real_cim = real_cim.to(self.opt.device)
@@ -287,15 +341,14 @@ class AlacGANTrainModel(BaseTrainModel):
 
         if self.opt.use_hint:
             if self.opt.mask_all:
-                mask = _mask_gen_all(self.opt, self.X, batch_size)
+                mask = self.mask_gen.all(batch_size)
             else:
-                mask = _mask_gen(self.opt, self.X, batch_size)
+                mask = self.mask_gen.half(batch_size)
             hint = torch.cat((real_vim * mask, mask), 1)
         else:
             hint = None
-        with torch.no_grad():
-            # get sketch feature
-            feat_sim = self.net_I(real_sim).detach()
+        # get sketch feature
+        feat_sim = self.test_features_I(real_sim, keys)
 
         fake_cim = self.net_G(real_sim, hint, feat_sim)
         loss = self.crt_l1(fake_cim, real_cim)
@@ -320,7 +373,10 @@ class AlacGANTrainModel(BaseTrainModel):
         )
         # get some data and see if it looks good
         i = 1
-        for real_cim, _, real_sim in self.train_loader:
+        for batch_data in self.train_loader:
+            if self.opt.batch_xdog:
+                batch_data = alac_gan_batch_xdog(self.opt, batch_data, jitter=True)
+            real_cim, _, real_sim = batch_data
             for inp, tar in zip(real_sim, real_cim):
                 plt_horizontals(
                     [inp, tar],
@@ -356,11 +412,15 @@ class AlacGANTrainModel(BaseTrainModel):
         self.net_G.train()
         self.net_D.train()
 
+        if self.opt.batch_xdog:
+            batch_data = alac_gan_batch_xdog(self.opt, batch_data, jitter=True)
         real_cim, real_vim, real_sim = batch_data
 
         real_cim = real_cim.to(self.opt.device)
         real_vim = real_vim.to(self.opt.device)
         real_sim = real_sim.to(self.opt.device)
+        # only needed for the generator step, computed on a side stream meanwhile
+        real_feat = self.features_F.submit(real_cim)
 
         batch_size = real_cim.shape[0]
 
@@ -369,18 +429,18 @@ class AlacGANTrainModel(BaseTrainModel):
         ###########################
         self._set_requires_grad(self.net_D, True)
         self._set_requires_grad(self.net_G, False)
-        self.net_D.zero_grad()
+        self._zero_grad('opt_D')
 
         if self.opt.use_hint:
             if self.opt.mask_all:
-                mask = _mask_gen_all(self.opt, self.X, batch_size)
+                mask = self.mask_gen.all(batch_size)
             else:
-                mask = _mask_gen(self.opt, self.X, batch_size)
+                mask = self.mask_gen.half(batch_size)
             hint = torch.cat((real_vim * mask, mask), 1)
         else:
             hint = None
 
-        with torch.no_grad():
+        with torch.no_grad(), self._amp_autocast():
             # train with fake
             # get sketch feature
             feat_sim = self.net_I(real_sim).detach()
@@ -388,23 +448,27 @@ class AlacGANTrainModel(BaseTrainModel):
             fake_cim = self.net_G(real_sim, hint, feat_sim).detach()
 
         # ask discriminator to calculate loss
-        errD_fake = self.net_D(fake_cim, feat_sim)
-        errD_fake = errD_fake.mean(0).view(1)
+        with self._amp_autocast():
+            errD_fake = self.net_D(fake_cim, feat_sim)
+            errD_fake = errD_fake.mean(0).view(1)
 
-        errD_fake.backward(retain_graph=True)  # backward on score on real
+        self._backward(errD_fake, 'opt_D', retain_graph=True)  # backward on score on real
 
-        errD_real = self.net_D(real_cim, feat_sim)
-        errD_real = errD_real.mean(0).view(1)
-        errD = errD_real - errD_fake
+        with self._amp_autocast():
+            errD_real = self.net_D(real_cim, feat_sim)
+            errD_real = errD_real.mean(0).view(1)
+            errD = errD_real - errD_fake
 
-        errD_realer = -1 * errD_real + errD_real.pow(2) * 0.001
+            errD_realer = -1 * errD_real + errD_real.pow(2) * 0.001
 
-        errD_realer.backward(retain_graph=True)  # backward on score on real
+        self._backward(errD_realer, 'opt_D', retain_graph=True)  # backward on score on real
 
-        grad_pen = calc_gradient_penalty(self.opt, self.net_D, real_cim, fake_cim, feat_sim)
-        grad_pen.backward()
+        with self._amp_autocast():
+            grad_pen = calc_gradient_penalty(self.opt, self.net_D, real_cim, fake_cim, feat_sim,
+                                             grad_scaler=self._get_grad_scaler('opt_D'))
+        self._backward(grad_pen, 'opt_D')
 
-        self.opt_D.step()
+        self._step('opt_D')
 
         ############################
         # (2) Update G network
@@ -412,24 +476,24 @@ class AlacGANTrainModel(BaseTrainModel):
 
         self._set_requires_grad(self.net_D, False)
         self._set_requires_grad(self.net_G, True)
-        self.net_G.zero_grad()
+        self._zero_grad('opt_G')
 
-        # generate a fake image
-        fake = self.net_G(real_sim, hint, feat_sim)
+        with self._amp_autocast():
+            # generate a fake image
+            fake = self.net_G(real_sim, hint, feat_sim)
 
-        # discriminator loss
-        errd = self.net_D(fake, feat_sim)
-        errd = errd.mean() * 0.0001 * -1
-        feat1 = self.net_F(fake)
-        with torch.no_grad():
-            feat2 = self.net_F(real_cim)
+            # discriminator loss
+            errd = self.net_D(fake, feat_sim)
+            errd = errd.mean() * 0.0001 * -1
+            feat1 = self.net_F(fake)
+            feat2 = real_feat.wait()
 
-        l1_loss = self.crt_l1(fake, real_cim)
-        content_loss = self.crt_mse(feat1, feat2)
-        errG = (errd + content_loss + l1_loss) / 3
-        errG.backward()
+            l1_loss = self.crt_l1(fake, real_cim)
+            content_loss = self.crt_mse(feat1, feat2)
+            errG = (errd + content_loss + l1_loss) / 3
+        self._backward(errG, 'opt_G')
 
-        self.opt_G.step()
+        self._step('opt_G')
 
         return errG.item(), errd.item(), content_loss.item(), l1_loss.item()
 
@@ -447,6 +511,8 @@ class AlacGANTrainModel(BaseTrainModel):
         self.sch_G.step()
         self.sch_D.step()
 
+        log_feature_caches(self.features_F, self.test_features_I)
+
     def post_train(self):
         super().post_train()
 
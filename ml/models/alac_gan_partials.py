@@ -1,3 +1,7 @@
+import hashlib
+import inspect
+import os
+import zipfile
 from bisect import bisect_right
 
 import torch
@@ -185,16 +189,40 @@ class NetD(nn.Module):
         return out
 
 
+VGG16_FEATURE_CFG = [64, 64, 'M', 128, 128]  # vgg16.features[:9], up to relu2_2
+
+
+def _load_tensors(path, names):
+    """
+    Only the named tensors of a checkpoint. Zip checkpoints are memory mapped, so the other tensors are never read,
+    legacy ones are read once and the named tensors are saved next to them, e.g. vgg16.pth -> vgg16.pth.subset-<hash>.pt
+    """
+    subset_file = f'{path}.subset-{hashlib.sha1(",".join(names).encode()).hexdigest()[:8]}.pt'
+    if os.path.isfile(subset_file):
+        path = subset_file
+    mmap = zipfile.is_zipfile(path) and 'mmap' in inspect.signature(torch.load).parameters
+    state_dict = torch.load(path, map_location='cpu', **({'mmap': True} if mmap else {}))
+    tensors = {name: state_dict[name].clone() for name in names}
+    del state_dict
+
+    if not zipfile.is_zipfile(path):
+        try:
+            torch.save(tensors, subset_file + '.tmp')
+            os.replace(subset_file + '.tmp', subset_file)
+        except OSError as e:
+            log(f'Failed to save {subset_file}: {e}')
+    return tensors
+
+
 class NetF(nn.Module):
     def __init__(self, opt):
         super(NetF, self).__init__()
 
-        vgg16 = M.vgg16()
-        vgg16.load_state_dict(torch.load(opt.VGG16_PATH))
-        vgg16.features = nn.Sequential(
-            *list(vgg16.features.children())[:9]
-        )
-        self.model = vgg16.features
+        # only the layers that are used, a full vgg16 is 138M parameters
+        self.model = M.vgg.make_layers(VGG16_FEATURE_CFG)
+        names = list(self.model.state_dict())
+        tensors = _load_tensors(opt.VGG16_PATH, [f'features.{name}' for name in names])
+        self.model.load_state_dict({name: tensors[f'features.{name}'] for name in names})
         self.register_buffer('mean', torch.FloatTensor([0.485 - 0.5, 0.456 - 0.5, 0.406 - 0.5]).view(1, 3, 1, 1))
         self.register_buffer('std', torch.FloatTensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
 
@@ -1,3 +1,4 @@
+import itertools
 import os
 import shutil
 import time
@@ -11,18 +12,21 @@ from torch import Tensor
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
+from ml.checkpoint_writer import CheckpointWriter
 from ml.logger import log
 from ml.misc_utils import format_time, get_center_text
+from ml.models.export import CompiledNetwork
+from ml.models.tiling import tiled_forward
 from ml.options.base import BaseOptions, BaseTrainOptions, BaseInferenceOptions
 from ml.plot_utils import plt_model_sample
-from ml.save_load import init_drive_and_folder, save_file, load_file
+from ml.save_load import get_storage, save_file, load_file
 
 
 class BaseModel(ABC):
 
     def __init__(self, opt: BaseOptions):
         self.opt = opt
-        init_drive_and_folder(self.opt)  # for saving and loading
+        self.checkpoint_file = None  # last loaded
 
     def load_checkpoint(self, tag=None, file_name=None):
         if file_name is None:
@@ -32,6 +36,7 @@ class BaseModel(ABC):
         log(f'Loading checkpoint ... ', end='')
         load_file(self.opt, file_name)  # ensure exists locally, will raise error if not exists
         log(f'done: {file_name}')
+        self.checkpoint_file = file_name
         return torch.load(file_name)
 
     # abstract subclass should implement this method
@@ -59,6 +64,17 @@ class BaseInferenceModel(BaseModel, ABC):
     def inference_batch(self, i, batch_data) -> Tuple[Tensor, Tensor, Tensor]:
         pass
 
+    def _compile_network(self, net, name, *args):
+        # callable running net on tensor inputs, followed by args, compiled as opt.inference_compile
+        return CompiledNetwork(net, name, self.opt.inference_compile, self.checkpoint_file, args)
+
+    def _inference_forward(self, forward, inp):
+        # inp is a batch tensor, or with tiling a list of full resolution (C, H, W) frames of any size
+        if self.opt.inference_tile_size > 0:
+            return tiled_forward(forward, inp, self.opt.inference_tile_size, self.opt.inference_tile_overlap,
+                                 self.opt.inference_tile_batch_size, self.opt.device)
+        return forward(inp.to(self.opt.device))
+
     def inference(self):
         # create output directory, delete existing one
         save_path = Path(self.opt.output_images_path)
@@ -67,21 +83,48 @@ class BaseInferenceModel(BaseModel, ABC):
         iterator = enumerate(self.inference_loader)
         if self.opt.show_progress:
             iterator = tqdm(iterator, total=len(self.inference_loader), desc='Inference')
-        for i, batch_data in iterator:
+        with torch.inference_mode():
+            for i, batch_data in iterator:
 
-            inp_batch, tar_batch, out_batch = self.inference_batch(i, batch_data)
+                inp_batch, tar_batch, out_batch = self.inference_batch(i, batch_data)
 
-            for inp_im, tar_im, out_im in zip(inp_batch, tar_batch, out_batch):
-                save_filename = os.path.join(self.opt.output_images_path, f'inference-{i}.png')
-                plt_model_sample(inp_im, tar_im, out_im, save_file=save_filename)
+                for inp_im, tar_im, out_im in zip(inp_batch, tar_batch, out_batch):
+                    save_filename = os.path.join(self.opt.output_images_path, f'inference-{i}.png')
+                    plt_model_sample(inp_im, tar_im, out_im, save_file=save_filename)
 
 
 class BaseTrainModel(BaseModel, ABC):
+    # subclass sets these to True once its train_batch goes through _amp_autocast, _zero_grad, _backward and _step
+    supports_amp = False
+    supports_grad_accumulation = False
 
     def __init__(self, opt: BaseTrainOptions, train_loader: DataLoader, test_loader: DataLoader):
         super().__init__(opt)
         self.opt = opt
 
+        self.amp_enabled = self.opt.amp and self.supports_amp
+        if self.opt.amp and not self.supports_amp:
+            log(f'{self.__class__.__name__} does not support amp, training in float32')
+        self.grad_scalers = {}  # optimizer attribute name -> GradScaler
+
+        self.grad_accumulation_steps = max(1, self.opt.grad_accumulation_steps)
+        if self.grad_accumulation_steps > 1 and not self.supports_grad_accumulation:
+            log(f'{self.__class__.__name__} does not support gradient accumulation, stepping every batch')
+            self.grad_accumulation_steps = 1
+        self.accumulation_window = 1  # number of batches accumulated into the current optimizer step
+        self.accumulation_start = True  # this batch starts a new optimizer step
+        self.accumulation_end = True  # this batch finishes the optimizer step
+        self.optimizer_steps = 0  # optimizer steps taken in this run
+        self.epoch_optimizer_steps = 0
+
+        # connect now rather than at the first save, drive authentication is interactive
+        get_storage(self.opt)
+
+        # writes and uploads checkpoints off the training thread
+        self.checkpoint_writer = None
+        if self.opt.async_checkpoint:
+            self.checkpoint_writer = CheckpointWriter(self.opt, max_in_flight=self.opt.checkpoint_max_in_flight)
+
         self.train_loader = train_loader
         self.test_loader = test_loader
 
@@ -117,12 +160,23 @@ class BaseTrainModel(BaseModel, ABC):
     def get_checkpoint(self) -> Dict:
         pass
 
-    def save_checkpoint(self, tag) -> None:
-        log('Saving checkpoint ... ', end='')
+    def save_checkpoint(self, tag, link_tags=()) -> None:
+        # link_tags are saved with the same content as tag, e.g. latest, without serializing again
         file_name = f'{self.opt.run_id}_{tag}.ckpt'
+        link_names = [f'{self.opt.run_id}_{link_tag}.ckpt' for link_tag in link_tags]
+
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.save(self.get_checkpoint(), file_name, link_names)
+            log(f'Checkpoint queued: {file_name}')
+            return
+
+        log('Saving checkpoint ... ', end='')
         torch.save(self.get_checkpoint(), file_name)
-        save_file(self.opt, file_name, local=False)
-        log(f'done: {file_name}')
+        save_file(self.opt, file_name)
+        for link_name in link_names:
+            shutil.copyfile(file_name, link_name)
+            save_file(self.opt, link_name)
+        log(f'done: {", ".join([file_name] + link_names)}')
 
     @abstractmethod
     def setup_from_train_checkpoint(self, checkpoint):
@@ -169,6 +223,7 @@ class BaseTrainModel(BaseModel, ABC):
     @abstractmethod
     def pre_epoch(self):
         self.last_batch_time = time.time()
+        self.epoch_optimizer_steps = 0
 
     @abstractmethod
     def pre_batch(self, epoch, batch):
@@ -180,12 +235,17 @@ class BaseTrainModel(BaseModel, ABC):
 
     @abstractmethod
     def post_batch(self, epoch, batch, batch_out):
-        if self.opt.batch_log_freq > 0 and (batch % self.opt.batch_log_freq == 0 or batch == 2):
+        # logging and saving count optimizer steps, which are batches unless gradients are accumulated
+        step = self.epoch_optimizer_steps
+        if self.accumulation_end and self.opt.batch_log_freq > 0 and (step % self.opt.batch_log_freq == 0 or step == 2):
             log(self.log_batch(batch))
             self.this_batch_logged = True
         else:
             self.this_batch_logged = False
 
+        if self.accumulation_end and self.opt.save_step_freq > 0 and self.optimizer_steps % self.opt.save_step_freq == 0:
+            self.save_checkpoint('latest')
+
     @abstractmethod
     def evaluate_batch(self, i, batch_data) -> Tuple[float, Tensor, Tensor, Tensor]:
         pass
@@ -226,8 +286,7 @@ class BaseTrainModel(BaseModel, ABC):
     def post_epoch(self, epoch):
 
         if self.opt.save_freq > 0 and (epoch % self.opt.save_freq == 0 or epoch == self.opt.start_epoch):
-            self.save_checkpoint(epoch)
-            self.save_checkpoint('latest')
+            self.save_checkpoint(epoch, link_tags=['latest'])
 
         if self.opt.log_freq > 0 and (epoch % self.opt.log_freq == 0 or epoch == self.opt.start_epoch):
             log(self.log_epoch(epoch))
@@ -237,28 +296,57 @@ class BaseTrainModel(BaseModel, ABC):
         else:
             self.epoch_eval_loss = None
 
+        image_cache = getattr(self.train_loader.dataset, 'image_cache', None)
+        if image_cache is not None:
+            log(image_cache.log_text())
+
     @abstractmethod
     def post_train(self):
         training_end_time = time.time()
         log(f'Training finished at {format_time(training_end_time, datetime=True)}')
         log(f'Time taken: {format_time(training_end_time - self.training_start_time)}')
         self.save_checkpoint(tag='final')
+        if self.checkpoint_writer is not None:
+            log('Waiting for checkpoints to be written and uploaded ... ', end='')
+            self.checkpoint_writer.flush()
+            log('done')
 
     ##
     # Main training loop
     ##
 
+    def _update_accumulation_window(self, batch):
+        # batches of an epoch are grouped into windows of grad_accumulation_steps, the last one may be shorter
+        n_batches = len(self.train_loader)
+        window_start = (batch - 1) // self.grad_accumulation_steps * self.grad_accumulation_steps + 1
+        self.accumulation_window = min(self.grad_accumulation_steps, n_batches - window_start + 1)
+        self.accumulation_start = batch == window_start
+        self.accumulation_end = batch == window_start + self.accumulation_window - 1
+
+    def _epoch_batches(self, train_iter):
+        if train_iter is None:
+            return self.train_loader
+        # logical epoch, same number of batches as one pass with drop_last
+        return itertools.islice(train_iter, len(self.train_loader))
+
     def train(self):
         self.pre_train()
 
+        # with virtual epochs the loader is iterated only once, avoiding per epoch worker and iterator setup
+        train_iter = iter(self.train_loader) if self.opt.virtual_epochs else None
+
         for epoch in range(self.opt.start_epoch, self.opt.end_epoch + 1):
 
             self.pre_epoch()
 
-            for batch, batch_data in enumerate(self.train_loader, 1):
+            for batch, batch_data in enumerate(self._epoch_batches(train_iter), 1):
+                self._update_accumulation_window(batch)
                 self.pre_batch(epoch, batch)
 
                 batch_out = self.train_batch(batch, batch_data)
+                if self.accumulation_end:
+                    self.optimizer_steps += 1
+                    self.epoch_optimizer_steps += 1
 
                 self.post_batch(epoch, batch, batch_out)
 
@@ -284,19 +372,75 @@ class BaseTrainModel(BaseModel, ABC):
         return text
 
     def _get_last_batch(self, this_batch):
-        return max(1, this_batch - self.opt.batch_log_freq)
+        return max(1, this_batch - self.opt.batch_log_freq * self.grad_accumulation_steps)
 
     def log_batch(self, batch):
         curr_time = time.time()
         from_batch = self._get_last_batch(batch)
 
         text = f'[batch={from_batch}-{batch}] ' + \
+               (f'[step={self.optimizer_steps}] ' if self.grad_accumulation_steps > 1 else '') + \
                f'[train_time={format_time(curr_time - self.training_start_time)}] ' + \
                f'[batch_time={format_time(curr_time - self.last_batch_time)}] '
 
         self.last_batch_time = curr_time
         return text
 
+    ###
+    # Mixed precision & gradient accumulation
+    ###
+
+    def _get_amp_dtype(self):
+        if self.opt.amp_dtype is not None:
+            return getattr(torch, self.opt.amp_dtype)
+        return torch.float16 if self._get_device_type() == 'cuda' else torch.bfloat16
+
+    def _get_device_type(self):
+        return torch.device(self.opt.device).type
+
+    def _amp_autocast(self):
+        return torch.autocast(device_type=self._get_device_type(), dtype=self._get_amp_dtype(),
+                              enabled=self.amp_enabled)
+
+    def _get_grad_scaler(self, optimizer_name):
+        if optimizer_name not in self.grad_scalers:
+            # bfloat16 has the range of float32 and does not need loss scaling, a disabled scaler is a pass through
+            enabled = self.amp_enabled and self._get_amp_dtype() == torch.float16 and self._get_device_type() == 'cuda'
+            self.grad_scalers[optimizer_name] = torch.cuda.amp.GradScaler(enabled=enabled)
+        return self.grad_scalers[optimizer_name]
+
+    def _zero_grad(self, optimizer_name):
+        # keeps the gradients accumulated by the previous batches of the window
+        if self.accumulation_start:
+            getattr(self, optimizer_name).zero_grad()
+
+    def _backward(self, loss, optimizer_name, **kwargs):
+        # average over the window, so the accumulated gradient matches one batch of the effective size
+        loss = loss / self.accumulation_window
+        self._get_grad_scaler(optimizer_name).scale(loss).backward(**kwargs)
+
+    def _unscale_grads(self, optimizer_name):
+        # before anything that reads the gradients, e.g. clipping, only valid when accumulation_end
+        self._get_grad_scaler(optimizer_name).unscale_(getattr(self, optimizer_name))
+
+    def _step(self, optimizer_name):
+        if not self.accumulation_end:
+            return
+        # skips the step if the scaled gradients overflowed
+        scaler = self._get_grad_scaler(optimizer_name)
+        scaler.step(getattr(self, optimizer_name))
+        scaler.update()
+
+    def _get_amp_state_dict(self):
+        return {name: scaler.state_dict() for name, scaler in self.grad_scalers.items()}
+
+    def _load_amp_state_dict(self, state_dict):
+        for name, scaler_state_dict in state_dict.items():
+            scaler = self._get_grad_scaler(name)
+            # empty when saved from a run without float16 scaling
+            if scaler.is_enabled() and scaler_state_dict:
+                scaler.load_state_dict(scaler_state_dict)
+
     ###
     # Miscellaneous
     ###
@@ -0,0 +1,118 @@
+import hashlib
+import os
+
+import torch
+from torch import nn, Tensor
+
+from ml.logger import log
+
+COMPILE_BACKENDS = [None, 'torchscript', 'compile']
+
+INDUCTOR_CACHE_DIR = 'inductor-cache'  # next to the checkpoints, shared by every compiled network of the process
+
+_FILE_HASHES = {}
+
+
+def get_file_hash(path):
+    # sha1 of the file content, once per process and version of the file
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key not in _FILE_HASHES:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 24), b''):
+                sha.update(block)
+        _FILE_HASHES[key] = sha.hexdigest()
+    return _FILE_HASHES[key]
+
+
+def _set_inductor_cache_dir(checkpoint_file):
+    # process wide, so it is set once, by the first compiled network, unless it was set by the user.
+    # inductor keys its cache by graph, weights are inputs of the graph, so networks of other checkpoints
+    # can share the directory without reusing each other's kernels wrongly
+    if 'TORCHINDUCTOR_CACHE_DIR' not in os.environ:
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.join(os.path.dirname(os.path.abspath(checkpoint_file)),
+                                                             INDUCTOR_CACHE_DIR)
+
+
+class _BoundArgs(nn.Module):
+    # network with its non tensor arguments fixed, so that only tensors are traced
+
+    def __init__(self, net, args):
+        super().__init__()
+        self.net = net
+        self.args = args
+
+    def forward(self, *inputs):
+        return self.net(*inputs, *self.args)
+
+
+class CompiledNetwork:
+    """
+    Callable in place of an inference network, taking its tensor inputs. With 'torchscript', the network is traced
+    once per input shape, dtype and device, and the traced module is saved next to checkpoint_file, keyed by
+    the checkpoint hash, so later runs load it instead of tracing again. A trace whose output differs from the
+    network is not used. With 'compile', torch.compile is used with inductor, which also works on cpu,
+    and its compiled kernels are cached in one directory next to the checkpoints.
+    """
+
+    def __init__(self, net: nn.Module, name, backend, checkpoint_file, args=()):
+        assert backend in COMPILE_BACKENDS, f'unknown compile backend: {backend}, expected one of {COMPILE_BACKENDS}'
+        self.net = _BoundArgs(net, tuple(args)).eval()
+        self.name = name
+        self.backend = backend
+        self.checkpoint_file = checkpoint_file
+        # only artifacts need the hash, eager runs do not read the checkpoint again
+        self.checkpoint_hash = get_file_hash(checkpoint_file) if backend == 'torchscript' else None
+        self.args = tuple(args)
+        self._traced = {}  # input key -> traced module, or the network itself if tracing failed
+
+        self._compiled = None
+        if backend == 'compile':
+            _set_inductor_cache_dir(checkpoint_file)
+            self._compiled = torch.compile(self.net)
+
+    def __call__(self, *inputs: Tensor) -> Tensor:
+        if self.backend is None:
+            return self.net(*inputs)
+        if self.backend == 'compile':
+            return self._compiled(*inputs)
+
+        key = tuple((tuple(x.shape), str(x.dtype), x.device.type) for x in inputs)
+        if key not in self._traced:
+            self._traced[key] = self._load_or_trace(key, inputs)
+        return self._traced[key](*inputs)
+
+    def get_artifact_file(self, key):
+        shapes = '_'.join('x'.join(map(str, shape)) for shape, _, _ in key)
+        digest = hashlib.sha1(repr((self.checkpoint_hash, key, self.args, torch.__version__)).encode()).hexdigest()
+        return f'{self.checkpoint_file}.{self.name}-{shapes}-{digest[:16]}.ts'
+
+    def _load_or_trace(self, key, inputs):
+        artifact_file = self.get_artifact_file(key)
+        if os.path.isfile(artifact_file):
+            try:
+                return torch.jit.load(artifact_file, map_location=inputs[0].device)
+            except (RuntimeError, OSError) as e:
+                log(f'Ignoring unreadable {artifact_file}: {e}')
+
+        log(f'Tracing {self.name} for inputs {[shape for shape, _, _ in key]} ... ', end='')
+        # tracing records autograd metadata, which inference tensors do not have
+        with torch.inference_mode(False), torch.no_grad():
+            inputs = [x.clone() for x in inputs]
+            try:
+                traced = torch.jit.trace(self.net, tuple(inputs), check_trace=False)
+            except Exception as e:
+                log(f'failed, running eagerly: {e}')
+                return self.net
+            if not torch.allclose(traced(*inputs), self.net(*inputs), rtol=1e-4, atol=1e-5):
+                log('traced output differs, running eagerly')
+                return self.net
+
+        try:
+            torch.jit.save(traced, artifact_file + '.tmp')
+            os.replace(artifact_file + '.tmp', artifact_file)
+            log(f'done: {artifact_file}')
+        except (RuntimeError, OSError) as e:
+            log(f'done, but failed to save {artifact_file}: {e}')
+        return traced
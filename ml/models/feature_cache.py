@@ -0,0 +1,144 @@
+import hashlib
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import nn, Tensor
+
+from ml.logger import log
+
+
+def _state_dict_hash(net: nn.Module):
+    # features are only reused with the same frozen weights
+    sha = hashlib.sha1()
+    for name, tensor in net.state_dict().items():
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+class _PendingFeatures:
+    # features being computed on the side stream of FrozenFeatures
+
+    def __init__(self, features, stream):
+        self.features = features
+        self.stream = stream
+
+    def wait(self) -> Tensor:
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.features.device)
+            current_stream.wait_stream(self.stream)
+            # tell the caching allocator that the features are used by the compute stream now
+            self.features.record_stream(current_stream)
+        return self.features
+
+
+class FrozenFeatures:
+    """
+    Outputs of a frozen network, net(x) without gradients.
+    With cache_dir, features of each sample are saved in float16 under cache_dir/name/<weights hash>,
+    and read back when the same input is seen again, this is worth it for inputs that are not augmented,
+    e.g. the test set, inference and un-augmented training. Samples are keyed by the keys the dataset gives
+    with them, so only inputs that are produced the same way every time are cached.
+    Otherwise features are computed on a separate cuda stream by submit, so that they overlap whatever
+    the caller runs before wait.
+    """
+
+    def __init__(self, net: nn.Module, name, device, cache_dir=None):
+        self.net = net
+        self.name = name
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+        self.cache_dir = None
+        if cache_dir is not None:
+            self.cache_dir = os.path.join(cache_dir, name, _state_dict_hash(net)[:16])
+            Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self._timings = []  # (start, end) cuda events or seconds of each computed batch
+
+    def __call__(self, x: Tensor, keys=None) -> Tensor:
+        return self.submit(x, keys).wait()
+
+    def submit(self, x: Tensor, keys=None) -> _PendingFeatures:
+        # start computing the features of x, call wait on the result once they are needed,
+        # keys identify each sample of x, they are needed with cache_dir
+        if self.cache_dir is not None:
+            return _PendingFeatures(self._cached(x, keys), None)
+        return self._submit(x)
+
+    def _submit(self, x):
+        x = x.to(self.device, non_blocking=True)
+        if self.stream is None:
+            return _PendingFeatures(self._compute(x), None)
+
+        # x is produced on the compute stream
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        x.record_stream(self.stream)
+        with torch.cuda.stream(self.stream):
+            features = self._compute(x)
+        return _PendingFeatures(features, self.stream)
+
+    def _compute(self, x):
+        if self.device.type == 'cuda':
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+        else:
+            start = time.perf_counter()
+
+        with torch.no_grad():
+            features = self.net(x).detach()
+
+        if self.device.type == 'cuda':
+            end.record()
+        else:
+            end = time.perf_counter()
+        self._timings.append((start, end))
+        self.misses += len(x)
+        return features
+
+    def _cached(self, x, keys):
+        assert keys is not None and len(keys) == len(x), f'cached features need a key per sample, got {keys}'
+        keys = [hashlib.sha1(str(key).encode()).hexdigest() for key in keys]
+        files = [os.path.join(self.cache_dir, f'{key}.npy') for key in keys]
+        cached = [np.load(file) if os.path.isfile(file) else None for file in files]
+        missing = [i for i, features in enumerate(cached) if features is None]
+        self.hits += len(x) - len(missing)
+
+        if missing:
+            computed = self._submit(x[missing]).wait().half().cpu().numpy()
+            for i, features in zip(missing, computed):
+                tmp_file = files[i] + '.tmp'
+                with open(tmp_file, 'wb') as file:
+                    np.save(file, features)
+                os.replace(tmp_file, files[i])
+                cached[i] = features
+
+        # computed features go through float16 as well, so a sample gives the same features whether cached or not
+        return torch.from_numpy(np.stack(cached)).to(self.device, non_blocking=True).float()
+
+    def log_text(self):
+        # per epoch, the compute saved is estimated from the time per sample of the computed ones
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            seconds = sum(start.elapsed_time(end) / 1000 for start, end in self._timings)
+        else:
+            seconds = sum(end - start for start, end in self._timings)
+        saved = self.hits * seconds / self.misses if self.misses else 0
+        text = f'[feature_cache {self.name}] ' + \
+               f'[hits={self.hits}] ' + \
+               f'[misses={self.misses}] ' + \
+               f'[compute={seconds:.2f}s] ' + \
+               f'[saved={saved:.2f}s] '
+        self.hits, self.misses, self._timings = 0, 0, []
+        return text
+
+
+def log_feature_caches(*frozen_features):
+    for features in frozen_features:
+        if features is not None and (features.hits or features.misses):
+            log(features.log_text())
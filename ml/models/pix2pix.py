@@ -10,11 +10,14 @@ from tqdm import tqdm
 
 from ml.models.base import BaseTrainModel, BaseInferenceModel
 from .alac_gan_partials import NetF
+from .feature_cache import FrozenFeatures, log_feature_caches
 from .pix2pix_partials import Generator, Discriminator
 from ml.models.criterion.GANBCELoss import GANBCELoss
+from ..datasets.pix2pix import pix2pix_batch_transform, get_feature_cache_dir
+from ..image_writer import ImageWriter, to_uint8_images
 from ..logger import log
 from ..options.pix2pix import Pix2pixTrainOptions, Pix2pixInferenceOptions
-from ..plot_utils import plt_input_target, plt_model_sample, plt_horizontals, save_raw_im
+from ..plot_utils import plt_input_target, plt_model_sample, plt_horizontals
 
 
 class Pix2pixInferenceModel(BaseInferenceModel):
@@ -23,6 +26,7 @@ class Pix2pixInferenceModel(BaseInferenceModel):
         super().__init__(opt, inference_loader)
         self.opt = opt
         self.net_G = None
+        self.compiled_G = None
         self.net_D = None
         self.setup()
 
@@ -35,14 +39,18 @@ class Pix2pixInferenceModel(BaseInferenceModel):
 
         self.net_G.load_state_dict(checkpoint['net_G_state_dict'])
         self.net_D.load_state_dict(checkpoint['net_D_state_dict'])
+        self.compiled_G = self._compile_network(self.net_G, 'net_G')
 
     def inference_batch(self, i, batch_data) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
 
         real_A, real_B = batch_data
-        real_A, real_B = real_A.to(self.opt.device), real_B.to(self.opt.device)
 
-        fake_B = self.net_G(real_A)
-        threshold = (fake_B > 0.5) * 1.0
+        fake_B = self._inference_forward(self.compiled_G, real_A)
+        if isinstance(fake_B, list):
+            # tiled, frames of different sizes
+            threshold = [(out > 0.5) * 1.0 for out in fake_B]
+        else:
+            threshold = (fake_B > 0.5) * 1.0
 
         return real_A, real_B, fake_B, threshold
 
@@ -54,45 +62,35 @@ class Pix2pixInferenceModel(BaseInferenceModel):
         iterator = enumerate(self.inference_loader)
         if self.opt.show_progress:
             iterator = tqdm(iterator, total=len(self.inference_loader), desc='Inference')
+
+        # images are converted to uint8 on the device and encoded in background threads,
+        # so the loop only runs the network
+        writer = ImageWriter(workers=self.opt.output_writers)
         im_index = 0
-        for i, batch_data in iterator:
+        with torch.inference_mode():
+            for i, batch_data in iterator:
 
-            inp_batch, tar_batch, out_batch, thresh_batch = self.inference_batch(i, batch_data)
+                inp_batch, tar_batch, out_batch, thresh_batch = self.inference_batch(i, batch_data)
 
-            for inp_im, tar_im, out_im, threshold in zip(inp_batch, tar_batch, out_batch, thresh_batch):
-                save_filename = os.path.join(self.opt.output_images_path, f'inference-{im_index}.png')
-                im_index += 1
-                plt_horizontals(
-                    [inp_im, tar_im, out_im],
-                    titles=['input', 'target', 'output', 'threshold'],
-                    un_normalize=True,
-                    grayscale=True,
-                    figsize=(3, 1),
-                    save_file=save_filename
-                )
-                save_raw_im(inp_im, os.path.join(
-                    self.opt.output_images_path,
-                    f'inference-{im_index}-in.png'),
-                    grayscale=True
-                )
-                save_raw_im(tar_im, os.path.join(
-                    self.opt.output_images_path,
-                    f'inference-{im_index}-tar.png'),
-                    grayscale=True
-                )
-                save_raw_im(out_im, os.path.join(
-                    self.opt.output_images_path,
-                    f'inference-{im_index}-out.png'),
-                    grayscale=True
-                )
-                save_raw_im(threshold, os.path.join(
-                    self.opt.output_images_path,
-                    f'inference-{im_index}-threshold.png'),
-                    grayscale=True
-                )
+                inp_ims, tar_ims, out_ims = [to_uint8_images(batch) for batch in (inp_batch, tar_batch, out_batch)]
+                thresh_ims = to_uint8_images(thresh_batch, un_normalize=False)
+
+                for inp_im, tar_im, out_im, thresh_im in zip(inp_ims, tar_ims, out_ims, thresh_ims):
+                    save_prefix = os.path.join(self.opt.output_images_path, f'inference-{im_index}')
+                    im_index += 1
+                    if self.opt.output_comparison:
+                        # input | target | output | threshold
+                        writer.write_strip(f'{save_prefix}.png', [inp_im, tar_im, out_im, thresh_im])
+                    writer.write(f'{save_prefix}-in.png', inp_im)
+                    writer.write(f'{save_prefix}-tar.png', tar_im)
+                    writer.write(f'{save_prefix}-out.png', out_im)
+                    writer.write(f'{save_prefix}-threshold.png', thresh_im)
+        writer.close()
 
 
 class Pix2pixTrainModel(BaseTrainModel):
+    supports_amp = True
+    supports_grad_accumulation = True
 
     def __init__(self, opt: Pix2pixTrainOptions, train_loader, test_loader):
         super().__init__(opt, train_loader, test_loader)
@@ -103,6 +101,7 @@ class Pix2pixTrainModel(BaseTrainModel):
         self.net_G = None
         self.net_D = None
         self.net_F = None
+        self.features_F = None
 
         # optimizer
         self.opt_G = None
@@ -131,11 +130,21 @@ class Pix2pixTrainModel(BaseTrainModel):
         self.crt_mse = nn.MSELoss(reduction='none')
         self.sch_G = optim.lr_scheduler.LambdaLR(self.opt_G, lr_lambda=self._decay_rule)
         self.sch_D = optim.lr_scheduler.LambdaLR(self.opt_D, lr_lambda=self._decay_rule)
+        if self.opt.content_loss:
+            self._init_content_loss()
+
+    def _init_content_loss(self):
         self.net_F = NetF(self.opt).to(self.opt.device)
+        # content features of real_A, cached when real_A is not augmented, otherwise they overlap the generator
+        if self.opt.feature_cache_dir is not None and get_feature_cache_dir(self.opt) is None:
+            log('real_A is augmented, NetF features are not cached')
+        self.features_F = FrozenFeatures(self.net_F, 'net_F', self.opt.device,
+                                         cache_dir=get_feature_cache_dir(self.opt))
 
     def setup_from_train_checkpoint(self, checkpoint):
-        _prev_opt, self.net_G, self.net_D, self.opt_G, self.opt_D = checkpoint
+        _prev_opt, self.net_G, self.net_D, self.opt_G, self.opt_D, grad_scaler_state_dicts = checkpoint
         self._init_fixed()
+        self._load_amp_state_dict(grad_scaler_state_dicts)
 
     def setup_from_opt(self, opt):
         # generator
@@ -162,7 +171,8 @@ class Pix2pixTrainModel(BaseTrainModel):
                 .to(self.opt.device))
         # get some data and see if it looks good
         i = 0
-        for inp_batch, tar_batch, _weight_map in self.train_loader:
+        for batch_data in self.train_loader:
+            inp_batch, tar_batch, _weight_map, _keys = self._get_batch_data(batch_data)
             for inp, tar in zip(inp_batch, tar_batch):
                 plt_horizontals(
                     [inp, tar],
@@ -193,75 +203,89 @@ class Pix2pixTrainModel(BaseTrainModel):
     def pre_batch(self, epoch, batch):
         super().pre_batch(epoch, batch)
 
+    def _get_batch_data(self, batch_data):
+        # A, B, weight map and the keys of the samples, which are only loaded when NetF features are cached
+        keys = None
+        if get_feature_cache_dir(self.opt) is not None:
+            *batch_data, keys = batch_data
+        if self.opt.batch_augmentation:
+            batch_data = pix2pix_batch_transform(self.opt, batch_data)
+        return (*batch_data, keys)
+
     def train_batch(self, batch, batch_data):
         self.net_G = self.net_G.train().to(self.opt.device)
         self.net_D = self.net_D.train().to(self.opt.device)
 
-        real_A, real_B, weight_map = batch_data
+        real_A, real_B, weight_map, keys = self._get_batch_data(batch_data)
         real_A, real_B = real_A.to(self.opt.device), real_B.to(self.opt.device)
+        if self.opt.content_loss:
+            real_feat = self.features_F.submit(real_A, keys)
 
         extra_weight = 10
         weight_map = weight_map.to(self.opt.device) * (extra_weight - 1) + 1
 
         # forward pass
         # generate fake image using generator
-        fake_B = self.net_G(real_A)
+        with self._amp_autocast():
+            fake_B = self.net_G(real_A)
 
         ###
         # DISCRIMINATOR
         ###
         self._set_requires_grad(self.net_D, True)
-        self.opt_D.zero_grad()
+        self._zero_grad('opt_D')
 
-        # discriminate fake image
-        fake_AB = torch.cat((real_A, fake_B), dim=1)  # conditionalGAN takes both real and fake image
-        pred_fake = self.net_D(fake_AB.detach())
-        loss_D_fake = self.crt_gan(pred_fake, False)
+        with self._amp_autocast():
+            # discriminate fake image
+            fake_AB = torch.cat((real_A, fake_B), dim=1)  # conditionalGAN takes both real and fake image
+            pred_fake = self.net_D(fake_AB.detach())
+            loss_D_fake = self.crt_gan(pred_fake, False)
 
-        # discriminate real image
-        real_AB = torch.cat((real_A, real_B), dim=1)
-        pred_real = self.net_D(real_AB)
-        loss_D_real = self.crt_gan(pred_real, True)
+            # discriminate real image
+            real_AB = torch.cat((real_A, real_B), dim=1)
+            pred_real = self.net_D(real_AB)
+            loss_D_real = self.crt_gan(pred_real, True)
+
+            loss_D = (loss_D_fake + loss_D_real) * self.opt.d_loss_factor
 
         # backward & optimize
-        loss_D = (loss_D_fake + loss_D_real) * self.opt.d_loss_factor
-        loss_D.backward()
-        self.opt_D.step()
+        self._backward(loss_D, 'opt_D')
+        self._step('opt_D')
 
         ###
         # GENERATOR
         ###
         self._set_requires_grad(self.net_D, False)
-        self.opt_G.zero_grad()
-
-        # generator should fool the discriminator
-        fake_AB = torch.cat((real_A, fake_B), dim=1)
-        pred_fake = self.net_D(fake_AB)
-        loss_G_fake = self.crt_gan(pred_fake, True)
-
-        # l1 loss between generated and real image for more accurate output
-        if self.opt.mse_loss:
-            pixel_wise_loss = self.crt_mse(fake_B, real_B) * self.opt.l1_lambda
-        else:
-            pixel_wise_loss = self.crt_l1(fake_B, real_B) * self.opt.l1_lambda
-        if self.opt.weight_map:
-            loss_G_l1 = torch.mean(pixel_wise_loss * weight_map) * self.opt.l1_lambda
-        else:
-            loss_G_l1 = torch.mean(pixel_wise_loss) * self.opt.l1_lambda
-
-        # content loss
-        if self.opt.content_loss:
-            fake_feat = self.net_F(fake_B.repeat(1, 3, 1, 1))
-            with torch.no_grad():
-                real_feat = self.net_F(real_A)
-            content_loss = self.crt_l1(fake_feat, real_feat).mean() / 3.0
-        else:
-            content_loss = torch.zeros_like(loss_G_l1)
+        self._zero_grad('opt_G')
+
+        with self._amp_autocast():
+            # generator should fool the discriminator
+            fake_AB = torch.cat((real_A, fake_B), dim=1)
+            pred_fake = self.net_D(fake_AB)
+            loss_G_fake = self.crt_gan(pred_fake, True)
+
+            # l1 loss between generated and real image for more accurate output
+            if self.opt.mse_loss:
+                pixel_wise_loss = self.crt_mse(fake_B, real_B) * self.opt.l1_lambda
+            else:
+                pixel_wise_loss = self.crt_l1(fake_B, real_B) * self.opt.l1_lambda
+            if self.opt.weight_map:
+                loss_G_l1 = torch.mean(pixel_wise_loss * weight_map) * self.opt.l1_lambda
+            else:
+                loss_G_l1 = torch.mean(pixel_wise_loss) * self.opt.l1_lambda
+
+            # content loss
+            if self.opt.content_loss:
+                fake_feat = self.net_F(fake_B.repeat(1, 3, 1, 1))
+                content_loss = self.crt_l1(fake_feat, real_feat.wait()).mean() / 3.0
+            else:
+                content_loss = torch.zeros_like(loss_G_l1)
+
+            loss_G = loss_G_fake + loss_G_l1 + content_loss
 
         # backward & optimize
-        loss_G = loss_G_fake + loss_G_l1 + content_loss
-        loss_G.backward()
-        self.opt_G.step()
+        self._backward(loss_G, 'opt_G')
+        self._step('opt_G')
 
         return loss_G_fake.item(), loss_G_l1.item(), loss_D.item(), content_loss.item()
 
@@ -279,6 +303,8 @@ class Pix2pixTrainModel(BaseTrainModel):
         self.sch_G.step()
         self.sch_D.step()
 
+        log_feature_caches(self.features_F)
+
     def post_train(self):
         super().post_train()
 
@@ -286,7 +312,7 @@ class Pix2pixTrainModel(BaseTrainModel):
         self.net_G = self.net_G.eval().to(self.opt.device)
         self.net_D = self.net_D.eval().to(self.opt.device)
 
-        inp, tar, _weight_map = batch_data
+        inp, tar, _weight_map, _keys = self._get_batch_data(batch_data)
         inp, tar = inp.to(self.opt.device), tar.to(self.opt.device)
 
         out = self.net_G(inp)
@@ -366,6 +392,7 @@ class Pix2pixTrainModel(BaseTrainModel):
             'net_D_state_dict': self.net_D.state_dict(),
             'opt_G_state_dict': self.opt_G.state_dict(),
             'opt_D_state_dict': self.opt_D.state_dict(),
+            'grad_scaler_state_dicts': self._get_amp_state_dict(),
             'opt': self.opt.saved_dict,
         }
 
@@ -389,7 +416,7 @@ class Pix2pixTrainModel(BaseTrainModel):
         opt_D.load_state_dict(checkpoint['opt_D_state_dict'])
 
         log('Successfully created network with loaded checkpoint')
-        return loaded_opt, net_G, net_D, opt_G, opt_D
+        return loaded_opt, net_G, net_D, opt_G, opt_D, checkpoint.get('grad_scaler_state_dicts', {})
 
     def _gaussian_init_weight(self, m):
         classname = m.__class__.__name__
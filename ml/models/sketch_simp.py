@@ -22,6 +22,7 @@ class SketchSimpInferenceModel(BaseInferenceModel):
         super().__init__(opt, inference_loader)
 
         self.network = None
+        self.compiled_network = None
 
         self.setup()
 
@@ -31,17 +32,20 @@ class SketchSimpInferenceModel(BaseInferenceModel):
 
         self.network = SketchSimpModel()
         self.network.load_state_dict(checkpoint['network_state_dict'])
+        self.network = self.network.to(self.opt.device).eval()
+        self.compiled_network = self._compile_network(self.network, 'network')
 
     def inference_batch(self, i, batch_data):
         inp, tar = batch_data
-        inp, tar = inp.to(self.opt.device), tar.to(self.opt.device)
 
-        out = self.network(inp)
+        out = self._inference_forward(self.compiled_network, inp)
 
         return inp, tar, out
 
 
 class SketchSimpTrainModel(BaseTrainModel):
+    supports_amp = True
+    supports_grad_accumulation = True
 
     def __init__(self, opt: SketchSimpTrainOptions, train_loader, test_loader):
         super().__init__(opt, train_loader, test_loader)
@@ -74,6 +78,7 @@ class SketchSimpTrainModel(BaseTrainModel):
         self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         self.net_D.load_state_dict(checkpoint['net_D_state_dict'])
         self.opt_D.load_state_dict(checkpoint['opt_D_state_dict'])
+        self._load_amp_state_dict(checkpoint.get('grad_scaler_state_dicts', {}))
 
     def setup_from_opt(self, opt):
         self.network = SketchSimpModel().to(opt.device)
@@ -129,40 +134,42 @@ class SketchSimpTrainModel(BaseTrainModel):
         # train net D
         self._set_requires_grad(self.network, False)
         self._set_requires_grad(self.net_D, True)
-        self.opt_D.zero_grad()
-        # generate fake
-        fake = self.network(inp)
-        # real
-        real_loss = self.crt_D(self.net_D(inp, real), True)
-        # fake
-        fake_loss = self.crt_D(self.net_D(inp, fake.detach()), False)
-        d_d_loss = (real_loss + fake_loss) * 0.5
-        d_d_loss.backward()
-        self.opt_D.step()
+        self._zero_grad('opt_D')
+        with self._amp_autocast():
+            # generate fake
+            fake = self.network(inp)
+            # real
+            real_loss = self.crt_D(self.net_D(inp, real), True)
+            # fake
+            fake_loss = self.crt_D(self.net_D(inp, fake.detach()), False)
+            d_d_loss = (real_loss + fake_loss) * 0.5
+        self._backward(d_d_loss, 'opt_D')
+        self._step('opt_D')
 
         # train net G
         self._set_requires_grad(self.network, True)
         self._set_requires_grad(self.net_D, False)
-        self.optimizer.zero_grad()
+        self._zero_grad('optimizer')
         self.net_F.zero_grad()
 
-        fake = self.network(inp)
-        # l1 loss
-        l1_loss = self.crt_l1(fake, real)
-        # l2 loss
-        l2_loss = self.crt_mse(fake, real)
-        # D loss
-        g_d_loss = self.crt_D(self.net_D(inp, fake), False)
-
-        # content loss
-        fake_feat = self.net_F(fake)
-        with torch.no_grad():
-            real_feat = self.net_F(real)
-        content_loss = self.crt_mse(fake_feat, real_feat)
-
-        loss = (content_loss + l1_loss + l2_loss + g_d_loss) * 0.25
-        loss.backward()
-        self.optimizer.step()
+        with self._amp_autocast():
+            fake = self.network(inp)
+            # l1 loss
+            l1_loss = self.crt_l1(fake, real)
+            # l2 loss
+            l2_loss = self.crt_mse(fake, real)
+            # D loss
+            g_d_loss = self.crt_D(self.net_D(inp, fake), False)
+
+            # content loss
+            fake_feat = self.net_F(fake)
+            with torch.no_grad():
+                real_feat = self.net_F(real)
+            content_loss = self.crt_mse(fake_feat, real_feat)
+
+            loss = (content_loss + l1_loss + l2_loss + g_d_loss) * 0.25
+        self._backward(loss, 'optimizer')
+        self._step('optimizer')
 
         return l1_loss.item(), l2_loss.item(), content_loss.item(), g_d_loss.item(), d_d_loss.item()
 
@@ -198,6 +205,7 @@ class SketchSimpTrainModel(BaseTrainModel):
             'optimizer_state_dict': self.optimizer.state_dict(),
             'net_D_state_dict': self.net_D.state_dict(),
             'opt_D_state_dict': self.opt_D.state_dict(),
+            'grad_scaler_state_dicts': self._get_amp_state_dict(),
             'option_saved_dict': self.opt.saved_dict
         }
 
@@ -0,0 +1,79 @@
+from typing import Callable, List
+
+import torch
+import torch.nn.functional as nnF
+from torch import Tensor
+
+
+def get_tile_starts(length, tile_size, stride):
+    # last tile is aligned to the end, so every pixel is covered without padding beyond the frame
+    if length <= tile_size:
+        return [0]
+    return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+
+def get_blend_window(tile_size, overlap):
+    """
+    (1, tile_size, tile_size) weight, linear ramp over the overlap on each side and 1 in the middle,
+    never zero so that the border of the frame, covered by a single tile, is still defined.
+    """
+    ramp = torch.ones(tile_size)
+    if overlap > 0:
+        positions = torch.arange(tile_size, dtype=torch.float32) + 0.5
+        ramp = torch.minimum(ramp, torch.minimum(positions, tile_size - positions) / overlap)
+    return (ramp[:, None] * ramp[None, :])[None]
+
+
+def tiled_forward(forward: Callable[[Tensor], Tensor], frames: List[Tensor], tile_size, overlap, tile_batch_size,
+                  device) -> List[Tensor]:
+    """
+    Run forward on overlapping tile_size tiles of (C, H, W) frames of any size and blend the tiles back.
+    Tiles of all frames go through forward in batches of tile_batch_size, only the tile batch is on the device,
+    frames and blended outputs stay on cpu. Output may be an integer multiple of the tile size, e.g. super resolution.
+    """
+    assert 0 <= overlap < tile_size, f'overlap must be smaller than tile size: {overlap} >= {tile_size}'
+    if not frames:
+        return []
+    stride = tile_size - overlap
+
+    padded_frames = []
+    tiles = []  # (frame index, y, x)
+    for f, frame in enumerate(frames):
+        # frames smaller than a tile are padded up to one tile
+        _, h, w = frame.shape
+        pad_h, pad_w = max(0, tile_size - h), max(0, tile_size - w)
+        if pad_h or pad_w:
+            frame = nnF.pad(frame[None], (0, pad_w, 0, pad_h), mode='replicate')[0]
+        padded_frames.append(frame)
+
+        for y in get_tile_starts(frame.shape[1], tile_size, stride):
+            for x in get_tile_starts(frame.shape[2], tile_size, stride):
+                tiles.append((f, y, x))
+
+    outputs = [None for _ in frames]
+    weights = [None for _ in frames]
+    window = None
+    for start in range(0, len(tiles), tile_batch_size):
+        batch_tiles = tiles[start:start + tile_batch_size]
+        batch = torch.stack([padded_frames[f][:, y:y + tile_size, x:x + tile_size] for f, y, x in batch_tiles])
+        out_batch = forward(batch.to(device)).float().cpu()
+
+        scale = out_batch.shape[-1] // tile_size
+        out_tile_size = tile_size * scale
+        if window is None:
+            window = get_blend_window(out_tile_size, overlap * scale)
+
+        for (f, y, x), out in zip(batch_tiles, out_batch):
+            if outputs[f] is None:
+                _, h, w = padded_frames[f].shape
+                outputs[f] = torch.zeros(out.shape[0], h * scale, w * scale)
+                weights[f] = torch.zeros(1, h * scale, w * scale)
+            y, x = y * scale, x * scale
+            outputs[f][:, y:y + out_tile_size, x:x + out_tile_size] += out * window
+            weights[f][:, y:y + out_tile_size, x:x + out_tile_size] += window
+
+    # crop the padding away
+    return [
+        (output / weight)[:, :frame.shape[1] * scale, :frame.shape[2] * scale]
+        for output, weight, frame in zip(outputs, weights, frames)
+    ]
@@ -13,7 +13,6 @@ from ml.models.base import BaseInferenceModel
 from ml.models.waifu2x_partials import Net
 from ml.models.warmup_lr import WarmupLRScheduler
 from ml.options.base import BaseInferenceOptions
-from ml.options.default import DefaultTrainOptions
 from ml.options.waifu2x import Waifu2xTrainOptions
 from ml.plot_utils import plt_input_target
 
@@ -24,26 +23,37 @@ class Waifu2xInferenceModel(BaseInferenceModel):
         super().__init__(opt, inference_loader)
 
         self.network = None
+        self.compiled_network = None
+        self.scale = None
 
         self.setup()
 
     def init_from_checkpoint(self, checkpoint):
-        loaded_opt = DefaultTrainOptions()
+        loaded_opt = Waifu2xTrainOptions()
         loaded_opt.load_saved_dict(checkpoint['option_saved_dict'])
 
-        self.network = ...
+        self.scale = loaded_opt.scale if loaded_opt.scale > 0 else 2
+        self.network = Net(scale=loaded_opt.scale, multi_scale=loaded_opt.multi_scale, group=1)
         self.network.load_state_dict(checkpoint['network_state_dict'])
+        self.network = self.network.to(self.opt.device).eval()
+        self.compiled_network = self._compile_network(self.network, 'network', self.scale)
 
     def inference_batch(self, i, batch_data):
-        inp, tar = batch_data
-        inp, tar = inp.to(self.opt.device), tar.to(self.opt.device)
+        # same layout as training, the last (hr, lr) pair
+        if self.opt.inference_tile_size > 0:
+            # list of (hr, lr) of each frame
+            tar, inp = [list(ims) for ims in zip(*batch_data[-1])]
+        else:
+            tar, inp = batch_data[-1]
 
-        out = self.network(inp)
+        out = self._inference_forward(self.compiled_network, inp)
 
         return inp, tar, out
 
 
 class Waifu2xTrainModel(BaseTrainModel):
+    supports_amp = True
+    supports_grad_accumulation = True
 
     def __init__(self, opt: Waifu2xTrainOptions, train_loader, test_loader):
         super().__init__(opt, train_loader, test_loader)
@@ -66,6 +76,7 @@ class Waifu2xTrainModel(BaseTrainModel):
         self.network.load_state_dict(checkpoint['network_state_dict'])
         self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         self.scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        self._load_amp_state_dict(checkpoint.get('grad_scaler_state_dicts', {}))
 
     def setup_from_opt(self, opt):
         self.network = Net(scale=opt.scale, multi_scale=opt.multi_scale, group=1).to(self.opt.device)
@@ -126,13 +137,17 @@ class Waifu2xTrainModel(BaseTrainModel):
 
         hr, lr = hr.to(self.opt.device), lr.to(self.opt.device)
 
-        out = self.network(lr, scale)
-        loss = self.criterion(hr, out)
+        with self._amp_autocast():
+            out = self.network(lr, scale)
+            loss = self.criterion(hr, out)
 
-        self.optimizer.zero_grad()
-        loss.backward()
-        nn.utils.clip_grad_norm(self.network.parameters(), self.opt.clip)
-        self.optimizer.step()
+        self._zero_grad('optimizer')
+        self._backward(loss, 'optimizer')
+        if self.accumulation_end:
+            # clip the accumulated gradient, once per optimizer step
+            self._unscale_grads('optimizer')
+            nn.utils.clip_grad_norm(self.network.parameters(), self.opt.clip)
+        self._step('optimizer')
 
         return loss.item()
 
@@ -172,6 +187,7 @@ class Waifu2xTrainModel(BaseTrainModel):
             'network_state_dict': self.network.state_dict(),
             'optimizer_state_dict': self.optimizer.state_dict(),
             'scheduler_state_dict': self.scheduler.state_dict(),
+            'grad_scaler_state_dicts': self._get_amp_state_dict(),
             'option_saved_dict': self.opt.saved_dict
         }
 
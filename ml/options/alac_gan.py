@@ -16,6 +16,8 @@ class AlacGANInferenceOptions(BaseInferenceOptions):
         self.hint_multiplier = 1
         self.custom_color = None  # red: (235, 64, 52), yellow: (252, 186, 3), blue: (66, 135, 245)
         self.limit = None  # limit on the inference dataset
+        self.batch_xdog = False  # extract sketches for whole batches on device instead of per sample with cv
+        self.feature_cache_dir = None  # cache frozen NetI features of the sketches here, float16, None = disabled
 
     @property
     def tag(self):
@@ -62,6 +64,9 @@ class AlacGANTrainOptions(BaseTrainOptions):
         self.make_fake_hint = True
         self.in_channels = 1
         self.out_channels = 3
+        self.batch_xdog = False  # extract sketches for whole batches on device instead of per sample with cv
+        self.dataset_sketches = False  # read color and sketches packed by ml/preprocess/preprocess_pack_sketches.py
+        self.feature_cache_dir = None  # cache frozen NetI features of the test sketches here, float16, None = disabled
 
         # Optimizer
         self.lr = 0.00002
@@ -20,7 +20,8 @@ class BaseOptions(ABC):
 
         # self.run_id = f'{self.tag}-2022-06-13-Monday-13h-06m-22s'
         self.random_seed = 42
-        self.working_folder = 'WORK'  # shared on Google Drive
+        self.working_folder = 'WORK'  # folder of all runs in storage, shared on Google Drive
+        self.storage_backend = 'local'  # 'local' or 'pydrive2', where files of each run are backed up
         self.pydrive2_settings_file = 'ucl-master-project/misc/settings.yaml'  # for saving and loading
 
         # Model
@@ -33,6 +34,8 @@ class BaseOptions(ABC):
         self.pin_memory = True
         self.shuffle = True
         self.image_size = 256
+        self.image_cache_size = 0  # bytes of decoded images shared across dataloader workers, 0 = disabled
+        self.dataset_index = True  # cache image paths and header sizes next to each dataset folder, refreshed by mtime
 
         # reproducibility
         random.seed(self.random_seed)
@@ -66,6 +69,12 @@ class BaseInferenceOptions(BaseOptions, ABC):
         self.shuffle = False
         self.output_images_path = 'BaseInferenceOptionsOutputPath'
         self.show_progress = True
+        self.output_writers = 4  # threads encoding and writing output images
+        self.output_comparison = True  # also write input, target and output side by side in one image
+        self.inference_tile_size = 0  # > 0 runs full resolution frames as overlapping tiles instead of resizing them
+        self.inference_tile_overlap = 64  # pixels shared by neighbouring tiles, blended with a linear window
+        self.inference_tile_batch_size = 8  # tiles per forward pass, taken across frames
+        self.inference_compile = None  # None, 'torchscript' or 'compile', compiled networks are cached next to the checkpoint
         self.run_id = self.inference_run_id
 
     @property
@@ -92,11 +101,30 @@ class BaseTrainOptions(BaseOptions, ABC):
         self.save_freq = 10
         self.batch_log_freq = 100
         self.resume_ckpt_file = None
+        self.grad_accumulation_steps = 1  # optimizer steps every n batches, effective batch size is batch_size * n
+        self.save_step_freq = 0  # also save the latest checkpoint every n optimizer steps, 0 = disabled
+        self.async_checkpoint = True  # write and upload checkpoints in background threads
+        self.checkpoint_max_in_flight = 2  # snapshots held in memory before save_checkpoint blocks
+
+        # Dataloader
+        self.persistent_workers = True  # keep worker processes alive between epochs and evaluations
+        self.prefetch_factor = 2  # batches loaded in advance by each worker
+        self.device_prefetch = False  # copy the next batch to device on a separate cuda stream
+        self.virtual_epochs = False  # iterate one endless train loader, an epoch is len(train_loader) batches
+
+        # Mixed precision
+        self.amp = False  # autocast forward passes of models that support it
+        self.amp_dtype = None  # 'float16' or 'bfloat16', None = float16 on cuda and bfloat16 on cpu
 
         # Dataset
         self.dataset_root = 'BaseTrainOptionDatasetRoot'
         self.dataset_train_folder = 'train'
         self.dataset_test_folder = 'test'
+        self.aspect_buckets = False  # train at native aspect ratio, batches of images with similar aspect ratio
+        # bucket sides are multiples of this, must suit the downsampling of the network, buckets have about
+        # image_size ** 2 pixels, so a step close to image_size leaves few buckets, or only the square one
+        self.bucket_step = 64
+        self.bucket_max_ratio = 2.0  # widest and tallest bucket
 
         # Evaluate
         self.eval_n_display_samples = 0
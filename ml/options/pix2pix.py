@@ -71,14 +71,21 @@ class Pix2pixTrainOptions(Pix2pixOptions, BaseTrainOptions):
         # pix2pix-sketch-simplification-NO_WEIGHT_MAP-MSE-2022-09-09-Friday-10h-01m-56s
 
         self.dataset_root = './sketch_simplification_good'
+        self.dataset_shards = False  # read from shards packed by ml/preprocess/preprocess_pack_shards.py
         self.a_to_b = True
         self.random_jitter = True
         self.random_mirror = True
         self.random_rotate = True
+        self.batch_augmentation = False  # augment whole batches on device instead of per sample with pil
+        self.batch_augmentation_load_size = None  # size the jitter crop is batched at before the warp, None = image_size
+        # the generator halves the resolution once per block and once more, so sides must be multiples of 128,
+        # at image_size 512 that gives 512x512, 384x640 and 640x384, at 256 only the square, i.e. no bucketing
+        self.bucket_step = 2 ** (len(_generator_config()['blocks']) + 1)
 
         self.weight_map = True
         self.dilate = True
         self.content_loss = False
+        self.feature_cache_dir = None  # cache frozen NetF features of real_A here when not augmented, float16, None = disabled
         self.mse_loss = True
         # self.resume_ckpt_file = 'pix2pix-sketch-simplification-DILATE-2022-09-07-Wednesday-13h-35m-26s'
 
@@ -37,6 +37,7 @@ def save_raw_im(im: torch.tensor, filename, dpi=512, un_normalize=True, grayscal
     else:
         ax.imshow(im, aspect='auto')
     fig.savefig(filename)
+    plt.close(fig)
 
 def plt_horizontals(images, titles=None, figsize=(10, 10), dpi=512, un_normalize=True, save_file=None, grayscale=False):
     fig = plt.figure(figsize=figsize, dpi=dpi)
@@ -15,7 +15,7 @@ print(f'Authentication finished')
 import os
 
 os.chdir('ucl-master-project')
-from ml.save_load import ensure_folder_on_drive
+from ml.storage.pydrive2 import ensure_folder_on_drive
 
 os.chdir('../../gitlab')
 
@@ -1,33 +1,27 @@
 from pathlib import Path
 
-import imagehash
-from PIL import Image
-from tqdm import tqdm
-
+from src.duplicates import hash_images, cluster_near_duplicates, group_clusters, print_cluster_report
 from src.utils import find_all_image_paths
 
+HASH_SIZE = 16  # 16x16 dhash, 256 bits
+MAX_DISTANCE = 0  # bits, 0 only removes exact duplicates, e.g. 8 also removes in-betweens within 8 bits of a kept one
+
 
-def delete_duplicates(root):
+def delete_duplicates(root, max_distance=MAX_DISTANCE, hash_size=HASH_SIZE, workers=4, dry_run=False):
+    # keep the first image in sorted order of each cluster, delete the others, which are within max_distance of it
     im_paths = sorted(find_all_image_paths(root))
 
-    seen = set()
-    to_delete = []
-    uniques = 0
-    for im_path in tqdm(im_paths, total=len(im_paths), desc='del dup'):
-        hash_code = imagehash.dhash(Image.open(im_path), hash_size=16)
-        if hash_code not in seen:
-            seen.add(hash_code)
-            uniques += 1
-        else:
-            to_delete.append(im_path)
+    hashes = hash_images(im_paths, hash_size=hash_size, workers=workers)
+    clusters = group_clusters(im_paths, cluster_near_duplicates(hashes, max_distance))
+    to_delete = [path for cluster in clusters for path in cluster[1:]]
 
-    for path in to_delete:
-        Path(path).unlink(missing_ok=False)
+    if not dry_run:
+        for path in to_delete:
+            Path(path).unlink(missing_ok=False)
 
     print(f'root: {root}')
-    print(f'all: {len(im_paths)}')
-    print(f'duplicates: {len(to_delete)}')
-    print(f'left over: {uniques}')
+    print_cluster_report(clusters)
+    print(f'left over: {len(clusters)}')
 
 
 def main():
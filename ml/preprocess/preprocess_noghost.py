@@ -167,6 +167,7 @@ def main():
         .add(pil_rgba_to_rgb) \
         .add(pil_rgb_to_gray) \
         .add(pil_save_image) \
+        .resume(os.path.join(line_tied_dataset_root, 'manifest.jsonl')) \
         .run()
 
 
@@ -0,0 +1,19 @@
+import os
+
+from ml.datasets.shard import pack_image_shards, DEFAULT_SHARD_SIZE
+
+
+def main():
+    DATASET_ROOT = r'./sketch_simplification_good'
+    FOLDERS = ['train', 'test']
+    SHARD_SIZE = DEFAULT_SHARD_SIZE
+
+    for folder in FOLDERS:
+        root = os.path.join(DATASET_ROOT, folder)
+        print(f'Packing: {root}')
+        out_root = pack_image_shards(root, shard_size=SHARD_SIZE, workers=os.cpu_count() - 1)
+        print(f'done, output directory: {out_root}')
+
+
+if __name__ == '__main__':
+    main()
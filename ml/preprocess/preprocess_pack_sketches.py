@@ -0,0 +1,20 @@
+import os
+
+from ml.datasets.shard import pack_sketch_shards, DEFAULT_SHARD_SIZE, SKETCH_SIGMAS
+
+
+def main():
+    DATASET_ROOT = r'./colorization'
+    FOLDERS = ['train', 'test']
+    SIGMAS = SKETCH_SIGMAS
+    SHARD_SIZE = DEFAULT_SHARD_SIZE
+
+    for folder in FOLDERS:
+        root = os.path.join(DATASET_ROOT, folder)
+        print(f'Packing color and sketches: {root}')
+        out_root = pack_sketch_shards(root, sigmas=SIGMAS, shard_size=SHARD_SIZE, workers=os.cpu_count() - 1)
+        print(f'done, output directory: {out_root}')
+
+
+if __name__ == '__main__':
+    main()
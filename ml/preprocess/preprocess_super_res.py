@@ -8,7 +8,7 @@ from sklearn.model_selection import train_test_split
 from tqdm import tqdm
 
 from preprocess_delete_duplicates import delete_duplicates
-from src.functions import cv_rgba_to_rgb_
+from src.functions import cv_rgba_to_rgb_, cv_imwrite_atomic, pil_save_atomic
 from src.pipeline import Pipeline
 from src.utils import find_all_image_paths
 
@@ -29,8 +29,8 @@ def save_image(prev_out, args):
     lr, hr = prev_out
     lr_path, hr_path = args
 
-    cv.imwrite(lr_path, lr)
-    cv.imwrite(hr_path, hr)
+    cv_imwrite_atomic(lr_path, lr)
+    cv_imwrite_atomic(hr_path, hr)
 
 
 def rgba_to_rgb(prev_out, _):
@@ -60,7 +60,7 @@ def pil_rgba_to_rgb(im, _):
 
 
 def pil_save_image(im, path):
-    im.save(path)
+    pil_save_atomic(im, path)
 
 
 def pil_crop_empty(im, _):
@@ -150,6 +150,7 @@ def main():
         .add(rgba_to_rgb) \
         .add(drop_small_images, args=64) \
         .add(save_image, args=out_paths) \
+        .resume(os.path.join(OUTPUT_ROOT, 'manifest.jsonl')) \
         .run(desc='process')
 
     # remove copied over original images
@@ -0,0 +1,166 @@
+import imagehash
+import numpy as np
+from PIL import Image
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from ml.preprocess.src.pipeline import Pipeline
+
+# number of set bits of every byte
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def pack_hash(im_hash: imagehash.ImageHash) -> np.ndarray:
+    # hash bits packed into bytes, 8 bytes for the default phash and 32 bytes for a 16x16 dhash
+    return np.packbits(im_hash.hash.flatten())
+
+
+def _dhash_image(prev_out, args):
+    i, path, hash_size = args
+    with Image.open(path) as im:
+        return i, pack_hash(imagehash.dhash(im, hash_size=hash_size))
+
+
+def _set_hash(hashes, out):
+    i, packed = out
+    hashes[i] = packed
+    return hashes
+
+
+def hash_images(paths, hash_size=16, workers=4, chunksize=64):
+    # (N, hash_size ** 2 / 8) packed dhash of each image, decoded and hashed in parallel
+    hashes = np.zeros((len(paths), hash_size * hash_size // 8), dtype=np.uint8)
+    return Pipeline(workers=workers, multi_process=True, chunksize=chunksize) \
+        .add(_dhash_image, args=((i, path, hash_size) for i, path in enumerate(paths))) \
+        .reduce(_set_hash, hashes) \
+        .run(desc='hash', total=len(paths))
+
+
+def hamming_distances(a, b):
+    # row wise hamming distance of two (N, n_bytes) packed hash arrays
+    return _POPCOUNT[np.bitwise_xor(a, b)].sum(axis=1, dtype=np.int64)
+
+
+def _as_keys(rows):
+    # (N, n_bytes) rows as a 1d array that sorts and compares by row, np.unique(axis=0) is several times slower
+    rows = np.ascontiguousarray(rows)
+    if rows.shape[1] <= 8:
+        padded = np.zeros((len(rows), 8), dtype=np.uint8)
+        padded[:, 8 - rows.shape[1]:] = rows
+        return padded.view('>u8').ravel()
+    return rows.view(f'V{rows.shape[1]}').ravel()
+
+
+def _chunk_keys(hashes, bit_start, bit_end):
+    # bits [bit_start, bit_end) of every hash
+    byte_start, byte_end = bit_start // 8, (bit_end + 7) // 8
+    bits = np.unpackbits(hashes[:, byte_start:byte_end], axis=1)
+    return _as_keys(np.packbits(bits[:, bit_start - byte_start * 8:bit_end - byte_start * 8], axis=1))
+
+
+def find_near_duplicate_pairs(hashes, max_distance):
+    """
+    All pairs (i, j), i < j, of distinct packed hashes within max_distance bits, with multi-index hashing:
+    the bits are split into max_distance + 1 chunks, two hashes within max_distance bits are equal in at least
+    one chunk, so only hashes sharing a chunk are compared. Pairs are generated and checked vectorised,
+    one offset within the groups of equal chunks at a time, so the work is proportional to the candidate pairs.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint8)
+    n_bits = hashes.shape[1] * 8
+    assert 0 <= max_distance < n_bits, f'max distance must be smaller than the hash bits: {max_distance} >= {n_bits}'
+
+    pairs_i, pairs_j = [], []
+    chunk_bounds = np.linspace(0, n_bits, max_distance + 2).astype(int)
+    for bit_start, bit_end in zip(chunk_bounds[:-1], chunk_bounds[1:]):
+        keys = _chunk_keys(hashes, bit_start, bit_end)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        sorted_ids = np.concatenate([[0], np.cumsum(sorted_keys[1:] != sorted_keys[:-1])])
+        group_sizes = np.bincount(sorted_ids)
+        group_starts = np.cumsum(group_sizes) - group_sizes
+
+        size_of = group_sizes[sorted_ids]
+        position_in_group = np.arange(len(order)) - group_starts[sorted_ids]
+        remaining = np.flatnonzero(size_of > 1)
+        offset = 1
+        while remaining.size:
+            # positions with a group member offset places after them
+            remaining = remaining[position_in_group[remaining] + offset < size_of[remaining]]
+            i, j = order[remaining], order[remaining + offset]
+            close = hamming_distances(hashes[i], hashes[j]) <= max_distance
+            pairs_i.append(np.minimum(i[close], j[close]))
+            pairs_j.append(np.maximum(i[close], j[close]))
+            offset += 1
+
+    if not pairs_i:
+        return np.zeros((0, 2), dtype=np.int64)
+    # pairs equal in several chunks are found several times
+    return np.unique(np.stack([np.concatenate(pairs_i), np.concatenate(pairs_j)], axis=1), axis=0)
+
+
+def _representative_labels(n, pairs):
+    # in order, each hash joins the first earlier representative within the distance, or becomes one
+    order = np.lexsort((pairs[:, 0], pairs[:, 1]))
+    pairs_i, pairs_j = pairs[order, 0], pairs[order, 1]
+    labels = np.arange(n)
+    is_representative = np.ones(n, dtype=bool)
+    starts = np.searchsorted(pairs_j, np.arange(n + 1))
+    for j in np.unique(pairs_j):
+        neighbours = pairs_i[starts[j]:starts[j + 1]]
+        representatives = neighbours[is_representative[neighbours]]
+        if representatives.size:
+            labels[j] = representatives[0]
+            is_representative[j] = False
+    return labels
+
+
+def cluster_near_duplicates(hashes, max_distance, chain=False):
+    """
+    Cluster label of each packed hash, hashes are taken in the given order and each joins the first earlier
+    representative within max_distance bits, so every member is close to the one that is kept.
+    With chain, connected components of the graph of hashes within max_distance bits are taken instead,
+    so that a sequence of in-betweens each close to the next ends up in one cluster, however far the ends are.
+    Identical hashes are merged first, so a large group of e.g. blank frames costs nothing.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint8)
+    if len(hashes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    _, first_index, unique_ids = np.unique(_as_keys(hashes), return_index=True, return_inverse=True)
+    # unique hashes in order of first occurrence, so that representatives come first
+    order = np.argsort(first_index)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    unique_hashes = hashes[first_index[order]]
+    unique_ids = rank[unique_ids.ravel()]
+
+    pairs = find_near_duplicate_pairs(unique_hashes, max_distance) if max_distance > 0 \
+        else np.zeros((0, 2), dtype=np.int64)
+    n = len(unique_hashes)
+    if chain:
+        graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+        _, unique_labels = connected_components(graph, directed=False)
+    else:
+        unique_labels = _representative_labels(n, pairs)
+    return unique_labels[unique_ids]
+
+
+def group_clusters(items, labels):
+    # items of each cluster, in the given order, the first one is the representative that is kept
+    clusters = {}
+    for item, label in zip(items, labels):
+        clusters.setdefault(label, []).append(item)
+    return list(clusters.values())
+
+
+def print_cluster_report(clusters, n_largest=10):
+    sizes = np.array([len(cluster) for cluster in clusters], dtype=np.int64)
+    print(f'all: {sizes.sum()}')
+    print(f'clusters: {len(clusters)}')
+    print(f'duplicates: {sizes.sum() - len(clusters)}')
+    for low, high in [(1, 1), (2, 2), (3, 5), (6, 10), (11, 50), (51, None)]:
+        in_range = (sizes >= low) & (sizes <= (high if high is not None else sizes.max(initial=0)))
+        name = f'{low}' if low == high else f'{low}+' if high is None else f'{low}-{high}'
+        print(f'  size {name:>6}: {in_range.sum():>8} clusters, {sizes[in_range].sum():>8} images')
+    for cluster in sorted(clusters, key=len, reverse=True)[:n_largest]:
+        if len(cluster) > 1:
+            print(f'  {len(cluster):>6} x {cluster[0]}')
@@ -5,7 +5,20 @@ import imagehash
 import numpy as np
 from PIL import Image, ImageOps
 
-from ml.preprocess.src.utils import find_all_image_paths
+from ml.preprocess.src.utils import find_all_image_paths, atomic_write
+
+
+def cv_imwrite_atomic(path, im):
+    # encoded in memory with the format of the extension, written with a rename
+    success, buffer = cv.imencode(os.path.splitext(path)[1], im)
+    if not success:
+        raise IOError(f'failed to encode image: {path}')
+    atomic_write(path, lambda file: file.write(buffer))
+
+
+def pil_save_atomic(im, path):
+    image_format = Image.registered_extensions()[os.path.splitext(path)[1].lower()]
+    atomic_write(path, lambda file: im.save(file, format=image_format))
 
 
 def make_input_output_paths(A_dir, B_dir, output_root, a_to_b=True):
@@ -136,7 +149,7 @@ def cv_save_im(prev_out, args):
 
     if im.size == 0:
         return
-    cv.imwrite(save_file, im)
+    cv_imwrite_atomic(save_file, im)
 
 
 def pil_read_images(prev_out, args):
@@ -248,7 +261,7 @@ def pil_rgba_to_rgb(prev_out, args):
 def pil_save_image(prev_out, args):
     im, save_path = prev_out
 
-    im.save(save_path)
+    pil_save_atomic(im, save_path)
     return im, save_path
 
 
@@ -263,7 +276,7 @@ def save_image(prev_out, args):
     im = prev_out
     save_path = args
 
-    im.save(save_path)
+    pil_save_atomic(im, save_path)
 
 
 def compute_hash(prev_out, args):
@@ -287,30 +300,48 @@ def center_crop_coord(im, new_size):
     return left, top, right, bottom
 
 
+def _window_sums(cumsum, lo_x, hi_x, lo_y, hi_y):
+    # sums over [lo_x, hi_x) x [lo_y, hi_y) of every (N, W, H) image, from its zero padded integral image
+    return (cumsum[:, hi_x[:, None], hi_y[None, :]] - cumsum[:, lo_x[:, None], hi_y[None, :]]
+            - cumsum[:, hi_x[:, None], lo_y[None, :]] + cumsum[:, lo_x[:, None], lo_y[None, :]])
+
+
+def compute_weight_maps(ims, n_bins, dist):
+    """
+    Weight map of a stack of (N, W, H) grayscale images in [0, 1], exp(-p) + 0.5 for each pixel,
+    where p is the fraction of the neighbourhood [x - dist, x + dist) x [y - dist, y + dist)
+    that falls strictly inside the histogram bin of the pixel.
+    Bin counts come from one integral image per bin, so the cost does not depend on dist.
+    """
+    ims = np.asarray(ims)
+    assert ims.ndim == 3, f'expected (N, W, H) images, got {ims.shape}'
+    n, w, h = ims.shape
+    lin = np.linspace(0, 1, n_bins + 1)
+
+    # window of each row and column, clipped at the border
+    lo_x, hi_x = np.maximum(np.arange(w) - dist, 0), np.minimum(np.arange(w) + dist, w)
+    lo_y, hi_y = np.maximum(np.arange(h) - dist, 0), np.minimum(np.arange(h) + dist, h)
+    window_size = (hi_x - lo_x)[:, None] * (hi_y - lo_y)[None, :]
+
+    # bin of each pixel, first bin with lin[i] <= p <= lin[i + 1], 0 when outside of [0, 1]
+    pixel_bins = np.searchsorted(lin[1:], ims, side='left')
+    pixel_bins[(pixel_bins >= n_bins) | (ims < 0)] = 0
+
+    fractions = np.zeros(ims.shape)
+    cumsum = np.zeros((n, w + 1, h + 1), dtype=np.int64)
+    for i in range(n_bins):
+        in_bin = pixel_bins == i
+        if not in_bin.any():
+            continue
+        np.cumsum(np.cumsum((ims > lin[i]) & (ims < lin[i + 1]), axis=1), axis=2, out=cumsum[:, 1:, 1:])
+        counts = _window_sums(cumsum, lo_x, hi_x, lo_y, hi_y)
+        fractions[in_bin] = (counts / window_size)[in_bin]
+
+    return np.exp(-fractions) + 0.5
+
+
 def compute_weight_map(prev_out, args):
     im = prev_out
     n_bins, dist = args
 
-    lin = np.linspace(0, 1, n_bins + 1)
-    out = np.zeros(im.shape)
-
-    w, h = im.shape[:2]
-    for x in range(w):
-        x_min = max(0, x - dist)
-        x_max = min(w, x + dist)
-        for y in range(h):
-            y_min = max(0, y - dist)
-            y_max = min(h, y + dist)
-            local = im[x_min:x_max, y_min:y_max]
-            bins = np.empty(n_bins)
-            for i in range(n_bins):
-                bins[i] = np.sum((local > lin[i]) * (local < lin[i + 1])) / local.size
-            p = im[x, y]
-            n = 0
-            for i in range(n_bins):
-                if lin[i] <= p <= lin[i + 1]:
-                    n = i
-                    break
-            out[x, y] = np.exp(-bins[n]) + 0.5
-
-    return out
+    return compute_weight_maps(im[np.newaxis], n_bins, dist)[0]
@@ -1,21 +1,59 @@
-import functools
-from multiprocessing import Pool as ProcessPool
+import hashlib
+import inspect
+import itertools
+import json
+import os
+import queue
+import time
+from collections import namedtuple
+from collections.abc import Iterator
+from contextlib import ExitStack
+from multiprocessing import Pool as ProcessPool, resource_tracker, shared_memory
 from multiprocessing.dummy import Pool as ThreadPool
 
+import numpy as np
 from tqdm import tqdm
 
 
-# run the given function
-# this exists because multiprocessing can only pickle top level function
-def process(func):
-    return func()
+# bytes read and written by the calling thread, linux only
+_IO_COUNTERS_FILE = '/proc/thread-self/io'
 
+# per stage totals, [seconds, calls, early terminations, bytes read, bytes written]
+_N_STAGE_STATS = 5
 
-# this is the actual processing function
-def _process(extra_args, functions, early_termination):
-    prev_output = None
-    for func, extra_arg in zip(functions, extra_args):
-        prev_output = func(prev_output, extra_arg)
+
+def _read_io_counters():
+    try:
+        with open(_IO_COUNTERS_FILE, 'rb') as file:
+            content = file.read()
+        counters = dict(line.split(b': ') for line in content.splitlines())
+        # counters are from before this read, the size of this read is returned so that it can be excluded
+        return int(counters[b'rchar']), int(counters[b'wchar']), len(content)
+    except (OSError, KeyError, ValueError):
+        return 0, 0, 0
+
+
+# this is the actual processing function, runs functions[start:end] of an item, from the output of start - 1
+def _process(extra_args, functions, early_termination, stats=None, start=0, end=None, prev_output=None):
+    end = len(functions) if end is None else end
+    for stage in range(start, end):
+        func, extra_arg = functions[stage], extra_args[stage]
+        if stats is None:
+            prev_output = func(prev_output, extra_arg)
+        else:
+            read_start, written_start, counters_size = _read_io_counters()
+            start_time = time.perf_counter()
+            prev_output = func(prev_output, extra_arg)
+            seconds = time.perf_counter() - start_time
+            read_end, written_end, _ = _read_io_counters()
+            read_start += counters_size
+
+            stage_stats = stats[stage]
+            stage_stats[0] += seconds
+            stage_stats[1] += 1
+            stage_stats[2] += prev_output is None and func != functions[-1]
+            stage_stats[3] += read_end - read_start
+            stage_stats[4] += written_end - written_start
         if prev_output is None:
             if early_termination is not None and func != functions[-1]:
                 early_termination(extra_args)
@@ -23,55 +61,377 @@ def _process(extra_args, functions, early_termination):
     return prev_output
 
 
+# numpy array handed to the pool of the next stage group, the pixels stay in a shared memory segment
+_SharedArray = namedtuple('_SharedArray', ['name', 'shape', 'dtype'])
+
+
+def _to_shared(obj):
+    # arrays, also inside tuples and lists, are moved to shared memory, anything else is pickled as usual
+    if isinstance(obj, np.ndarray):
+        shm = shared_memory.SharedMemory(create=True, size=max(1, obj.nbytes))
+        np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf)[...] = obj
+        shared = _SharedArray(shm.name, obj.shape, obj.dtype.str)
+        shm.close()
+        return shared
+    if isinstance(obj, (tuple, list)) and not isinstance(obj, _SharedArray):
+        return type(obj)(_to_shared(o) for o in obj)
+    return obj
+
+
+def _from_shared(obj, copy=True):
+    # the segment is unlinked once read, without copy it is only released
+    if isinstance(obj, _SharedArray):
+        shm = shared_memory.SharedMemory(name=obj.name)
+        array = np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf).copy() if copy else None
+        shm.close()
+        shm.unlink()
+        return array
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(_from_shared(o, copy) for o in obj)
+    return obj
+
+
+def _item_files(extra_args):
+    # [path, mtime, size] of every existing file named in the arguments of an item, inputs and outputs alike
+    files = []
+    for arg in extra_args:
+        for path in (arg if isinstance(arg, (list, tuple)) else [arg]):
+            if isinstance(path, str) and os.path.isfile(path):
+                stat = os.stat(path)
+                files.append([path, stat.st_mtime_ns, stat.st_size])
+    return files
+
+
+# runs in the worker, a chunk is sent and returned as a whole to save round trips
+# items are (manifest key, arguments, output of the previous stage group), the stage group is functions[start:end]
+# returns outputs of items finished here, when the parent consumes them, otherwise just how many items finished,
+# stats when profiling, files of finished items for the manifest, and items for the next stage group
+def _process_chunk(chunk, functions, start, end, early_termination, keep_outputs, profile, resume, share):
+    stats = [[0] * _N_STAGE_STATS for _ in functions] if profile else None
+    outputs, records, next_items = [], [], []
+    for key, extra_args, prev_output in chunk:
+        output = _process(extra_args, functions, early_termination, stats, start, end, _from_shared(prev_output))
+        if output is not None and end < len(functions):
+            next_items.append((key, extra_args, _to_shared(output) if share else output))
+            continue
+        outputs.append(output)
+        if resume:
+            records.append((key, _item_files(extra_args)))
+    return (outputs if keep_outputs else len(outputs)), stats, records, next_items
+
+
+def _stage_config_hash(functions, arguments):
+    # changes when a function, its code or an argument shared by all items changes
+    config = hashlib.sha1()
+    for func, args in zip(functions, arguments):
+        config.update(f'{getattr(func, "__module__", "")}.{getattr(func, "__qualname__", repr(func))}'.encode())
+        try:
+            config.update(inspect.getsource(func).encode())
+        except (OSError, TypeError):
+            pass
+        if not _is_per_item(args):
+            config.update(repr(args).encode())
+    return config.hexdigest()
+
+
+class _Manifest:
+    """
+    Items completed by previous runs, keyed by the stage config hash and the arguments of the item,
+    with the files the item read or wrote as they were when it completed. An item is done as long as
+    all of its files are unchanged. One json line is appended per completed item, a crash loses at most the last line.
+    """
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.records = {}
+        n_lines = 0
+        if os.path.isfile(manifest_file):
+            with open(manifest_file, 'r') as file:
+                for line in file:
+                    n_lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # partially written by a crashed run
+                    self.records[record['key']] = record['files']
+
+        if n_lines > len(self.records):
+            # drop superseded and partial lines
+            tmp_file = manifest_file + '.tmp'
+            with open(tmp_file, 'w') as file:
+                for key, files in self.records.items():
+                    file.write(json.dumps({'key': key, 'files': files}) + '\n')
+            os.replace(tmp_file, manifest_file)
+
+        self.file = open(manifest_file, 'a')
+
+    @staticmethod
+    def item_key(config_hash, extra_args):
+        return hashlib.sha1(f'{config_hash}{extra_args!r}'.encode()).hexdigest()
+
+    def is_done(self, key):
+        files = self.records.get(key)
+        if files is None:
+            return False
+        for path, mtime, size in files:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+            if stat.st_mtime_ns != mtime or stat.st_size != size:
+                return False
+        return True
+
+    def add(self, records):
+        for key, files in records:
+            self.records[key] = files
+            self.file.write(json.dumps({'key': key, 'files': files}) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def _is_per_item(args):
+    # lists and iterators give one argument per item, anything else is the same argument for every item
+    return isinstance(args, (list, Iterator))
+
+
 class Pipeline:
 
-    def __init__(self, workers=4, multi_process=True):
+    def __init__(self, workers=4, multi_process=True, chunksize=1, max_in_flight=None):
         self.functions = []
         self.arguments = []
         self.pool = ProcessPool if multi_process else ThreadPool
+        self.multi_process = multi_process
         self.workers = workers
+        self.stage_workers = {0: workers}  # first function of each stage group -> workers of its pool
+        self.chunksize = chunksize
+        self.max_in_flight = max_in_flight  # in chunks, 4 per worker by default
         self.post_process_func = None
+        self.reduce_func = None
+        self.reduce_initial = None
         self.early_termination = None
+        self.profile_enabled = False
+        self.profile_file = None
+        self.manifest_file = None
 
     def add(self, func, args=None):
         self.functions.append(func)
         self.arguments.append(args)
         return self
 
+    def stage(self, workers):
+        """
+        Functions added after this run in a separate pool of workers, so that a cpu heavy stage can scale
+        independently of e.g. reading. With processes, numpy arrays passed between the pools go through shared memory,
+        only their (name, shape, dtype) are pickled.
+        """
+        self.stage_workers[len(self.functions)] = workers
+        return self
+
+    def _stage_groups(self):
+        # (start, end, workers) of each stage group
+        starts = sorted(start for start in self.stage_workers if start < len(self.functions))
+        ends = starts[1:] + [len(self.functions)]
+        return [(start, end, self.stage_workers[start]) for start, end in zip(starts, ends)]
+
     def on_early_terminate(self, func):
         self.early_termination = func
         return self
 
     def post_process(self, func):
+        # func is called once with the outputs of all items, which are all kept in memory until then
         self.post_process_func = func
         return self
 
+    def reduce(self, func, initial=None):
+        # outputs are folded as they arrive, result = func(result, output), run returns the result
+        self.reduce_func = func
+        self.reduce_initial = initial
+        return self
+
+    def profile(self, report_file=None):
+        # time, calls, early terminations and bytes read and written of each function,
+        # printed as a table at the end of run and dumped as json to report_file if given
+        self.profile_enabled = True
+        self.profile_file = report_file
+        return self
+
+    def resume(self, manifest_file):
+        # items completed by a previous run with the same functions and arguments are skipped,
+        # as long as the files they read and wrote are unchanged, outputs of skipped items are not available
+        self.manifest_file = manifest_file
+        return self
+
     def get_worker_inputs(self):
-        assert isinstance(self.arguments[0], list), "input to the first function should be a list"
-        size = len(self.arguments[0])
-        worker_inputs = [[] for _ in range(size)]
-        for func_index, args in enumerate(self.arguments):
-            # args is args for each function
-            if not isinstance(args, list):
-                args = [args for _ in range(size)]
+        """
+        Arguments of each item, lazily, so that inputs can be an iterator over more items than fit in memory.
+        The number of items is given by the first function, other per item arguments must be at least as long.
+        """
+        assert _is_per_item(self.arguments[0]), "input to the first function should be a list or an iterator"
+        if isinstance(self.arguments[0], list):
+            size = len(self.arguments[0])
+            for args in self.arguments:
+                if isinstance(args, list):
+                    assert len(args) >= size, f"len of arguments need to be enough: {len(args)} < {size}"
 
-            assert len(args) >= size, f"len of arguments need to be enough: {len(args)} < {size}"
-            for i, arg in enumerate(args[:size]):
-                worker_inputs[i].append(arg)
+        per_func_args = [iter(args) if _is_per_item(args) else itertools.repeat(args) for args in self.arguments]
+        for worker_input in zip(*per_func_args):
+            yield list(worker_input)
 
-        worker_funcs = [functools.partial(_process, worker_input, self.functions, self.early_termination) for worker_input in worker_inputs]
+    def _skip_done(self, worker_inputs, manifest, progress):
+        # (key, arguments, no previous output) of items that are not done yet
+        config_hash = _stage_config_hash(self.functions, self.arguments) if manifest is not None else None
+        for worker_input in worker_inputs:
+            if manifest is None:
+                yield None, worker_input, None
+                continue
+            key = manifest.item_key(config_hash, worker_input)
+            if manifest.is_done(key):
+                progress.update(1)
+            else:
+                yield key, worker_input, None
 
-        return worker_funcs
+    def _chunks(self, worker_inputs):
+        while True:
+            chunk = list(itertools.islice(worker_inputs, self.chunksize))
+            if not chunk:
+                return
+            yield chunk
+
+    def run(self, desc='', total=None):
+        """
+        Items are dispatched in chunks of chunksize with at most max_in_flight chunks submitted and not yet done,
+        so memory does not grow with the number of items. Outputs are dropped unless post_process or reduce is set.
+        With a manifest, see resume, items done by a previous run are skipped and counted as done.
+        total is only for the progress bar, it defaults to the length of the first argument when it is a list.
+        """
+        if total is None and isinstance(self.arguments[0], list):
+            total = len(self.arguments[0])
+        keep_outputs = self.post_process_func is not None or self.reduce_func is not None
+        groups = self._stage_groups()
+        share = self.multi_process and len(groups) > 1
+        max_in_flight = self.max_in_flight
+        if max_in_flight is None:
+            max_in_flight = 4 * sum(workers for _, _, workers in groups)
 
-    def run(self, desc=''):
         process_outs = []
-        worker_inputs = self.get_worker_inputs()
-        with self.pool(self.workers) as pool:
-            for item in tqdm(
-                    pool.imap_unordered(process, worker_inputs),
-                    total=len(worker_inputs),
-                    desc=desc
-            ):
-                process_outs.append(item)
+        result = self.reduce_initial
+        stats = [[0] * _N_STAGE_STATS for _ in self.functions]
+        # (stage group, success, _process_chunk output or exception), filled by the pool result threads
+        done = queue.Queue()
+        manifest = _Manifest(self.manifest_file) if self.manifest_file is not None else None
+        if share:
+            # pools must share the tracker of the main process, so segments unlinked by one are not leaked by another
+            resource_tracker.ensure_running()
+
+        def submit(pool_index, chunk):
+            start, end, _ = groups[pool_index]
+            pools[pool_index].apply_async(
+                _process_chunk,
+                (chunk, self.functions, start, end, self.early_termination, keep_outputs, self.profile_enabled,
+                 manifest is not None, share),
+                callback=lambda out: done.put((pool_index, True, out)),
+                error_callback=lambda e: done.put((pool_index, False, e))
+            )
+
+        def consume(progress):
+            # returns whether the chunk left the pipeline, otherwise it moved on to the next stage group
+            nonlocal result
+            pool_index, success, chunk_out = done.get()
+            if not success:
+                raise chunk_out
+            chunk_out, chunk_stats, chunk_records, next_items = chunk_out
+            if chunk_records:
+                manifest.add(chunk_records)
+            if chunk_stats is not None:
+                for stage_stats, chunk_stage_stats in zip(stats, chunk_stats):
+                    for i, value in enumerate(chunk_stage_stats):
+                        stage_stats[i] += value
+            if not keep_outputs:
+                progress.update(chunk_out)
+            else:
+                progress.update(len(chunk_out))
+                for item in chunk_out:
+                    if self.reduce_func is not None:
+                        result = self.reduce_func(result, item)
+                    if self.post_process_func is not None:
+                        process_outs.append(item)
+
+            if next_items:
+                submit(pool_index + 1, next_items)
+                return False
+            return True
+
+        start_time = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                pools = [stack.enter_context(self.pool(workers)) for _, _, workers in groups]
+                progress = stack.enter_context(tqdm(total=total, desc=desc))
+                worker_inputs = self._skip_done(self.get_worker_inputs(), manifest, progress)
+
+                in_flight = 0
+                for chunk in self._chunks(worker_inputs):
+                    while in_flight >= max_in_flight:
+                        in_flight -= consume(progress)
+                    submit(0, chunk)
+                    in_flight += 1
+
+                while in_flight > 0:
+                    in_flight -= consume(progress)
+                n_items = progress.n
+        finally:
+            if manifest is not None:
+                manifest.close()
+            if share:
+                # items handed between pools when the run failed
+                while not done.empty():
+                    _, success, chunk_out = done.get()
+                    if success:
+                        for _, _, prev_output in chunk_out[3]:
+                            _from_shared(prev_output, copy=False)
+        wall_seconds = time.perf_counter() - start_time
+
+        if self.profile_enabled:
+            self._report_profile(stats, n_items, wall_seconds, desc)
+
         if self.post_process_func is not None:
             self.post_process_func(process_outs)
+        return result
+
+    def _report_profile(self, stats, n_items, wall_seconds, desc):
+        # seconds are summed over all workers, so they add up to about workers * wall time when the pool is busy
+        total_seconds = sum(stage_stats[0] for stage_stats in stats) or 1
+        stages = [{
+            'stage': i,
+            'function': getattr(func, '__name__', repr(func)),
+            'seconds': seconds,
+            'calls': calls,
+            'ms_per_call': seconds / calls * 1000 if calls else 0,
+            'time_percent': seconds / total_seconds * 100,
+            'early_terminations': terminations,
+            'bytes_read': n_read,
+            'bytes_written': n_written,
+        } for i, (func, (seconds, calls, terminations, n_read, n_written)) in enumerate(zip(self.functions, stats))]
+
+        # workers of each stage group
+        group_workers = [workers for _, _, workers in self._stage_groups()]
+        print(f'Pipeline profile{f" ({desc})" if desc else ""}: {n_items} items in {wall_seconds:.1f}s '
+              f'with {"+".join(str(workers) for workers in group_workers)} workers')
+        print(f'{"#":>3} {"function":<32}{"calls":>10}{"total s":>10}{"ms/call":>10}{"time %":>8}'
+              f'{"early end":>11}{"MB read":>10}{"MB written":>12}')
+        for stage in stages:
+            print(f'{stage["stage"]:>3} {stage["function"]:<32}{stage["calls"]:>10}{stage["seconds"]:>10.2f}'
+                  f'{stage["ms_per_call"]:>10.2f}{stage["time_percent"]:>8.1f}{stage["early_terminations"]:>11}'
+                  f'{stage["bytes_read"] / 2 ** 20:>10.1f}{stage["bytes_written"] / 2 ** 20:>12.1f}')
+
+        if self.profile_file is not None:
+            with open(self.profile_file, 'w') as file:
+                json.dump({
+                    'desc': desc,
+                    'items': n_items,
+                    'workers': group_workers,
+                    'wall_seconds': wall_seconds,
+                    'stages': stages,
+                }, file, indent=2)
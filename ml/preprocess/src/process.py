@@ -4,14 +4,18 @@ from multiprocessing.dummy import Pool as ThreadPool
 from pathlib import Path
 
 import imagehash
+import numpy as np
 from PIL import Image, ImageOps
 from tqdm import tqdm
 
+from ml.preprocess.src.duplicates import pack_hash, cluster_near_duplicates, group_clusters
+
 CROP_EMPTY = True
 RESIZE_SIZE = 512
 
 CROP_INSTEAD_OF_PAD = True
 RETURN_HASH = False
+MAX_DISTANCE = 0  # bits of the 64 bit phash, 0 only removes exact duplicates, > 0 also near duplicates
 
 
 # worker method
@@ -82,10 +86,9 @@ def center_crop_coord(im, new_size):
     return left, top, right, bottom
 
 
-def _multi(Pool, amount, worker_inputs):
-    seen = set()
-    valids = 0
-    dups = []
+def _multi(Pool, amount, worker_inputs, max_distance):
+    hashes = []
+    indices = []
     empties = 0
 
     with Pool(amount) as pool:
@@ -94,13 +97,16 @@ def _multi(Pool, amount, worker_inputs):
                 empties += 1
                 continue
             else:
-                valids += 1
+                hashes.append(pack_hash(im_hash))
+                indices.append(i)
 
-                # check duplicates
-                if im_hash in seen:
-                    dups.append(worker_inputs[i][2])  # for later delete file
-                else:
-                    seen.add(im_hash)
+    # keep the first of each cluster of near duplicates, in order of the inputs
+    clusters = []
+    if hashes:
+        order = np.argsort(indices)
+        labels = cluster_near_duplicates(np.stack(hashes)[order], max_distance)
+        clusters = group_clusters(np.asarray(indices)[order], labels)
+    dups = [worker_inputs[i][2] for cluster in clusters for i in cluster[1:]]  # for later delete file
 
     # remove duplicates
     for p in dups:
@@ -108,14 +114,14 @@ def _multi(Pool, amount, worker_inputs):
 
     print(fr'Amount     of            data: {len(worker_inputs)}')
     print(fr'\_Amount   of     empty  data: {empties}')
-    print(fr'\_Amount   of non empty  data: {valids}')
+    print(fr'\_Amount   of non empty  data: {len(indices)}')
     print(fr'  \_Amount of similar    data: {len(dups)}')
-    print(fr'  \_Amount of remaining  data: {len(seen)}')
+    print(fr'  \_Amount of remaining  data: {len(clusters)}')
 
 
-def multi_process(worker_inputs):
-    return _multi(ProcessPool, os.cpu_count() - 1, worker_inputs)
+def multi_process(worker_inputs, max_distance=MAX_DISTANCE):
+    return _multi(ProcessPool, os.cpu_count() - 1, worker_inputs, max_distance)
 
 
-def multi_thread(worker_inputs):
-    return _multi(ThreadPool, 4, worker_inputs)
+def multi_thread(worker_inputs, max_distance=MAX_DISTANCE):
+    return _multi(ThreadPool, 4, worker_inputs, max_distance)
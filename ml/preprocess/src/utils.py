@@ -26,4 +26,19 @@ def find_all_image_paths(root, recursive=True):
 
 
 def get_last_comp(path):
-    return os.path.basename(os.path.normpath(path))
\ No newline at end of file
+    return os.path.basename(os.path.normpath(path))
+
+
+def atomic_write(path, write):
+    """
+    write(file) writes the content to an open binary file next to path, which is then renamed over path,
+    so that path is either the previous or the complete new file, never a partial write.
+    """
+    tmp_path = f'{path}.tmp'
+    try:
+        with open(tmp_path, 'wb') as file:
+            write(file)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
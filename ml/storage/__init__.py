@@ -0,0 +1,15 @@
+from ml.file_utils import _find_cls_using_name
+from ml.logger import log
+from ml.storage.base import BaseStorage
+
+
+def create_storage(opt):
+    log(f'Finding storage with name: [{opt.storage_backend}] ... ', end='')
+    instance = _find_cls_using_name(
+        opt.storage_backend,
+        package='storage',
+        parent_class=BaseStorage,
+        cls_postfix='Storage'
+    )(opt)
+    log(f'done, [{instance.__class__.__name__}] was created')
+    return instance
@@ -0,0 +1,30 @@
+from abc import ABC, abstractmethod
+from typing import List
+
+
+class BaseStorage(ABC):
+    """
+    Backup location for files produced by a run, e.g. checkpoints, grouped by run_id.
+    Files are always used from the working directory, storage only copies them in and out.
+    """
+
+    def __init__(self, opt):
+        self.opt = opt
+
+    @abstractmethod
+    def save(self, run_id, file_name) -> None:
+        # copy local file_name into the storage of run_id
+        pass
+
+    @abstractmethod
+    def load(self, run_id, file_name) -> bool:
+        # copy file_name from the storage of run_id to local, false if it is not stored
+        pass
+
+    @abstractmethod
+    def exists(self, run_id, file_name) -> bool:
+        pass
+
+    @abstractmethod
+    def list(self, run_id) -> List[str]:
+        pass
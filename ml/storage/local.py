@@ -0,0 +1,44 @@
+import os
+import shutil
+from pathlib import Path
+
+from ml.storage.base import BaseStorage
+
+
+def _copy_file(src, dst):
+    # copy then rename, so that dst is never half written
+    tmp = dst + '.tmp'
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class LocalStorage(BaseStorage):
+    """
+    Keeps files under working_folder/run_id, which can be a local directory or a mounted network drive.
+    """
+
+    def _get_path(self, run_id, file_name=''):
+        return os.path.join(self.opt.working_folder, run_id, file_name)
+
+    def save(self, run_id, file_name):
+        path = self._get_path(run_id, os.path.basename(file_name))
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        if os.path.abspath(path) != os.path.abspath(file_name):
+            _copy_file(file_name, path)
+
+    def load(self, run_id, file_name):
+        path = self._get_path(run_id, os.path.basename(file_name))
+        if not os.path.isfile(path):
+            return False
+        if os.path.abspath(path) != os.path.abspath(file_name):
+            _copy_file(path, file_name)
+        return True
+
+    def exists(self, run_id, file_name):
+        return os.path.isfile(self._get_path(run_id, os.path.basename(file_name)))
+
+    def list(self, run_id):
+        path = self._get_path(run_id)
+        if not os.path.isdir(path):
+            return []
+        return sorted(name for name in os.listdir(path) if os.path.isfile(os.path.join(path, name)))
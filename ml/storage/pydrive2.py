@@ -0,0 +1,141 @@
+import pprint
+import threading
+
+from pydrive2.auth import GoogleAuth
+from pydrive2.drive import GoogleDrive
+from pydrive2.settings import LoadSettingsFile
+
+from ml.logger import log
+from ml.storage.base import BaseStorage
+
+_FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+
+def ensure_folder_on_drive(drive, folder_name, parent_folder=None):
+    folders = drive.ListFile({
+        # see https://developers.google.com/drive/api/guides/search-files
+        'q': f"mimeType = '{_FOLDER_MIME_TYPE}' and title = '{folder_name}'"
+    }).GetList()
+
+    if len(folders) == 1:
+        return folders[0]
+
+    if len(folders) > 1:
+        log(pprint.pformat(folders))
+        raise AssertionError('Multiple Folders of the same name detected')
+
+    # folder not found, create a new one at root
+    # pprint(parent_folder)
+    log(f'Folder {folder_name} with parent {parent_folder["title"] if parent_folder else "root"} not found, creating... ',
+        end='')
+
+    folder = drive.CreateFile({
+        'title': folder_name,
+        "parents": [{
+            "kind": "drive#fileLink",
+            "id": parent_folder['id']
+        }] if parent_folder else [],
+        "mimeType": _FOLDER_MIME_TYPE
+    })
+    folder.Upload()
+
+    log('done')
+    return folder
+
+
+def connect_drive(settings_file):
+    log(f'Connecting to Google Drive for Saving and Backup')
+    g_auth = GoogleAuth(settings_file=settings_file)
+    # pydrive2 swallow error, we load it again to ensure it really works
+    log('Loading settings file ... ', end='')
+    LoadSettingsFile(settings_file)
+    log('done')
+    # g_auth.LocalWebserverAuth()
+    g_auth.CommandLineAuth()
+    drive = GoogleDrive(g_auth)
+    log(f'Authentication Finished')
+    return drive
+
+
+class PyDrive2Storage(BaseStorage):
+    """
+    Keeps files in working_folder/run_id on Google Drive,
+    file ids of each run folder are listed once and cached, so lookups do not scan the drive.
+    """
+
+    def __init__(self, opt):
+        super().__init__(opt)
+        self._drive = connect_drive(opt.pydrive2_settings_file)
+        self._working_folder = ensure_folder_on_drive(self._drive, opt.working_folder)
+        self._run_folders = {}  # run_id -> folder, only for folders that exist
+        self._file_ids = {}  # run_id -> {file title -> file id}
+        self._lock = threading.Lock()  # used by the checkpoint upload thread as well
+
+    def _get_run_folder(self, run_id, create=False):
+        if run_id not in self._run_folders:
+            if create:
+                self._run_folders[run_id] = ensure_folder_on_drive(self._drive, run_id, parent_folder=self._working_folder)
+            else:
+                folders = self._drive.ListFile({
+                    'q': f"mimeType = '{_FOLDER_MIME_TYPE}' and title = '{run_id}' "
+                         f"and '{self._working_folder['id']}' in parents and trashed = false"
+                }).GetList()
+                if not folders:
+                    return None
+                self._run_folders[run_id] = folders[0]
+        return self._run_folders[run_id]
+
+    def _get_file_ids(self, run_id, refresh=False):
+        if refresh or run_id not in self._file_ids:
+            folder = self._get_run_folder(run_id)
+            if folder is None:
+                return {}
+            files = self._drive.ListFile({
+                'q': f"'{folder['id']}' in parents and trashed = false"
+            }).GetList()
+            self._file_ids[run_id] = {file['title']: file['id'] for file in files}
+        return self._file_ids[run_id]
+
+    def _find_file_id(self, run_id, file_name):
+        file_id = self._get_file_ids(run_id).get(file_name)
+        if file_id is None:
+            # may have been uploaded by another process since the index was built
+            file_id = self._get_file_ids(run_id, refresh=True).get(file_name)
+        return file_id
+
+    def save(self, run_id, file_name):
+        with self._lock:
+            folder = self._get_run_folder(run_id, create=True)
+            file_ids = self._get_file_ids(run_id)
+
+            if file_name in file_ids:
+                # overwrite, e.g. latest, instead of creating another file with the same title
+                file = self._drive.CreateFile({'id': file_ids[file_name]})
+            else:
+                file = self._drive.CreateFile({
+                    'title': file_name,
+                    'parents': [{
+                        'id': folder['id']
+                    }]
+                })
+            file.SetContentFile(file_name)
+            file.Upload()
+            file_ids[file_name] = file['id']
+
+    def load(self, run_id, file_name):
+        with self._lock:
+            file_id = self._find_file_id(run_id, file_name)
+            if file_id is None:
+                return False
+            log('Downloading file requested ... ', end='')
+            self._drive.CreateFile({'id': file_id}).GetContentFile(file_name)
+            log('done')
+            return True
+
+    def exists(self, run_id, file_name):
+        with self._lock:
+            return self._find_file_id(run_id, file_name) is not None
+
+    def list(self, run_id):
+        with self._lock:
+            return sorted(self._get_file_ids(run_id, refresh=True))
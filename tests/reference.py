@@ -0,0 +1,41 @@
+import numpy as np
+import torch
+
+
+def random_images(rng, n, size):
+    # smooth random (n, size, size, 3) uint8 images with some edges, noise alone is all edges
+    small = rng.integers(0, 256, (n, size // 16, size // 16, 3), dtype=np.uint8)
+    ims = small.repeat(16, axis=1).repeat(16, axis=2).astype(np.int16)
+    ims += rng.integers(-8, 9, ims.shape, dtype=np.int16)
+    return np.clip(ims, 0, 255).astype(np.uint8)
+
+
+def to_batch(ims, device):
+    return torch.from_numpy(ims).permute(0, 3, 1, 2).float().to(device)
+
+
+def compute_weight_map_loop(im, n_bins, dist):
+    # what compute_weight_map did before, kept as the reference output
+    lin = np.linspace(0, 1, n_bins + 1)
+    out = np.zeros(im.shape)
+
+    w, h = im.shape[:2]
+    for x in range(w):
+        x_min = max(0, x - dist)
+        x_max = min(w, x + dist)
+        for y in range(h):
+            y_min = max(0, y - dist)
+            y_max = min(h, y + dist)
+            local = im[x_min:x_max, y_min:y_max]
+            bins = np.empty(n_bins)
+            for i in range(n_bins):
+                bins[i] = np.sum((local > lin[i]) * (local < lin[i + 1])) / local.size
+            p = im[x, y]
+            n = 0
+            for i in range(n_bins):
+                if lin[i] <= p <= lin[i + 1]:
+                    n = i
+                    break
+            out[x, y] = np.exp(-bins[n]) + 0.5
+
+    return out
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from ml.preprocess.src.functions import compute_weight_map, compute_weight_maps
+from tests.reference import compute_weight_map_loop
+
+CASES = [((7, 9), 4, 2), ((16, 11), 10, 3), ((20, 20), 5, 1), ((13, 17), 8, 30)]
+
+
+def _edge_mask(shape):
+    # lines on the border rows and columns, and one through the middle
+    mask = np.zeros(shape)
+    mask[0, :] = mask[-1, :] = mask[:, 0] = mask[:, -1] = 1
+    mask[:, shape[1] // 2] = 1
+    return mask
+
+
+def _images(shape, n_bins, rng):
+    # random values, values exactly on the bin edges, values outside of [0, 1], empty, full and edge touching masks
+    return {
+        'random': rng.random(shape),
+        'bin_edges': rng.integers(0, n_bins + 1, shape) / n_bins,
+        'out_of_range': rng.random(shape) * 1.4 - 0.2,
+        'empty': np.zeros(shape),
+        'full': np.ones(shape),
+        'edge': _edge_mask(shape),
+    }
+
+
+@pytest.mark.parametrize('shape, n_bins, dist', CASES)
+def test_compute_weight_map_same_as_loop(shape, n_bins, dist):
+    rng = np.random.default_rng(0)
+    for name, im in _images(shape, n_bins, rng).items():
+        expected = compute_weight_map_loop(im, n_bins, dist)
+        assert np.array_equal(compute_weight_map(im, (n_bins, dist)), expected), name
+
+
+def test_compute_weight_maps_same_as_loop():
+    rng = np.random.default_rng(0)
+    ims = np.concatenate([rng.random((3, 15, 10)), np.zeros((1, 15, 10)), _edge_mask((15, 10))[np.newaxis]])
+    expected = np.stack([compute_weight_map_loop(im, 6, 3) for im in ims])
+    assert np.array_equal(compute_weight_maps(ims, 6, 3), expected)
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+from ml.algorithms.xdog import extract_edges_cv, extract_edges_torch
+from tests.reference import random_images, to_batch
+
+SIGMAS = [0.3, 0.4, 0.5]
+MAX_MISMATCH = 0.005  # cv rounds its fixed point blur differently at some pixels, flipping a few edges
+
+
+@pytest.mark.parametrize('size', [37, 128])
+def test_extract_edges_torch_close_to_cv(size):
+    rng = np.random.default_rng(0)
+    ims = random_images(rng, len(SIGMAS), size)
+    expected = np.stack([extract_edges_cv(im, sigma=sigma) for im, sigma in zip(ims, SIGMAS)])
+    out = extract_edges_torch(to_batch(ims, 'cpu'), SIGMAS)[:, 0].numpy()
+    mismatch = np.mean(np.abs(out - expected) > 1e-3)
+    assert mismatch <= MAX_MISMATCH, f'{size}x{size}: {mismatch:.4%} pixels differ'